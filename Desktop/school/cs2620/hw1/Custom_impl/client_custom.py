@@ -1,70 +1,150 @@
 import socket
-import struct
 import threading
+import itertools
+import os
 import sys
 from protocol_custom import (
     CMD_LOGIN, CMD_CREATE, CMD_SEND, CMD_READ, CMD_DELETE_MSG,
     CMD_VIEW_CONV, CMD_DELETE_ACC, CMD_LOGOFF, CMD_CLOSE,
-    CMD_CHAT, CMD_LIST, CMD_READ_ACK,
-    encode_message, decode_message,
-    pack_short_string, pack_long_string,
-    unpack_short_string, unpack_long_string
+    CMD_CHAT, CMD_LIST, CMD_READ_ACK, CMD_HELLO, CMD_BATCH, CMD_READ_BULK, CMD_HISTORY_CHUNK, unpack_frames,
+    PROTOCOL_V1, PROTOCOL_VERSION, CODEC_V1, pack_hello, negotiated_codec, negotiated_caps,
+    split_request_id, REQUEST_ID, REQUEST_SCHEMAS, DELETE_UNREAD, CHAT, TEXT, HISTORY_CHUNK, unpack_unread_page,
+    encode_message, FrameReader,
+    pack_list, unpack_short_string
 )
 
-# Helper functions for packing data for each command
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from chat_common.compression import FrameCompressor, CompressionStats, SUPPORTED_CAPS, CAP_ZLIB, CAP_ZDICT
+from chat_common.outbound import send_buffers
+
+# Helper functions for packing data for each command (layouts in protocol_custom's schemas)
 def pack_login(username, password):
     # Pack username and password into a login payload
-    return pack_short_string(username) + pack_short_string(password)
+    return REQUEST_SCHEMAS[CMD_LOGIN].pack(CODEC_V1, (username, password))
 
 def pack_create(username, password):
     # Pack username and password for account creation
-    return pack_short_string(username) + pack_short_string(password)
+    return REQUEST_SCHEMAS[CMD_CREATE].pack(CODEC_V1, (username, password))
 
-def pack_send(sender, recipient, message):
+def pack_send(sender, recipient, message, codec=CODEC_V1):
     # Pack sender recipient and message into a payload
-    return pack_short_string(sender) + pack_short_string(recipient) + pack_long_string(message)
+    return REQUEST_SCHEMAS[CMD_SEND].pack(codec, (sender, recipient, message))
 
-def pack_read(username, limit):
-    # Pack username and a 1 byte limit 0 means read all messages
-    return pack_short_string(username) + struct.pack("!B", limit)
+def pack_read(username, limit, codec=CODEC_V1):
+    # Pack username and a limit (1 byte on v1, 4 on v2) 0 means read all messages
+    return REQUEST_SCHEMAS[CMD_READ].pack(codec, (username, limit))
 
-def pack_delete_msg(username, indices):
+def pack_delete_msg(username, indices, codec=CODEC_V1):
     # Pack username and a list of indices of messages to delete
-    data = pack_short_string(username)
-    data += struct.pack("!B", len(indices))
-    for idx in indices:
-        data += struct.pack("!B", idx)
-    return data
+    return DELETE_UNREAD.pack(codec, (username, indices))
 
-def pack_view_conv(username, other_user):
-    # Pack username and the other user to view conversation
-    return pack_short_string(username) + pack_short_string(other_user)
+def pack_view_conv(username, other_user, since_id=0, before_id=0, limit=0, codec=CODEC_V1, stream=False):
+    # Pack username and the other user to view conversation, plus the optional history cursor
+    # (IDs and limit are 1 byte on v1, 8 and 4 on v2; 0 means no bound) and streaming flag
+    return REQUEST_SCHEMAS[CMD_VIEW_CONV].pack(codec, (username, other_user, since_id, before_id, limit, int(stream)))
 
 def pack_delete_acc(username):
     # Pack username for account deletion
-    return pack_short_string(username)
+    return REQUEST_SCHEMAS[CMD_DELETE_ACC].pack(CODEC_V1, (username,))
 
 def pack_logoff(username):
     # Pack username for logging off
-    return pack_short_string(username)
+    return REQUEST_SCHEMAS[CMD_LOGOFF].pack(CODEC_V1, (username,))
 
 def pack_close(username):
     # Pack username for closing the connection
-    return pack_short_string(username)
+    return REQUEST_SCHEMAS[CMD_CLOSE].pack(CODEC_V1, (username,))
 
 # Chatclient class handles client server communication
 class ChatClient:
-    def __init__(self, host, port):
+    def __init__(self, host, port, version=PROTOCOL_VERSION, caps=SUPPORTED_CAPS):
         # Create and connect the socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((host, port))
+        # Buffers replies so a burst of frames is read with one recv
+        self.reader = FrameReader(self.sock)
         self.username = None 
+        self.codec = CODEC_V1
+        # Pipelining state: replies that arrived for other request IDs, and live pushes
+        # (untagged frames) read while waiting for a reply
+        self.request_ids = itertools.count(1)
+        self.replies = {}
+        self.pushes = []
+        # What compressing our own large frames (e.g. long messages) saved and cost
+        self.compression_stats = CompressionStats()
+        if version > PROTOCOL_V1:
+            self.negotiate(version, caps)
+
+    def negotiate(self, version, caps=0):
+        # Ask for a newer protocol version and optional capabilities (compression); the reader
+        # switches framing on the server's answer
+        self.sock.sendall(encode_message(CMD_HELLO, pack_hello(version, caps)))
+        cmd, data = self.reader.read_frame()
+        if cmd == CMD_HELLO:
+            self.codec = negotiated_codec(data)
+            agreed = negotiated_caps(data, caps)
+            if agreed & CAP_ZLIB:
+                self.codec = self.codec.with_compressor(FrameCompressor(
+                    use_dictionary=bool(agreed & CAP_ZDICT), stats=self.compression_stats))
+
+    def send_frame(self, cmd, payload, request_id=None):
+        # Header and payload go to sendmsg separately, so a large payload is never copied
+        send_buffers(self.sock, self.codec.encode_parts(cmd, payload, request_id))
+
+    def submit(self, cmd, payload):
+        # Send a tagged command without waiting for its reply; returns the ID to pass to wait_reply
+        request_id = next(self.request_ids) & 0xFFFFFFFF
+        self.send_frame(cmd, payload, request_id)
+        return request_id
+
+    def wait_reply(self, request_id):
+        # Next reply frame for request_id; frames for other requests are kept until asked for.
+        # With no request_id (v1) the next frame is the reply
+        if request_id is None:
+            return self.reader.read_frame()
+        queued = self.replies.get(request_id)
+        if queued:
+            reply = queued.pop(0)
+            if not queued:
+                del self.replies[request_id]
+            return reply
+        while True:
+            cmd, data = self.reader.read_frame()
+            cmd, reply_id, data = split_request_id(cmd, data)
+            if reply_id == request_id:
+                return cmd, data
+            if reply_id is None:
+                self.pushes.append((cmd, data))
+            else:
+                self.replies.setdefault(reply_id, []).append((cmd, data))
+
+    def request(self, cmd, payload):
+        # One command and its reply. Servers that negotiated v2 understand request IDs, so the
+        # reply is matched by ID and a live push arriving first is set aside instead of misread
+        return self.wait_reply(self.send_request(cmd, payload))
+
+    def send_request(self, cmd, payload):
+        # Send a command the way request() does; returns the ID its replies carry (None on v1,
+        # where replies are untagged and arrive in order)
+        if self.codec.version == PROTOCOL_V1:
+            self.send_frame(cmd, payload)
+            return None
+        return self.submit(cmd, payload)
+
+    def pipeline(self, commands):
+        # Send every (cmd, payload) in one write, then collect one reply per command in order,
+        # so a batch costs about one round trip instead of one per command
+        request_ids = [next(self.request_ids) & 0xFFFFFFFF for _ in commands]
+        buffers = []
+        for (cmd, payload), request_id in zip(commands, request_ids):
+            buffers.extend(self.codec.encode_parts(cmd, payload, request_id))
+        send_buffers(self.sock, buffers)
+        return [self.wait_reply(request_id) for request_id in request_ids]
 
     def login(self, username, password):
         # build and send the login payload
         payload = pack_login(username, password)
-        self.sock.sendall(encode_message(CMD_LOGIN, payload))
-        cmd, data = decode_message(self.sock)
+        cmd, data = self.request(CMD_LOGIN, payload)
         resp, _ = unpack_short_string(data, 0)
         # Update username if login is successful
         if "successful" in resp:
@@ -74,19 +154,17 @@ class ChatClient:
     def create_account(self, username, password):
         # Build and send the account creation payload
         payload = pack_create(username, password)
-        self.sock.sendall(encode_message(CMD_CREATE, payload))
-        cmd, data = decode_message(self.sock)
+        cmd, data = self.request(CMD_CREATE, payload)
         resp, _ = unpack_short_string(data, 0)
         print("create account response", resp)
 
     def list_accounts(self, wildcard="*"):
         # Use a helper function to pack the wildcard
         payload = pack_list(wildcard)
-        self.sock.sendall(encode_message(CMD_LIST, payload))
-        cmd, data = decode_message(self.sock)
+        cmd, data = self.request(CMD_LIST, payload)
         # If the server returned a long string response for the list unpack and display matching accounts
         if cmd == CMD_LIST:
-            resp, _ = unpack_long_string(data, 0)
+            resp, _ = self.codec.unpack_long_string(data, 0)
             print("matching accounts", resp)
         else:
             resp, _ = unpack_short_string(data, 0)
@@ -97,25 +175,78 @@ class ChatClient:
         if not self.username:
             print("please login first")
             return
-        payload = pack_send(self.username, recipient, message)
-        self.sock.sendall(encode_message(CMD_SEND, payload))
-        cmd, data = decode_message(self.sock)
+        payload = pack_send(self.username, recipient, message, self.codec)
+        cmd, data = self.request(CMD_SEND, payload)
         resp, _ = unpack_short_string(data, 0)
         print("send message response", resp)
 
+    def batch(self, commands):
+        # Run several (cmd, payload) commands as CMD_BATCH envelopes and return the reply frames
+        # they produced, in order. Commands are packed into as few envelopes as the frame limit
+        # allows (one, unless they add up to more than a v1 frame), all sent in a single write
+        envelopes = [[]]
+        size = 0
+        room = self.codec.max_payload - REQUEST_ID.size
+        for cmd, sub_payload in commands:
+            frame = self.codec.plain.encode_message(cmd, sub_payload)
+            if envelopes[-1] and size + len(frame) > room:
+                envelopes.append([])
+                size = 0
+            envelopes[-1].append(frame)
+            size += len(frame)
+        tagged = self.codec.version > PROTOCOL_V1
+        request_ids = [next(self.request_ids) & 0xFFFFFFFF if tagged else None for _ in envelopes]
+        self.sock.sendall(b"".join(self.codec.encode_message(CMD_BATCH, b"".join(frames), request_id)
+                                   for frames, request_id in zip(envelopes, request_ids)))
+        replies = []
+        for request_id in request_ids:
+            stream = bytearray()
+            while True:
+                cmd, data = self.wait_reply(request_id)
+                if cmd != CMD_BATCH:
+                    raise Exception(f"Unexpected reply to batch: command {cmd}")
+                stream += data[1:]
+                if not data[0]:
+                    break
+            replies.extend(unpack_frames(stream, self.codec))
+        return replies
+
+    def send_batch(self, messages):
+        # Send (recipient, message) pairs, to any mix of recipients, in a single CMD_BATCH.
+        # Returns the server's response for each message
+        if not self.username:
+            print("please login first")
+            return
+        replies = self.batch([(CMD_SEND, pack_send(self.username, recipient, message, self.codec))
+                              for recipient, message in messages])
+        return [unpack_short_string(data, 0)[0] for _, data in replies]
+
+    def send_messages(self, recipient, messages):
+        # Pipelined send_message: every message goes out before any reply is awaited.
+        # Returns the server's response for each message
+        if not self.username:
+            print("please login first")
+            return
+        replies = self.pipeline([(CMD_SEND, pack_send(self.username, recipient, message, self.codec))
+                                 for message in messages])
+        return [unpack_short_string(data, 0)[0] for _, data in replies]
+
     def read_messages(self, limit=0):
         # Check if user is logged in before reading messages
         if not self.username:
             print("please login first")
             return
-        payload = pack_read(self.username, limit)
-        self.sock.sendall(encode_message(CMD_READ, payload))
+        payload = pack_read(self.username, limit, self.codec)
+        if self.codec.version != PROTOCOL_V1:
+            self.read_messages_bulk(payload)
+            return
+        self.send_frame(CMD_READ, payload)
         print("reading messages")
         # Loop until a non read message is received
         while True:
-            cmd, data = decode_message(self.sock)
+            cmd, data = self.reader.read_frame()
             if cmd != CMD_READ:
-                msg_text, _ = unpack_long_string(data, 0)
+                msg_text, _ = self.codec.unpack_long_string(data, 0)
                 if msg_text == "NO_MESSAGES":
                     print("no new messages")
                 elif msg_text == "END_OF_MESSAGES":
@@ -123,48 +254,84 @@ class ChatClient:
                 else:
                     print("unexpected code  message", msg_text)
                 break
-            offset = 0
-            sender, offset = unpack_short_string(data, offset)
-            msg_text, offset = unpack_long_string(data, offset)
+            sender, msg_text = CHAT.unpack(self.codec, data)
             print("from", sender, ":", msg_text)
         # Send an acknowledgement after finishing reading messages
-        ack_payload = pack_short_string("DONE")
-        self.sock.sendall(encode_message(CMD_READ_ACK, ack_payload))
+        ack_payload = REQUEST_SCHEMAS[CMD_READ_ACK].pack(CODEC_V1, ("DONE",))
+        self.send_frame(CMD_READ_ACK, ack_payload)
+
+    def read_messages_bulk(self, payload):
+        # v2 servers send every unread message in a few CMD_READ_BULK frames; returns the
+        # (id, sender, timestamp, message) records
+        print("reading messages")
+        request_id = self.submit(CMD_READ_BULK, payload)
+        records = []
+        while True:
+            cmd, data = self.wait_reply(request_id)
+            if cmd != CMD_READ_BULK:
+                print("read failed:", TEXT.unpack(self.codec, data)[0])
+                return records
+            more, page = unpack_unread_page(self.codec, data)
+            records.extend(page)
+            if not more:
+                break
+        for msg_id, sender, timestamp, msg_text in records:
+            print(f"[ID {msg_id}] [{timestamp}] from", sender, ":", msg_text)
+        print("finished reading messages" if records else "no new messages")
+        return records
 
     def delete_messages(self, indices):
         # Check if user is logged in before deleting messages
         if not self.username:
             print("please login first")
             return
-        payload = pack_delete_msg(self.username, indices)
-        self.sock.sendall(encode_message(CMD_DELETE_MSG, payload))
-        cmd, data = decode_message(self.sock)
+        payload = pack_delete_msg(self.username, indices, self.codec)
+        cmd, data = self.request(CMD_DELETE_MSG, payload)
         resp, _ = unpack_short_string(data, 0)
         print("delete messages response", resp)
 
-    def view_conversation(self, other_user):
-        # Check if the user is logged in before viewing a conversation
+    def view_conversation(self, other_user, since_id=0, before_id=0, limit=0, stream=False):
+        # Check if the user is logged in before viewing a conversation. since_id fetches only
+        # the messages after the last one already shown
         if not self.username:
             print("please login first")
             return
-        payload = pack_view_conv(self.username, other_user)
-        self.sock.sendall(encode_message(CMD_VIEW_CONV, payload))
-        cmd, data = decode_message(self.sock)
-        if cmd == CMD_VIEW_CONV:
-            conv_str, _ = unpack_long_string(data, 0)
+        payload = pack_view_conv(self.username, other_user, since_id, before_id, limit, self.codec, stream)
+        request_id = self.send_request(CMD_VIEW_CONV, payload)
+        cmd, data = self.wait_reply(request_id)
+        if cmd == CMD_HISTORY_CHUNK:
+            print("conversation", self.read_history_chunks(data, request_id))
+        elif cmd == CMD_VIEW_CONV:
+            conv_str, _ = self.codec.unpack_long_string(data, 0)
             print("conversation", conv_str)
         else:
             resp, _ = unpack_short_string(data, 0)
             print("view conversation response", resp)
 
+    def read_history_chunks(self, data, request_id=None):
+        # Reassemble a streamed history, starting from its first CMD_HISTORY_CHUNK payload
+        chunks = []
+        while True:
+            more, text = HISTORY_CHUNK.unpack(self.codec, data)
+            chunks.append(text)
+            if not more:
+                return "".join(chunks)
+            if request_id is not None:
+                cmd, data = self.wait_reply(request_id)
+                continue
+            cmd, data = self.reader.read_frame()
+            # A live message arriving mid-stream is kept for later
+            while cmd == CMD_CHAT:
+                self.pushes.append((cmd, data))
+                cmd, data = self.reader.read_frame()
+
     def delete_account(self):
         # Delete the currently logged in account
         if not self.username:
             print("please login first")
             return
         payload = pack_delete_acc(self.username)
-        self.sock.sendall(encode_message(CMD_DELETE_ACC, payload))
-        cmd, data = decode_message(self.sock)
+        cmd, data = self.request(CMD_DELETE_ACC, payload)
         resp, _ = unpack_short_string(data, 0)
         print("delete account response", resp)
         if "deleted" in resp.lower():
@@ -176,8 +343,7 @@ class ChatClient:
             print("not logged in")
             return
         payload = pack_logoff(self.username)
-        self.sock.sendall(encode_message(CMD_LOGOFF, payload))
-        cmd, data = decode_message(self.sock)
+        cmd, data = self.request(CMD_LOGOFF, payload)
         resp, _ = unpack_short_string(data, 0)
         print("log off response", resp)
         self.username = None
@@ -186,7 +352,7 @@ class ChatClient:
         # Close the connection to the server
         uname = self.username if self.username else ""
         payload = pack_close(uname)
-        self.sock.sendall(encode_message(CMD_CLOSE, payload))
+        self.send_frame(CMD_CLOSE, payload)
         self.sock.close()
 
 def client_main():
@@ -246,7 +412,7 @@ def client_main():
                 client.delete_messages(idx_list)
             elif choice == "5":
                 ou = input("enter other user's name ")
-                client.view_conversation(ou)
+                client.view_conversation(ou, stream=True)
             elif choice == "6":
                 client.delete_account()
             elif choice == "7":
@@ -6,6 +6,11 @@ import sys
 import struct
 import ast 
 
+# Framing and string decoding shared with the server; FrameReader payloads are memoryviews
+from protocol_custom import FrameReader, unpack_short_string, unpack_long_string
+# Payload layouts shared with the command-line client; this GUI always speaks protocol v1
+from protocol_custom import CODEC_V1, REQUEST_SCHEMAS, DELETE_UNREAD, CHAT
+
 PORT = 56789 
 MSGLEN = 409600               
 
@@ -21,71 +26,6 @@ CMD_CLOSE      = 9
 CMD_CHAT       = 10
 CMD_LIST       = 11
 
-HEADER_FORMAT = "!BH" 
-HEADER_SIZE = struct.calcsize(HEADER_FORMAT) 
-
-def encode_message(cmd, payload_bytes):
-    # Pack the command and length of the payload into a header
-    header = struct.pack(HEADER_FORMAT, cmd, len(payload_bytes))
-    # Return header concatenated with payload
-    return header + payload_bytes
-
-def decode_message(sock):
-    # Read the header first
-    header = b""
-    while len(header) < HEADER_SIZE:
-        chunk = sock.recv(HEADER_SIZE - len(header))
-        if not chunk:
-            # Connection closed unexpectedly
-            raise Exception("Connection closed while reading header")
-        header += chunk
-    # Unpack header to get command and payload length
-    cmd, payload_len = struct.unpack(HEADER_FORMAT, header)
-    payload = b""
-    # Read the payload based on length specified in header
-    while len(payload) < payload_len:
-        chunk = sock.recv(payload_len - len(payload))
-        if not chunk:
-            raise Exception("Connection closed while reading payload")
-        payload += chunk
-    return cmd, payload
-
-def pack_short_string(s):
-    # Convert string to bytes using UTF-8 encoding
-    b = s.encode('utf-8')
-    # Check that the string is not too long to pack in 1 byte length
-    if len(b) > 255:
-        raise ValueError("String too long for short string (exceeds 255 bytes).")
-    # Pack length (1 byte) and then the actual string bytes
-    return struct.pack("!B", len(b)) + b
-
-def unpack_short_string(data, offset):
-    # Unpack the length of the short string (1 byte)
-    length = struct.unpack_from("!B", data, offset)[0]
-    offset += 1
-    # Extract the string bytes based on the length and decode to UTF-8
-    s = data[offset:offset+length].decode('utf-8')
-    offset += length
-    return s, offset
-
-def pack_long_string(s):
-    # Convert string to bytes using UTF-8 encoding
-    b = s.encode('utf-8')
-    # Ensure string length fits within 2 bytes length (max 65535)
-    if len(b) > 65535:
-        raise ValueError("String too long for long string (exceeds 65535 bytes).")
-    # Pack length (2 bytes) and then the string bytes
-    return struct.pack("!H", len(b)) + b
-
-def unpack_long_string(data, offset):
-    # Unpack the length of the long string (2 bytes)
-    length = struct.unpack_from("!H", data, offset)[0]
-    offset += 2
-    # Extract and decode the string
-    s = data[offset:offset+length].decode('utf-8')
-    offset += length
-    return s, offset
-
 def decode_response(cmd, payload):
     # For commands that expect a short response
     if cmd in (CMD_LOGIN, CMD_CREATE, CMD_SEND, CMD_DELETE_MSG, CMD_LOGOFF, CMD_DELETE, CMD_CLOSE):
@@ -112,21 +52,19 @@ def decode_response(cmd, payload):
                 else:
                     return marker
         # Otherwise, unpack a sender and a long message
-        sender, offset = unpack_short_string(payload, 0)
-        message, _ = unpack_long_string(payload, offset)
+        sender, message = CHAT.unpack(CODEC_V1, payload)
         return {"sender": sender, "message": message}
     elif cmd == CMD_CHAT:
         try:
             # For chat messages, try unpacking sender and message
-            sender, offset = unpack_short_string(payload, 0)
-            message, _ = unpack_long_string(payload, offset)
+            sender, message = CHAT.unpack(CODEC_V1, payload)
             return {"sender": sender, "message": message}
         except Exception:
             # Fallback: decode as plain UTF-8 text
-            return payload.decode('utf-8', errors='replace')
+            return str(payload, 'utf-8', errors='replace')
     else:
         # For any unknown command, decode the payload as UTF-8
-        return payload.decode('utf-8', errors='replace')
+        return str(payload, 'utf-8', errors='replace')
 
 class ChatClient:
     def __init__(self, server_host, server_port):
@@ -141,59 +79,44 @@ class ChatClient:
         self.running = True
 
     def send_message(self, cmd, data):
-        # Build payloads based on the command type
+        # Pick the payload layout and its values based on the command type
+        schema = REQUEST_SCHEMAS.get(cmd)
         if cmd in (CMD_LOGIN, CMD_CREATE):
-            username = data.get("from", "")
-            password = data.get("password", "")
-            # For login or account creation, pack username and password as short strings
-            payload = pack_short_string(username) + pack_short_string(password)
+            # For login or account creation, the username and password
+            values = (data.get("from", ""), data.get("password", ""))
         elif cmd == CMD_SEND:
-            sender = data.get("from", "")
-            recipient = data.get("to", "")
-            message = data.get("body", "")
-            # For sending messages, pack sender, recipient and message (as a long string)
-            payload = pack_short_string(sender) + pack_short_string(recipient) + pack_long_string(message)
+            # For sending messages, the sender, recipient and message
+            values = (data.get("from", ""), data.get("to", ""), data.get("body", ""))
         elif cmd == CMD_LIST:
-            wildcard = data.get("body", "*")
-            # Use a wildcard to list matching accounts; pack as a short string
-            payload = pack_short_string(wildcard)
+            # Use a wildcard to list matching accounts
+            values = (data.get("body", "*"),)
         elif cmd == CMD_READ:
-            username = data.get("from", "")
             try:
                 # Limit indicates the number of messages to retrieve
                 limit = int(data.get("body", "0"))
             except:
                 limit = 0
-            # Pack username and limit (1 byte)
-            payload = pack_short_string(username) + struct.pack("!B", limit)
+            values = (data.get("from", ""), limit)
         elif cmd == CMD_DELETE_MSG:
-            username = data.get("from", "")
-            indices_str = data.get("body", "")
             indices = []
             # Parse comma-separated message indices to delete
-            for part in indices_str.split(","):
+            for part in data.get("body", "").split(","):
                 part = part.strip()
                 if part.isdigit():
                     indices.append(int(part))
-            count = len(indices)
-            payload = pack_short_string(username) + struct.pack("!B", count)
-            # Append each index as a byte
-            for idx in indices:
-                payload += struct.pack("!B", idx)
+            schema = DELETE_UNREAD
+            values = (data.get("from", ""), indices)
         elif cmd == CMD_VIEW_CONV:
-            username = data.get("from", "")
-            other = data.get("to", "")
-            # Pack usernames to view conversation between two users
-            payload = pack_short_string(username) + pack_short_string(other)
+            # Usernames of both sides of the conversation
+            values = (data.get("from", ""), data.get("to", ""))
         elif cmd in (CMD_DELETE, CMD_LOGOFF, CMD_CLOSE):
-            username = data.get("from", "")
             # For account deletion, logoff, or closing, only the username is needed
-            payload = pack_short_string(username)
+            values = (data.get("from", ""),)
         else:
-            payload = b""
-        # Encode the complete message (header + payload) and send it
-        msg = encode_message(cmd, payload)
-        self.sock.sendall(msg)
+            self.sock.sendall(CODEC_V1.encode_message(cmd, b""))
+            return
+        # Build the complete message (header + payload) in one buffer and send it
+        self.sock.sendall(schema.frame(CODEC_V1, cmd, values))
 
     def close(self):
         # Stop the receive loop and close the socket connection
@@ -202,9 +125,10 @@ class ChatClient:
 
     def receive_loop(self, callback):
         # Continuously listen for incoming messages from the server
+        reader = FrameReader(self.sock)
         while self.running:
             try:
-                cmd, payload = decode_message(self.sock)
+                cmd, payload = reader.read_frame()
             except Exception as e:
                 # Print error to stderr if connection is lost or an error occurs
                 print("Error receiving message:", e, file=sys.stderr)
@@ -1,7 +1,18 @@
+import copy
+import os
 import struct
+import sys
+from array import array
+from operator import itemgetter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from chat_common.compression import decompress
 
 HEADER_FORMAT = "!BH"  
 HEADER_SIZE = struct.calcsize(HEADER_FORMAT)  
+HEADER = struct.Struct(HEADER_FORMAT)
+# Bytes requested per recv_into by FrameReader
+READ_SIZE = 65536
 
 CMD_LOGIN        = 1
 CMD_CREATE       = 2
@@ -15,6 +26,40 @@ CMD_CLOSE        = 9
 CMD_CHAT         = 10
 CMD_LIST         = 11
 CMD_READ_ACK     = 12  
+# Version negotiation. The client sends it (v1-framed) with the highest version it speaks as
+# one byte, optionally followed by a byte of capability bits (chat_common.compression.CAP_*);
+# the server answers (v1-framed) with the version and capabilities it picked. Every later frame
+# in either direction uses the picked version. Clients that never send it stay on v1
+CMD_HELLO        = 13
+# Envelope for many sub-commands. The payload is a run of complete frames (same framing as the
+# connection, untagged); the server runs them in order and answers with CMD_BATCH frames whose
+# payload is one "more" byte followed by a slice of the sub-replies' frames. The slices
+# concatenate to the full reply stream; the last frame has more == 0
+CMD_BATCH        = 14
+# Unread messages in bulk (v2 only). The request is laid out like CMD_READ's; the reply is one or
+# more CMD_READ_BULK frames, each a "more" byte, a record count and that many UNREAD_RECORDs.
+# The last frame has more == 0. An unknown user (or a v1 connection) gets a CMD_READ text reply
+CMD_READ_BULK    = 15
+# One chunk of a streamed CMD_VIEW_CONV reply (requested with its "stream" field): a "more"
+# byte and a long string holding whole lines of the formatted history. The chunks concatenate
+# to the full history text; the last one has more == 0 and is empty
+CMD_HISTORY_CHUNK = 16
+
+# A command byte with this bit set carries a 32-bit request ID in front of its payload, and the
+# server tags every reply frame to it with the same ID, so a client can keep many commands in
+# flight and still match the answers (live CMD_CHAT pushes stay untagged). CMD_HELLO is never tagged
+REQUEST_ID_FLAG = 0x80
+REQUEST_ID = struct.Struct("!I")
+# A command byte with this bit set has a zlib-compressed payload (request ID prefix included).
+# Only sent to peers whose CMD_HELLO offered compression; readers inflate it transparently.
+# Sub-frames inside a CMD_BATCH are never compressed, the envelope is
+COMPRESSED_FLAG = 0x40
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_VERSION = PROTOCOL_V2
+# Largest v2 frame either side accepts
+MAX_V2_PAYLOAD = 64 << 20
 
 # Helper functions for packing and unpacking strings
 
@@ -26,12 +71,13 @@ def pack_short_string(s):
     return struct.pack("!B", len(b)) + b
 
 def pack_list(wildcard="*"):
-    return pack_short_string(wildcard)
+    return REQUEST_SCHEMAS[CMD_LIST].pack(CODEC_V1, (wildcard,))
 
 def unpack_short_string(data, offset):
     length = struct.unpack_from("!B", data, offset)[0]
     offset += 1
-    s = data[offset:offset+length].decode('utf-8') 
+    # str() decodes straight from bytes, bytearray or a memoryview slice without copying it first
+    s = str(data[offset:offset+length], 'utf-8')
     # Update offset past the string bytes
     offset += length  
     return s, offset
@@ -46,7 +92,7 @@ def pack_long_string(s):
 def unpack_long_string(data, offset):
     length = struct.unpack_from("!H", data, offset)[0]
     offset += 2  
-    s = data[offset:offset+length].decode('utf-8') 
+    s = str(data[offset:offset+length], 'utf-8')
     offset += length
     return s, offset
 
@@ -75,3 +121,682 @@ def decode_message(sock):
             raise Exception("Connection closed while reading payload.")
         payload += chunk
     return cmd, payload
+
+class FrameParser:
+    # Incremental decoder for non-blocking sockets: bytes arrive in arbitrary slices, so
+    # keep the parse state (waiting for header / waiting for payload) between calls
+    def __init__(self):
+        self.buffer = bytearray()
+        self.cmd = None  # set once the header of the current frame has been parsed
+        self.payload_len = 0
+        self.codec = CODEC_V1  # switched by a CMD_HELLO frame
+
+    def feed(self, data):
+        # Append newly received bytes and return every frame they complete
+        self.buffer += data
+        frames = []
+        while True:
+            if self.cmd is None:
+                if len(self.buffer) < self.codec.header.size:
+                    break
+                self.cmd, self.payload_len = self.codec.header.unpack_from(self.buffer, 0)
+                self.codec.check_length(self.payload_len)
+                del self.buffer[:self.codec.header.size]
+            if len(self.buffer) < self.payload_len:
+                break
+            payload = bytes(self.buffer[:self.payload_len])
+            del self.buffer[:self.payload_len]
+            if self.cmd & COMPRESSED_FLAG:
+                self.cmd &= ~COMPRESSED_FLAG
+                payload = decompress(payload, self.codec.max_payload)
+            frames.append((self.cmd, payload))
+            if self.cmd == CMD_HELLO:
+                self.codec = negotiated_codec(payload)
+            self.cmd = None
+        return frames
+
+class Codec:
+    # Wire format of one protocol version. v1: 16-bit frame and long-string lengths, 8-bit read
+    # limits, counts and message IDs. v2: 32-bit lengths, limits and counts, and 64-bit message IDs.
+    # Short strings (usernames, status replies) keep their one-byte length in both
+    def __init__(self, version, header_format, long_format, count_format, id_format, max_payload=None):
+        self.version = version
+        # Set on a connection's own copy (with_compressor) once compression was negotiated
+        self.compressor = None
+        self.plain = self
+        self.header = struct.Struct(header_format)
+        self.long_len = struct.Struct(long_format)
+        self.count = struct.Struct(count_format)
+        self.msg_id = struct.Struct(id_format)
+        self.max_payload = max_payload or (1 << (8 * (self.header.size - 1))) - 1
+        self.max_long = min((1 << (8 * self.long_len.size)) - 1, self.max_payload)
+
+    def check_length(self, payload_len):
+        # Readers call this before buffering a frame, so a bogus length can't make them allocate GBs
+        if payload_len > self.max_payload:
+            raise ValueError(f"Frame too long for protocol v{self.version} ({payload_len} bytes).")
+
+    def with_compressor(self, compressor):
+        # Same wire format, but payloads over the compressor's threshold go out compressed
+        codec = copy.copy(self)
+        codec.compressor = compressor
+        codec.plain = self.plain
+        return codec
+
+    def encode_message(self, cmd, payload_bytes, request_id=None):
+        return b"".join(self.encode_parts(cmd, payload_bytes, request_id))
+
+    def encode_parts(self, cmd, payload_bytes, request_id=None, prefix=b""):
+        # The frame as [header, payload] for a scatter-gather send (chat_common.outbound.send_parts):
+        # the payload is passed through untouched instead of being copied in behind the header.
+        # prefix is a short run of payload bytes to place in front of it (packed with the header)
+        head = prefix
+        if request_id is not None:
+            cmd |= REQUEST_ID_FLAG
+            head = REQUEST_ID.pack(request_id) + prefix
+        if self.compressor is not None and len(head) + len(payload_bytes) >= self.compressor.threshold:
+            packed = self.compressor.compress(head + payload_bytes)
+            if packed is not None:
+                self.check_length(len(packed))
+                return [self.header.pack(cmd | COMPRESSED_FLAG, len(packed)), packed]
+        payload_len = len(head) + len(payload_bytes)
+        self.check_length(payload_len)
+        return [self.header.pack(cmd, payload_len) + head, payload_bytes]
+
+    def pack_long_string(self, s):
+        b = s.encode('utf-8')
+        if len(b) > self.max_long:
+            raise ValueError(f"String too long for protocol v{self.version} long string ({len(b)} bytes).")
+        return self.long_len.pack(len(b)) + b
+
+    def unpack_long_string(self, data, offset):
+        length = self.long_len.unpack_from(data, offset)[0]
+        offset += self.long_len.size
+        s = str(data[offset:offset+length], 'utf-8')
+        return s, offset + length
+
+    def pack_count(self, n):
+        return self.count.pack(n)
+
+    def unpack_count(self, data, offset):
+        return self.count.unpack_from(data, offset)[0], offset + self.count.size
+
+    def pack_ids(self, ids):
+        return b"".join(self.msg_id.pack(i) for i in ids)
+
+    def unpack_ids(self, data, offset, n):
+        if len(data) - offset < n * self.msg_id.size:
+            raise ValueError("Not enough bytes for message IDs")
+        ids = [self.msg_id.unpack_from(data, offset + i * self.msg_id.size)[0] for i in range(n)]
+        return ids, offset + n * self.msg_id.size
+
+CODEC_V1 = Codec(PROTOCOL_V1, HEADER_FORMAT, "!H", "!B", "!B")
+CODEC_V2 = Codec(PROTOCOL_V2, "!BI", "!I", "!I", "!Q", max_payload=MAX_V2_PAYLOAD)
+CODECS = {PROTOCOL_V1: CODEC_V1, PROTOCOL_V2: CODEC_V2}
+
+# Field kinds a MessageSchema is declared with
+BYTE = "byte"    # unsigned 8-bit integer
+SHORT = "short"  # UTF-8 string with a one-byte length
+LONG = "long"    # UTF-8 string with the codec's long-string length
+COUNT = "count"  # the codec's count / limit integer
+IDS = "ids"      # list of message IDs: a codec count, then that many codec IDs
+ID = "id"        # one codec message ID
+# Long strings from this many characters on are sent as a separate buffer by frame_parts
+SCATTER_MIN = 1024
+
+class MessageSchema:
+    # Declarative layout of one payload as (name, kind) or (name, kind, default) fields.
+    # Trailing fields with a default may be left out of both the values and the payload.
+    # For each codec the schema is compiled once into an encoder and decoder specialised to its
+    # layout (see compile_schema): straight-line code over precomputed struct.Struct objects,
+    # with no loop over the fields per message
+    def __init__(self, *fields):
+        self.fields = fields
+        self.names = tuple(field[0] for field in fields)
+        self.kinds = tuple(field[1] for field in fields)
+        self.defaults = tuple(field[2] for field in fields if len(field) > 2)
+        self.required = len(fields) - len(self.defaults)
+        self.compiled = {}
+        # Every field but a trailing long string, for frame_parts
+        self.scatter = bool(fields) and self.kinds[-1] == LONG
+        self.head = MessageSchema(*fields[:-1]) if len(fields) > 1 and self.scatter else None
+
+    def compile(self, codec):
+        # (encode, decode, decode_from) for this codec's version, built on first use
+        functions = self.compiled.get(codec.version)
+        if functions is None:
+            functions = self.compiled[codec.version] = compile_schema(self, codec)
+        return functions
+
+    def pack(self, codec, values):
+        # Just the payload
+        functions = self.compiled.get(codec.version) or self.compile(codec)
+        return functions[0](values)
+
+    def frame(self, codec, cmd, values, request_id=None):
+        # The complete frame, header and request ID included, built in the payload's buffer.
+        # Frames that may be compressed go through the codec, which has to see the whole payload
+        if codec.compressor is not None:
+            return codec.encode_message(cmd, self.pack(codec, values), request_id)
+        functions = self.compiled.get(codec.version) or self.compile(codec)
+        return functions[0](values, cmd, request_id)
+
+    def frame_parts(self, codec, cmd, values, request_id=None):
+        # The frame as a list of buffers for a scatter-gather send. A long trailing string,
+        # usually the bulk of the frame, becomes a buffer of its own instead of being copied in
+        # behind the header; short frames are cheaper to build in one piece
+        if not self.scatter or len(values[-1]) < SCATTER_MIN:
+            if codec.compressor is not None:
+                return [self.frame(codec, cmd, values, request_id)]
+            functions = self.compiled.get(codec.version) or self.compile(codec)
+            return [functions[0](values, cmd, request_id)]
+        body = values[-1].encode('utf-8')
+        if len(body) > codec.max_long:
+            raise ValueError(f"String too long for field {self.names[-1]} ({len(body)} bytes).")
+        prefix = codec.long_len.pack(len(body))
+        if self.head is not None:
+            prefix = self.head.pack(codec, values[:-1]) + prefix
+        return codec.encode_parts(cmd, body, request_id, prefix)
+
+    def unpack(self, codec, data, offset=0):
+        # Field values as a tuple; missing trailing fields take their defaults
+        functions = self.compiled.get(codec.version) or self.compile(codec)
+        return functions[2](data, offset)[0]
+
+    def unpack_from(self, codec, data, offset=0):
+        # (values, offset just past them), for records packed back to back
+        functions = self.compiled.get(codec.version) or self.compile(codec)
+        return functions[2](data, offset)
+
+# Most variable-length fields one compiled schema may have (each one is a slot, see below)
+MAX_SLOTS = 3
+
+def schema_slots(schema, codec):
+    # Split a layout into slots, one per string or ID list: the fixed-width fields in front of it
+    # and its length, packed together by one Struct. Fixed-width fields after the last one are
+    # the tail. Returns ([(fixed indices, format, index, is ID list, byte limit, name)],
+    # (tail indices, tail format)), formats without the byte-order prefix
+    slots = []
+    fixed, fmt = [], ""
+    for i, (name, kind) in enumerate(zip(schema.names, schema.kinds)):
+        if kind == SHORT:
+            slots.append((tuple(fixed), fmt + "B", i, False, 255, name))
+        elif kind == LONG:
+            slots.append((tuple(fixed), fmt + codec.long_len.format[1:], i, False, codec.max_long, name))
+        elif kind == IDS:
+            slots.append((tuple(fixed), fmt + codec.count.format[1:], i, True, None, name))
+        elif kind in (BYTE, COUNT, ID):
+            fixed.append(i)
+            fmt += {BYTE: "B", COUNT: codec.count.format[1:], ID: codec.msg_id.format[1:]}[kind]
+            continue
+        else:
+            raise ValueError(f"Unknown field kind: {kind}")
+        fixed, fmt = [], ""
+    if len(slots) > MAX_SLOTS:
+        raise ValueError(f"A schema holds at most {MAX_SLOTS} strings or ID lists")
+    return slots, (tuple(fixed), fmt)
+
+def utf8(view):
+    return str(view, 'utf-8')
+
+def fixed_getter(indices):
+    # values -> tuple of the fixed-width fields at indices, or None when there are none
+    if not indices:
+        return None
+    if len(indices) == 1:
+        i = indices[0]
+        return lambda values: (values[i],)
+    return itemgetter(*indices)
+
+def compile_schema(schema, codec):
+    # encode(values, cmd=None, request_id=None), decode(data, offset) and decode_from(data,
+    # offset), which also returns the offset where the payload ended. Each is one straight run
+    # of code specialised to the schema's slots (schema_slots): encode packs each slot's
+    # fixed-width fields and length with one precomputed Struct (the first one merged with the
+    # frame header and request ID) and joins them with the field bytes; decode reads each slot
+    # with one Struct call (or by indexing a lone length byte) and slices out the field. encode
+    # returns the payload alone when cmd is None, otherwise the whole frame
+    slots, (tail_fields, tail_format) = schema_slots(schema, codec)
+    k = len(slots)
+    count = len(schema.names)
+    required = schema.required
+    defaults = schema.defaults
+    header = codec.header.format
+    tagged = header + REQUEST_ID.format[1:]
+    max_payload = codec.max_payload
+    # ID lists go through an array of the ID width, swapped to network order here
+    id_size = codec.msg_id.size
+    id_type = next(code for code in "BHILQ" if array(code).itemsize == id_size)
+    swap = id_size > 1 and sys.byteorder == "little"
+
+    def id_bytes(ids):
+        ids = array(id_type, ids)
+        if swap:
+            ids.byteswap()
+        return ids.tobytes()
+
+    def read_ids(data, offset, n):
+        chunk = data[offset:offset + n * id_size]
+        if len(chunk) != n * id_size:
+            raise IndexError
+        ids = array(id_type)
+        ids.frombytes(chunk)
+        if swap:
+            ids.byteswap()
+        return ids.tolist()
+
+    tail = struct.Struct("!" + tail_format)
+    tail_get = fixed_getter(tail_fields)
+    fixed_size = tail.size + sum(struct.calcsize("!" + slot[1]) for slot in slots)
+
+    if k == 0:
+        framed = struct.Struct(header + tail_format)
+        framed_tagged = struct.Struct(tagged + tail_format)
+
+        def encode(values, cmd=None, request_id=None):
+            if len(values) < count:
+                values = tuple(values) + defaults[len(values) - required:]
+            fields = tail_get(values) if tail_get else ()
+            if cmd is None:
+                return tail.pack(*fields)
+            if request_id is None:
+                return framed.pack(cmd, fixed_size, *fields)
+            return framed_tagged.pack(cmd | REQUEST_ID_FLAG, fixed_size + REQUEST_ID.size, request_id, *fields)
+
+        def decode_from(data, offset=0):
+            try:
+                values = tail.unpack_from(data, offset)
+            except struct.error:
+                raise ValueError('Not enough bytes for payload')
+            return values, offset + tail.size
+
+        return finish(schema, codec, encode, decode_from)
+
+    # Slot 0 comes in three Structs: alone, behind the frame header, and behind header and ID
+    lead0, format0, i0, ids0, limit0, name0 = slots[0]
+    slot0 = struct.Struct("!" + format0)
+    framed0 = struct.Struct(header + format0)
+    tagged0 = struct.Struct(tagged + format0)
+    get0 = fixed_getter(lead0)
+    # A single field in front of the first string (a command or "more" byte, a record's ID) is
+    # common enough to be packed and read without going through get0
+    one0 = len(lead0) == 1
+    first = lead0[0] if one0 else 0
+    # Unused slots get harmless placeholders; k decides which are read
+    lead1, format1, i1, ids1, limit1, name1 = slots[1] if k > 1 else ((), "", 0, False, 0, "")
+    slot1 = struct.Struct("!" + format1)
+    get1 = fixed_getter(lead1)
+    lead2, format2, i2, ids2, limit2, name2 = slots[2] if k > 2 else ((), "", 0, False, 0, "")
+    slot2 = struct.Struct("!" + format2)
+    get2 = fixed_getter(lead2)
+    size0, size1, size2 = slot0.size, slot1.size, slot2.size
+    # Nothing but the strings and ID lists (and at most that single first field): decode
+    # returns them without reassembling
+    plain = not tail_fields and not lead1 and not lead2 and (one0 or not lead0)
+
+    def too_long(name, size):
+        return ValueError(f"String too long for field {name} ({size} bytes).")
+
+    def encode(values, cmd=None, request_id=None):
+        if len(values) < count:
+            values = tuple(values) + defaults[len(values) - required:]
+        x0 = values[i0]
+        if ids0:
+            n0 = len(x0)
+            x0 = id_bytes(x0)
+        else:
+            x0 = x0.encode('utf-8')
+            n0 = len(x0)
+            if n0 > limit0:
+                raise too_long(name0, n0)
+        size = fixed_size + len(x0)
+        if k > 1:
+            x1 = values[i1]
+            if ids1:
+                n1 = len(x1)
+                x1 = id_bytes(x1)
+            else:
+                x1 = x1.encode('utf-8')
+                n1 = len(x1)
+                if n1 > limit1:
+                    raise too_long(name1, n1)
+            size += len(x1)
+            m1 = slot1.pack(*get1(values), n1) if get1 else slot1.pack(n1)
+            if k > 2:
+                x2 = values[i2]
+                if ids2:
+                    n2 = len(x2)
+                    x2 = id_bytes(x2)
+                else:
+                    x2 = x2.encode('utf-8')
+                    n2 = len(x2)
+                    if n2 > limit2:
+                        raise too_long(name2, n2)
+                size += len(x2)
+                m2 = slot2.pack(*get2(values), n2) if get2 else slot2.pack(n2)
+        if cmd is None:
+            if one0:
+                head = slot0.pack(values[first], n0)
+            else:
+                head = slot0.pack(*get0(values), n0) if get0 else slot0.pack(n0)
+        elif request_id is None:
+            if size > max_payload:
+                codec.check_length(size)
+            if one0:
+                head = framed0.pack(cmd, size, values[first], n0)
+            else:
+                head = framed0.pack(cmd, size, *get0(values), n0) if get0 else framed0.pack(cmd, size, n0)
+        else:
+            size += REQUEST_ID.size
+            if size > max_payload:
+                codec.check_length(size)
+            cmd |= REQUEST_ID_FLAG
+            if one0:
+                head = tagged0.pack(cmd, size, request_id, values[first], n0)
+            else:
+                head = tagged0.pack(cmd, size, request_id, *get0(values), n0) if get0 else tagged0.pack(cmd, size, request_id, n0)
+        if k == 1:
+            out = head + x0
+        elif k == 2:
+            out = b"".join((head, x0, m1, x1))
+        else:
+            out = b"".join((head, x0, m1, x1, m2, x2))
+        if tail_get:
+            out += tail.pack(*tail_get(values))
+        return out
+
+    # A length running past the data makes a later read fail (turned into ValueError) or leaves
+    # offset past the end, checked last
+    def decode_from(data, offset=0):
+        # bytes.decode beats str(); payloads read by FrameReader are memoryviews, which lack it
+        text = bytes.decode if data.__class__ is bytes else utf8
+        try:
+            if one0:
+                a0, n0 = slot0.unpack_from(data, offset)
+            elif get0:
+                *lead, n0 = slot0.unpack_from(data, offset)
+            elif size0 == 1:
+                n0 = data[offset]
+            else:
+                n0 = slot0.unpack_from(data, offset)[0]
+            offset += size0
+            if ids0:
+                x0 = read_ids(data, offset, n0)
+                offset += n0 * id_size
+            else:
+                x0 = text(data[offset:offset + n0])
+                offset += n0
+            if k > 1:
+                if get1:
+                    *lead1, n1 = slot1.unpack_from(data, offset)
+                elif size1 == 1:
+                    n1 = data[offset]
+                else:
+                    n1 = slot1.unpack_from(data, offset)[0]
+                offset += size1
+                if ids1:
+                    x1 = read_ids(data, offset, n1)
+                    offset += n1 * id_size
+                else:
+                    x1 = text(data[offset:offset + n1])
+                    offset += n1
+                if k > 2:
+                    if get2:
+                        *lead2, n2 = slot2.unpack_from(data, offset)
+                    elif size2 == 1:
+                        n2 = data[offset]
+                    else:
+                        n2 = slot2.unpack_from(data, offset)[0]
+                    offset += size2
+                    if ids2:
+                        x2 = read_ids(data, offset, n2)
+                        offset += n2 * id_size
+                    else:
+                        x2 = text(data[offset:offset + n2])
+                        offset += n2
+            if tail_get:
+                last = tail.unpack_from(data, offset)
+                offset += tail.size
+        except (IndexError, struct.error):
+            raise ValueError('Not enough bytes for payload')
+        if offset > len(data):
+            raise ValueError('Not enough bytes for payload')
+        if plain:
+            if one0:
+                values = (a0, x0) if k == 1 else (a0, x0, x1) if k == 2 else (a0, x0, x1, x2)
+            else:
+                values = (x0,) if k == 1 else (x0, x1) if k == 2 else (x0, x1, x2)
+        else:
+            values = (a0, x0) if one0 else (*lead, x0) if get0 else (x0,)
+            if k > 1:
+                values += (*lead1, x1) if get1 else (x1,)
+                if k > 2:
+                    values += (*lead2, x2) if get2 else (x2,)
+            if tail_get:
+                values += last
+        return values, offset
+
+    return finish(schema, codec, encode, decode_from)
+
+def finish(schema, codec, encode, decode_from):
+    # The compiled functions, with decode_from accepting payloads that leave out trailing
+    # fields with defaults: the straight decoder expects every field, so when it runs out of
+    # bytes the payload is read again by the schema without the last field, and must end there
+    if schema.defaults:
+        shorter = MessageSchema(*schema.fields[:-1]).compile(codec)[2]
+        default = schema.defaults[-1:]
+        every_field = decode_from
+
+        def decode_from(data, offset=0):
+            try:
+                return every_field(data, offset)
+            except ValueError as e:
+                try:
+                    values, end = shorter(data, offset)
+                except ValueError:
+                    raise e
+                if end != len(data):
+                    raise e
+                return values + default, end
+
+    def decode(data, offset=0):
+        return decode_from(data, offset)[0]
+
+    return encode, decode, decode_from
+
+# Payload layouts of the client requests, by command
+CREDENTIALS = MessageSchema(("username", SHORT), ("password", SHORT))
+USERNAME = MessageSchema(("username", SHORT))
+REQUEST_SCHEMAS = {
+    CMD_HELLO: MessageSchema(("version", BYTE), ("caps", BYTE, 0)),
+    CMD_LOGIN: CREDENTIALS,
+    CMD_CREATE: CREDENTIALS,
+    CMD_LIST: MessageSchema(("wildcard", SHORT, "*")),
+    CMD_SEND: MessageSchema(("sender", SHORT), ("recipient", SHORT), ("message", LONG)),
+    CMD_READ: MessageSchema(("username", SHORT), ("limit", COUNT, 0)),
+    CMD_READ_BULK: MessageSchema(("username", SHORT), ("limit", COUNT, 0)),
+    # The cursor fields are optional: 0 means no bound (see chat_common.history.history_window)
+    CMD_VIEW_CONV: MessageSchema(("username", SHORT), ("other_user", SHORT),
+                                 ("since_id", ID, 0), ("before_id", ID, 0), ("limit", COUNT, 0),
+                                 ("stream", BYTE, 0)),
+    CMD_DELETE_ACC: USERNAME,
+    CMD_LOGOFF: USERNAME,
+    CMD_CLOSE: USERNAME,
+    CMD_READ_ACK: MessageSchema(("marker", SHORT)),
+}
+# CMD_DELETE_MSG has two layouts: unread messages by position, or conversation messages by ID
+DELETE_UNREAD = MessageSchema(("username", SHORT), ("indices", IDS))
+DELETE_CONV = MessageSchema(("username", SHORT), ("other_user", SHORT), ("ids", IDS))
+
+# Reply layouts; the command byte is the one of the request being answered
+STATUS = MessageSchema(("text", SHORT))
+TEXT = MessageSchema(("text", LONG))
+# A CMD_CHAT push, and one unread message in a CMD_READ reply
+CHAT = MessageSchema(("sender", SHORT), ("message", LONG))
+# CMD_HISTORY_CHUNK reply
+HISTORY_CHUNK = MessageSchema(("more", BYTE), ("text", LONG))
+
+def pack_history_chunk(codec, text_bytes, request_id=None):
+    # A non-final CMD_HISTORY_CHUNK frame around already encoded text, as buffers for send_parts
+    if len(text_bytes) > codec.max_long:
+        raise ValueError(f"History chunk too long for protocol v{codec.version} ({len(text_bytes)} bytes).")
+    prefix = bytes([1]) + codec.long_len.pack(len(text_bytes))
+    return codec.encode_parts(CMD_HISTORY_CHUNK, text_bytes, request_id, prefix)
+
+# CMD_READ_BULK reply: a page head, then the records back to back
+READ_PAGE = MessageSchema(("more", BYTE), ("count", COUNT))
+UNREAD_RECORD = MessageSchema(("id", ID), ("sender", SHORT), ("timestamp", SHORT), ("message", LONG))
+# Target size of one CMD_READ_BULK frame; a single larger record still gets a frame of its own
+READ_PAGE_SIZE = 256 << 10
+
+def pack_unread_pages(codec, messages, request_id=None, page_size=READ_PAGE_SIZE):
+    # The CMD_READ_BULK reply for a list of unread message dicts, as one list of buffers per
+    # frame (for send_parts). Records are packed once and each page is joined once, so
+    # thousands of messages take a handful of frames instead of one frame each
+    room = min(page_size, codec.max_payload) - 1 - codec.count.size
+    if request_id is not None:
+        room -= REQUEST_ID.size
+    pages = []
+    records, size = [], 0
+    for message in messages:
+        record = UNREAD_RECORD.pack(codec, (message.get("id", 0), message["sender"],
+                                            message.get("timestamp", ""), message["message"]))
+        if records and size + len(record) > room:
+            pages.append(records)
+            records, size = [], 0
+        records.append(record)
+        size += len(record)
+    pages.append(records)
+    frames = []
+    for i, records in enumerate(pages):
+        head = READ_PAGE.pack(codec, (i < len(pages) - 1, len(records)))
+        frames.append(codec.encode_parts(CMD_READ_BULK, b"".join(records), request_id, head))
+    return frames
+
+def unpack_unread_page(codec, payload):
+    # (more, [(id, sender, timestamp, message), ...]) for one CMD_READ_BULK payload
+    more, count = READ_PAGE.unpack(codec, payload)
+    offset = 1 + codec.count.size
+    records = []
+    for _ in range(count):
+        record, offset = UNREAD_RECORD.unpack_from(codec, payload, offset)
+        records.append(record)
+    return bool(more), records
+
+def unpack_frames(data, codec):
+    # Split a run of complete frames (a CMD_BATCH payload or reply) into (cmd, payload view) pairs
+    view = memoryview(data)
+    frames = []
+    offset = 0
+    while offset < len(view):
+        if len(view) - offset < codec.header.size:
+            raise ValueError("Truncated frame header in batch")
+        cmd, payload_len = codec.header.unpack_from(view, offset)
+        offset += codec.header.size
+        if len(view) - offset < payload_len:
+            raise ValueError("Truncated frame payload in batch")
+        frames.append((cmd, view[offset:offset + payload_len]))
+        offset += payload_len
+    return frames
+
+def split_request_id(cmd, payload):
+    # (cmd, request ID or None, payload without the ID) for a frame as read off the wire
+    if not cmd & REQUEST_ID_FLAG:
+        return cmd, None, payload
+    if len(payload) < REQUEST_ID.size:
+        raise ValueError("Not enough bytes for request ID")
+    return cmd & ~REQUEST_ID_FLAG, REQUEST_ID.unpack_from(payload, 0)[0], payload[REQUEST_ID.size:]
+
+def pack_hello(version=PROTOCOL_VERSION, caps=0):
+    return bytes(REQUEST_SCHEMAS[CMD_HELLO].pack(CODEC_V1, (version, caps)))
+
+def negotiated_caps(hello_payload, supported):
+    # Capability bits both the CMD_HELLO payload and the reader of it agree on
+    return hello_payload[1] & supported if len(hello_payload) > 1 else 0
+
+def negotiated_codec(hello_payload):
+    # The version a CMD_HELLO payload settles on: the requested (or granted) one, capped at ours
+    requested = hello_payload[0] if len(hello_payload) else PROTOCOL_V1
+    return CODECS[max(PROTOCOL_V1, min(requested, PROTOCOL_VERSION))]
+
+def connection_codec(conn):
+    # Connections only carry a codec once they have negotiated; everything else speaks v1
+    return getattr(conn, "codec", CODEC_V1)
+
+class FrameReader:
+    # Buffered reader for a blocking socket. One recv_into pulls in up to READ_SIZE bytes, and
+    # every complete frame in them is returned without another syscall, so a burst of small
+    # frames (e.g. a CMD_READ reply) costs one recv instead of two per frame.
+    # Payloads are memoryviews into the receive buffer. The buffer is never written over once
+    # a frame has been handed out (it is replaced rather than compacted), so a view stays valid
+    # even after later reads; call bytes() on it only if it has to outlive the connection
+    def __init__(self, sock, size=READ_SIZE):
+        self.sock = sock
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first byte not yet returned as part of a frame
+        self.end = 0    # end of received data
+        self.codec = CODEC_V1  # switched by a CMD_HELLO frame
+
+    def fill(self):
+        # Receive once; start a fresh buffer holding just the unparsed tail when out of room
+        if len(self.buf) - self.end < self.size // 4:
+            tail = self.end - self.start
+            need = tail
+            if tail >= self.codec.header.size:
+                # Make room for the whole pending frame at once, so a large v2 frame is not
+                # copied again every READ_SIZE bytes
+                need = max(need, self.codec.header.size + self.codec.header.unpack_from(self.buf, self.start)[1])
+            buf = bytearray(need + self.size)
+            buf[:tail] = self.view[self.start:self.end]
+            self.buf, self.view = buf, memoryview(buf)
+            self.start, self.end = 0, tail
+        n = self.sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def frames(self):
+        # Return every complete (cmd, payload view) frame already buffered
+        frames = []
+        while self.end - self.start >= self.codec.header.size:
+            cmd, payload_len = self.codec.header.unpack_from(self.buf, self.start)
+            self.codec.check_length(payload_len)
+            body = self.start + self.codec.header.size
+            if self.end - body < payload_len:
+                break
+            frames.append(self.take(cmd, body, payload_len))
+        return frames
+
+    def take(self, cmd, body, payload_len):
+        payload = self.view[body:body + payload_len]
+        self.start = body + payload_len
+        if cmd & COMPRESSED_FLAG:
+            cmd &= ~COMPRESSED_FLAG
+            payload = memoryview(decompress(payload, self.codec.max_payload))
+        if cmd == CMD_HELLO:
+            # Frames after a version negotiation use the negotiated header
+            self.codec = negotiated_codec(payload)
+        return cmd, payload
+
+    def read_frame(self):
+        # Drop-in for decode_message(sock): the next frame, receiving only when none is buffered
+        while True:
+            if self.end - self.start >= self.codec.header.size:
+                cmd, payload_len = self.codec.header.unpack_from(self.buf, self.start)
+                self.codec.check_length(payload_len)
+                body = self.start + self.codec.header.size
+                if self.end - body >= payload_len:
+                    return self.take(cmd, body, payload_len)
+            if not self.fill():
+                if self.start == self.end:
+                    raise Exception("Connection closed while reading header.")
+                raise Exception("Connection closed while reading payload.")
+
+    def __iter__(self):
+        # Yield frames until the peer closes the connection
+        while True:
+            for frame in self.frames():
+                yield frame
+            if not self.fill():
+                return
@@ -1,241 +1,795 @@
 import socket
 import struct
-import fnmatch
 import threading
 import datetime
 import hashlib
+import argparse
+import selectors
+import os
+import sys
+import itertools
+from collections import deque
+from concurrent.futures import Future
 
 from protocol_custom import (
     HEADER_SIZE,
     CMD_LOGIN, CMD_CREATE, CMD_SEND, CMD_READ,
     CMD_DELETE_MSG, CMD_VIEW_CONV, CMD_DELETE_ACC, CMD_LOGOFF, CMD_CLOSE,
-    CMD_CHAT, CMD_LIST, CMD_READ_ACK,
-    encode_message, decode_message,
-    pack_short_string, pack_long_string,
-    unpack_short_string, unpack_long_string
+    CMD_CHAT, CMD_LIST, CMD_READ_ACK, CMD_HELLO, CMD_BATCH, CMD_READ_BULK, CMD_HISTORY_CHUNK,
+    REQUEST_ID_FLAG, REQUEST_ID, HISTORY_CHUNK, pack_history_chunk,
+    PROTOCOL_V1, FrameParser, FrameReader, negotiated_codec, connection_codec, pack_unread_pages,
+    split_request_id, unpack_frames, negotiated_caps,
+    REQUEST_SCHEMAS, CREDENTIALS, USERNAME, DELETE_UNREAD, DELETE_CONV, STATUS, TEXT, CHAT,
+    unpack_short_string
 )
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from chat_common.worker_pool import OrderedWorkerPool, ConnectionQueue, DEFAULT_QUEUE_DEPTH, durable_pool_size
+from chat_common.multiproc import run_multiprocess, EVERY_SHARD
+from chat_common.concurrency import StripedLock, user_lock_key
+from chat_common.compression import (CompressionStats, FrameCompressor, SUPPORTED_CAPS, CAP_ZLIB,
+                                     CAP_ZDICT)
+from chat_common.outbound import (QueuedConnection, Backpressure, DEFAULT_HIGH_WATERMARK,
+                                  DEFAULT_LOW_WATERMARK, SLOW_CONSUMER_POLICIES, IOV_MAX,
+                                  advance, send_parts, send_stream, command_result, take_drained)
+from chat_common.wal import DEFAULT_COMMIT_WINDOW
+from chat_common.snapshot import DEFAULT_SNAPSHOT_EVERY
+from chat_common.store import MemoryStore
+from chat_common.sqlite_store import SqliteStore
+from chat_common.segment_store import SegmentStore
+
 CMD_DELETE = CMD_DELETE_ACC 
 
-# Data stores for user info, active connections, and conversation history
-users = {}         
+SERVER_MODES = ("thread", "selectors")
+RECV_SIZE = 65536
+
+# Accounts, conversation histories and unread messages (see chat_common.store and main)
+store = MemoryStore()
+# Active connections, and striped locks keyed by ("user", name) that guard logging in and out
 active_users = {} 
-conversations = {} 
-next_message_id = 1
+locks = StripedLock()
+# Optional OrderedWorkerPool that runs commands off the I/O threads (see main)
+pool = None
+# Slow-consumer policy for live chat pushes (see main)
+backpressure = Backpressure()
+# Ratio and CPU cost of compressing frames for clients that negotiated CAP_ZLIB
+compression_stats = CompressionStats()
+
+# Commands that change what the connection itself is (who receives pushes on it, its framing,
+# whether it stays open) only make sense on their own, not inside a CMD_BATCH
+BATCH_EXCLUDED = (CMD_HELLO, CMD_LOGIN, CMD_CLOSE, CMD_BATCH)
+
+class BatchCollector:
+    # Stands in for the connection while a batch runs: sub-command replies are gathered here
+    # instead of each costing its own sendall
+    def __init__(self, codec):
+        # Sub-replies are framed uncompressed; the envelope carrying them is what gets compressed
+        self.codec = codec.plain
+        self.envelope = codec
+        self.parts = []
+
+    def sendall(self, data):
+        self.parts.append(data)
+
+    def sendmsg(self, buffers):
+        self.parts.extend(buffers)
+
+    def frames(self, request_id=None):
+        # The gathered replies as CMD_BATCH frames, each a list of buffers for send_parts, split
+        # only when they exceed the frame limit. Chunks are views of the joined replies, not copies
+        stream = memoryview(b"".join(self.parts))
+        room = self.envelope.max_payload - 1 - (REQUEST_ID.size if request_id is not None else 0)
+        frames = []
+        offset = 0
+        while True:
+            chunk = stream[offset:offset + room]
+            offset += len(chunk)
+            more = offset < len(stream)
+            frames.append(self.envelope.encode_parts(CMD_BATCH, chunk, request_id, bytes([more])))
+            if not more:
+                return frames
 
 def get_matching_users(wildcard="*"):
     # Return list of usernames matching the given wildcard pattern
-    return fnmatch.filter(list(users.keys()), wildcard)
+    return store.match_users(wildcard)
+
+# A live chat push as buffers, framed for the recipient's connection. Logged-in connections
+# carry the encoder of the protocol they logged in with (see dual_server)
+def chat_push_parts(conn, message_entry):
+    return CHAT.frame_parts(connection_codec(conn), CMD_CHAT, (message_entry["sender"], message_entry["message"]))
+
+# Text bytes per CMD_HISTORY_CHUNK frame of a streamed history (a longer single line gets its own)
+HISTORY_CHUNK_BYTES = 32 << 10
+
+def format_history_line(msg):
+    return f"[ID {msg.get('id', '?')}] [{msg.get('timestamp', '')}] {msg.get('sender', '')}: {msg.get('message', '')}\n"
+
+# The formatted lines of history pages, encoded once and regrouped into chunks of about budget bytes
+def history_text_chunks(pages, budget):
+    chunk, size = [], 0
+    for page in pages:
+        for msg in page:
+            line = format_history_line(msg).encode("utf-8")
+            if chunk and size + len(line) > budget:
+                yield b"".join(chunk)
+                chunk, size = [], 0
+            chunk.append(line)
+            size += len(line)
+    if chunk:
+        yield b"".join(chunk)
+
+# Run one decoded command for a connection. conn only needs sendall(), so the same logic
+# serves blocking sockets and the selectors loop. Returns False once the client asks to close
+def process_command(conn, cmd, payload):
+    # Frame, long-string, count and ID sizes of the protocol version this connection negotiated
+    codec = connection_codec(conn)
+    # Replies to a tagged request carry its request ID so pipelining clients can match them
+    cmd, request_id, payload = split_request_id(cmd, payload)
+    if cmd == CMD_HELLO and request_id is None:
+        # Answer in the current (v1) framing, then switch this connection to the agreed version
+        agreed = negotiated_codec(payload)
+        caps = negotiated_caps(payload, SUPPORTED_CAPS)
+        conn.sendall(REQUEST_SCHEMAS[CMD_HELLO].frame(codec, CMD_HELLO, (agreed.version, caps)))
+        if caps & CAP_ZLIB:
+            compressor = FrameCompressor(use_dictionary=bool(caps & CAP_ZDICT), stats=compression_stats)
+            agreed = agreed.with_compressor(compressor)
+        conn.codec = agreed
+
+    elif cmd == CMD_LOGIN:
+        username, password = CREDENTIALS.unpack(codec, payload)
+        hashed = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        with locks.holding(user_lock_key(username)):
+            stored_hash = store.password_hash(username)
+            if stored_hash is None:
+                resp = "Username does not exist"
+            elif hashed != stored_hash:
+                resp = "Incorrect password"
+            else:
+                conn.chat_push_parts = chat_push_parts
+                active_users[username] = conn
+                unread_count = store.unread_count(username)
+                resp = f"Login successful. Unread messages: {unread_count}"
+        conn.sendall(STATUS.frame(codec, CMD_LOGIN, (resp,), request_id))
+
+    elif cmd == CMD_CREATE:
+        # Extract username and password and create new user if not exists
+        username, password = CREDENTIALS.unpack(codec, payload)
+        hashed = hashlib.sha256(password.encode("utf-8")).hexdigest()
+        resp = "Account created" if store.create_user(username, hashed) else "Username already exists"
+        conn.sendall(STATUS.frame(codec, CMD_CREATE, (resp,), request_id))
+
+    elif cmd == CMD_LIST:
+        wildcard, = REQUEST_SCHEMAS[CMD_LIST].unpack(codec, payload)
+        matching = store.match_users(wildcard)
+        matching_str = ",".join(matching)
+        conn.sendall(TEXT.frame(codec, CMD_LIST, (matching_str,), request_id))
+
+    elif cmd == CMD_SEND:
+        # Get sender, recipient, and message text
+        sender, recipient, msg_text = REQUEST_SCHEMAS[CMD_SEND].unpack(codec, payload)
+        # Record message in conversation history with timestamp and unique ID
+        conv_key = tuple(sorted([sender, recipient]))
+        timestamp = datetime.datetime.now().isoformat()
+        message_entry = store.post(conv_key, sender, msg_text, timestamp)
+        # If recipient exists and is active, deliver message immediately; otherwise, store as unread
+        if not store.has_user(recipient):
+            resp = "Recipient not found"
+        else:
+            recipient_conn = active_users.get(recipient)
+            delivered = False
+            if recipient_conn is not None:
+                # Pushes are framed for the recipient's connection, not the sender's
+                encode_push = getattr(recipient_conn, "chat_push_parts", chat_push_parts)
+                live_msg = encode_push(recipient_conn, message_entry)
+                if backpressure.admit(recipient_conn, sum(len(part) for part in live_msg)):
+                    try:
+                        send_parts(recipient_conn, live_msg)
+                        delivered = True
+                    except Exception:
+                        pass
+                elif backpressure.policy == "disconnect":
+                    # The stalled connection was cut; let the recipient log in again
+                    with locks.holding(user_lock_key(recipient)):
+                        if active_users.get(recipient) is recipient_conn:
+                            del active_users[recipient]
+            if not delivered:
+                store.add_unread(recipient, conv_key, message_entry)
+            resp = "Message sent"
+        conn.sendall(STATUS.frame(codec, CMD_SEND, (resp,), request_id))
+
+    elif cmd == CMD_READ:
+        # Send unread messages to the user, up to an optional limit
+        username, limit = REQUEST_SCHEMAS[CMD_READ].unpack(codec, payload)
+        msgs_to_send = store.take_unread(username, limit)
+        if msgs_to_send is None:
+            resp = "User not found"
+            conn.sendall(TEXT.frame(codec, CMD_READ, (resp,), request_id))
+        else:
+            if not msgs_to_send:
+                conn.sendall(TEXT.frame(codec, CMD_READ, ("NO_MESSAGES",), request_id))
+            else:
+                for message in msgs_to_send:
+                    send_parts(conn, CHAT.frame_parts(codec, CMD_READ, (message["sender"], message["message"]), request_id))
+                conn.sendall(TEXT.frame(codec, CMD_READ, ("END_OF_MESSAGES",), request_id))
+
+    elif cmd == CMD_READ_BULK:
+        # Same as CMD_READ, but every message goes out in a few large frames with its ID and
+        # timestamp, and no END_OF_MESSAGES or acknowledgement round trip
+        username, limit = REQUEST_SCHEMAS[CMD_READ_BULK].unpack(codec, payload)
+        if codec.version == PROTOCOL_V1:
+            conn.sendall(TEXT.frame(codec, CMD_READ, ("Bulk read needs protocol v2",), request_id))
+            return True
+        msgs_to_send = store.take_unread(username, limit)
+        if msgs_to_send is None:
+            conn.sendall(TEXT.frame(codec, CMD_READ, ("User not found",), request_id))
+        else:
+            for frame in pack_unread_pages(codec, msgs_to_send, request_id):
+                send_parts(conn, frame)
+
+    elif cmd == CMD_DELETE_MSG:
+        # Supports deleting from conversation or unread messages
+        try:
+            offset = 0
+            username, offset = unpack_short_string(payload, offset)
+            if len(payload) - offset >= 1:
+                potential_other_len = payload[offset]
+                if potential_other_len != 0 and (len(payload) - offset >= 1 + potential_other_len):
+                    username, other_user, ids_to_delete = DELETE_CONV.unpack(codec, payload)
+                    conv_key = tuple(sorted([username, other_user]))
+                    if store.delete_from_conversation(conv_key, ids_to_delete):
+                        resp = "Specified conversation messages deleted"
+                    else:
+                        resp = "No conversation found"
+                    conn.sendall(STATUS.frame(codec, CMD_DELETE_MSG, (resp,), request_id))
+                    return True
+
+            username, indices = DELETE_UNREAD.unpack(codec, payload)
+            if store.delete_unread_at(username, indices):
+                resp = "Specified messages deleted"
+            else:
+                resp = "User not found"
+            conn.sendall(STATUS.frame(codec, CMD_DELETE_MSG, (resp,), request_id))
+        except Exception as e:
+            print("Error in CMD_DELETE_MSG:", e)
+            resp = "Error processing delete message command"
+            conn.sendall(STATUS.frame(codec, CMD_DELETE_MSG, (resp,), request_id))
+
+    elif cmd == CMD_VIEW_CONV:
+        # Return formatted conversation history between two users, optionally only the part
+        # selected by the since_id / before_id / limit cursor (see history_window)
+        username, other_user, since_id, before_id, limit, stream = REQUEST_SCHEMAS[CMD_VIEW_CONV].unpack(codec, payload)
+        if not store.has_user(other_user):
+            resp = "User not found"
+            conn.sendall(STATUS.frame(codec, CMD_VIEW_CONV, (resp,), request_id))
+        else:
+            conv_key = tuple(sorted([username, other_user]))
+            found = store.has_history(conv_key)
+            conv = [] if stream or not found else store.history(conv_key, since_id, before_id, limit)
+            if not found:
+                resp = "No conversation history found"
+                conn.sendall(TEXT.frame(codec, CMD_VIEW_CONV, (resp,), request_id))
+            elif stream:
+                # Page by page, so the reply never holds more than a few chunks of the history;
+                # it continues on the pool, if there is one, whenever the client catches up
+                pages = store.history_pages(conv_key, since_id, before_id, limit)
+                chunks = (pack_history_chunk(codec, chunk, request_id)
+                          for chunk in history_text_chunks(pages, min(HISTORY_CHUNK_BYTES, codec.max_long)))
+                end = [HISTORY_CHUNK.frame(codec, CMD_HISTORY_CHUNK, (0, ""), request_id)]
+                return send_stream(conn, itertools.chain(chunks, [end]), pool.executor.submit if pool else None)
+            else:
+                formatted = "".join(format_history_line(msg) for msg in conv)
+                try:
+                    reply = TEXT.frame_parts(codec, CMD_VIEW_CONV, (formatted,), request_id)
+                except ValueError:
+                    # Only reachable on v1 (64 KiB frames); v2 clients get the whole history
+                    reply = TEXT.frame_parts(codec, CMD_VIEW_CONV,
+                                             ("Conversation too large for protocol v1; page it with a limit or reconnect with v2",),
+                                             request_id)
+                send_parts(conn, reply)
+
+    elif cmd == CMD_DELETE:
+        # Remove user from records and active users
+        username, = USERNAME.unpack(codec, payload)
+        with locks.holding(user_lock_key(username)):
+            if not store.delete_user(username):
+                resp = "User does not exist"
+            else:
+                active_users.pop(username, None)
+                resp = "Account deleted"
+        conn.sendall(STATUS.frame(codec, CMD_DELETE, (resp,), request_id))
+
+    elif cmd == CMD_LOGOFF:
+        # Log off the user
+        username, = USERNAME.unpack(codec, payload)
+        active_users.pop(username, None)
+        resp = "User logged off"
+        conn.sendall(STATUS.frame(codec, CMD_LOGOFF, (resp,), request_id))
+
+    elif cmd == CMD_BATCH:
+        # Run every sub-command in order; their replies go back together in CMD_BATCH frames
+        collector = BatchCollector(codec)
+        try:
+            sub_frames = unpack_frames(payload, codec)
+        except ValueError as e:
+            print("Error in CMD_BATCH:", e)
+            sub_frames = []
+            collector.sendall(STATUS.frame(collector.codec, 0, ("Malformed batch",)))
+        for sub_cmd, sub_payload in sub_frames:
+            if (sub_cmd & ~REQUEST_ID_FLAG) in BATCH_EXCLUDED:
+                collector.sendall(STATUS.frame(collector.codec, sub_cmd & ~REQUEST_ID_FLAG,
+                                               ("Command not allowed in a batch",)))
+            else:
+                process_command(collector, sub_cmd, sub_payload)
+        for frame in collector.frames(request_id):
+            send_parts(conn, frame)
+
+    elif cmd == CMD_CLOSE:
+        return False
+
+    else:
+        resp = "Unknown command"
+        conn.sendall(STATUS.frame(codec, 0, (resp,), request_id))
+    return True
 
 def handle_client(conn, addr):
-    global next_message_id
     print(f"[NEW CONNECTION] {addr} connected.")
+    # Replies and pushes for this client go through its own outbound queue and writer thread
+    out = QueuedConnection(conn)
+    queue = ConnectionQueue(pool, out) if pool else None
+    reader = FrameReader(conn)
     try:
         while True:
             # Decode the incoming command and its payload from the client
-            cmd, payload = decode_message(conn)
-
-            if cmd == CMD_LOGIN:
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                password, offset = unpack_short_string(payload, offset)
-                if username not in users:
-                    resp = "Username does not exist"
-                else:
-                    stored_hash = users[username]["password_hash"]
-                    hashed = hashlib.sha256(password.encode("utf-8")).hexdigest()
-                    if hashed != stored_hash:
-                        resp = "Incorrect password"
-                    else:
-                        active_users[username] = conn
-                        unread_count = len(users[username]["messages"])
-                        resp = f"Login successful. Unread messages: {unread_count}"
-                conn.sendall(encode_message(CMD_LOGIN, pack_short_string(resp)))
-
-            elif cmd == CMD_CREATE:
-                # Extract username and password and create new user if not exists
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                password, offset = unpack_short_string(payload, offset)
-                if username in users:
-                    resp = "Username already exists"
-                else:
-                    hashed = hashlib.sha256(password.encode("utf-8")).hexdigest()
-                    users[username] = {"password_hash": hashed, "messages": []}
-                    resp = "Account created"
-                conn.sendall(encode_message(CMD_CREATE, pack_short_string(resp)))
-
-            elif cmd == CMD_LIST:
-                offset = 0
-                wildcard = unpack_short_string(payload, offset)[0] if payload else "*"
-                matching = fnmatch.filter(list(users.keys()), wildcard)
-                matching_str = ",".join(matching)
-                conn.sendall(encode_message(CMD_LIST, pack_long_string(matching_str)))
-
-            elif cmd == CMD_SEND:
-                # Get sender, recipient, and message text
-                offset = 0
-                sender, offset = unpack_short_string(payload, offset)
-                recipient, offset = unpack_short_string(payload, offset)
-                msg_text, offset = unpack_long_string(payload, offset)
-                # Record message in conversation history with timestamp and unique ID
-                conv_key = tuple(sorted([sender, recipient]))
-                if conv_key not in conversations:
-                    conversations[conv_key] = []
-                timestamp = datetime.datetime.now().isoformat()
-                message_entry = {"id": next_message_id, "sender": sender, "message": msg_text, "timestamp": timestamp}
-                next_message_id += 1
-                conversations[conv_key].append(message_entry)
-                # If recipient exists and is active, deliver message immediately; otherwise, store as unread
-                if recipient not in users:
-                    resp = "Recipient not found"
-                else:
-                    if recipient in active_users:
-                        try:
-                            live_payload = pack_short_string(sender) + pack_long_string(msg_text)
-                            active_users[recipient].sendall(encode_message(CMD_CHAT, live_payload))
-                        except Exception:
-                            users[recipient]["messages"].append({"sender": sender, "message": msg_text})
-                    else:
-                        users[recipient]["messages"].append({"sender": sender, "message": msg_text})
-                    resp = "Message sent"
-                conn.sendall(encode_message(CMD_SEND, pack_short_string(resp)))
-
-            elif cmd == CMD_READ:
-                # Send unread messages to the user, up to an optional limit
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                limit = struct.unpack_from("!B", payload, offset)[0] if offset < len(payload) else 0
-                if username not in users:
-                    resp = "User not found"
-                    conn.sendall(encode_message(CMD_READ, pack_long_string(resp)))
-                else:
-                    msgs = users[username]["messages"]
-                    msgs_to_send = msgs[:limit] if limit > 0 else msgs
-                    users[username]["messages"] = msgs[limit:] if limit > 0 else []
-                    if not msgs_to_send:
-                        conn.sendall(encode_message(CMD_READ, pack_long_string("NO_MESSAGES")))
-                    else:
-                        for message in msgs_to_send:
-                            one_msg = pack_short_string(message["sender"]) + pack_long_string(message["message"])
-                            conn.sendall(encode_message(CMD_READ, one_msg))
-                        conn.sendall(encode_message(CMD_READ, pack_long_string("END_OF_MESSAGES")))
-
-            elif cmd == CMD_DELETE_MSG:
-                # Supports deleting from conversation or unread messages
-                try:
-                    offset = 0
-                    username, offset = unpack_short_string(payload, offset)
-                    if len(payload) - offset >= 1:
-                        potential_other_len = payload[offset]
-                        if potential_other_len != 0 and (len(payload) - offset >= 1 + potential_other_len):
-                            other_user, offset = unpack_short_string(payload, offset)
-                            if len(payload) - offset < 1:
-                                raise ValueError("Not enough bytes for count")
-                            count = struct.unpack_from("!B", payload, offset)[0]
-                            offset += 1
-                            if len(payload) - offset < count:
-                                raise ValueError("Not enough bytes for message IDs")
-                            ids_to_delete = [struct.unpack_from("!B", payload, offset + i)[0] for i in range(count)]
-                            offset += count
-                            conv_key = tuple(sorted([username, other_user]))
-                            if conv_key not in conversations:
-                                resp = "No conversation found"
-                            else:
-                                conv = conversations[conv_key]
-                                conversations[conv_key] = [msg for msg in conv if msg.get("id") not in ids_to_delete]
-                                resp = "Specified conversation messages deleted"
-                            conn.sendall(encode_message(CMD_DELETE_MSG, pack_short_string(resp)))
-                            continue
-
-                    if len(payload) - offset < 1:
-                        raise ValueError("Not enough bytes for count in unread deletion")
-                    count = struct.unpack_from("!B", payload, offset)[0]
-                    offset += 1
-                    indices = [struct.unpack_from("!B", payload, offset + i)[0] for i in range(count)]
-                    offset += count
-                    if username not in users:
-                        resp = "User not found"
-                    else:
-                        current_msgs = users[username]["messages"]
-                        users[username]["messages"] = [msg for i, msg in enumerate(current_msgs) if i not in indices]
-                        resp = "Specified messages deleted"
-                    conn.sendall(encode_message(CMD_DELETE_MSG, pack_short_string(resp)))
-                except Exception as e:
-                    print("Error in CMD_DELETE_MSG:", e)
-                    resp = "Error processing delete message command"
-                    conn.sendall(encode_message(CMD_DELETE_MSG, pack_short_string(resp)))
-
-            elif cmd == CMD_VIEW_CONV:
-                # Return formatted conversation history between two users
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                other_user, offset = unpack_short_string(payload, offset)
-                if other_user not in users:
-                    resp = "User not found"
-                    conn.sendall(encode_message(CMD_VIEW_CONV, pack_short_string(resp)))
-                else:
-                    conv_key = tuple(sorted([username, other_user]))
-                    conv = conversations.get(conv_key, [])
-                    if not conv:
-                        resp = "No conversation history found"
-                        conn.sendall(encode_message(CMD_VIEW_CONV, pack_long_string(resp)))
-                    else:
-                        formatted = ""
-                        for msg in conv:
-                            formatted += f"[ID {msg.get('id', '?')}] [{msg.get('timestamp', '')}] {msg.get('sender', '')}: {msg.get('message', '')}\n"
-                        conn.sendall(encode_message(CMD_VIEW_CONV, pack_long_string(formatted)))
-
-            elif cmd == CMD_DELETE:
-                # Remove user from records and active users
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                if username not in users:
-                    resp = "User does not exist"
-                else:
-                    del users[username]
-                    if username in active_users:
-                        del active_users[username]
-                    resp = "Account deleted"
-                conn.sendall(encode_message(CMD_DELETE, pack_short_string(resp)))
-
-            elif cmd == CMD_LOGOFF:
-                # Log off the user
-                offset = 0
-                username, offset = unpack_short_string(payload, offset)
-                if username in active_users:
-                    del active_users[username]
-                resp = "User logged off"
-                conn.sendall(encode_message(CMD_LOGOFF, pack_short_string(resp)))
-
-            elif cmd == CMD_CLOSE:
+            cmd, payload = reader.read_frame()
+            if queue is not None:
+                keep_open = queue.submit(process_command, out, cmd, payload)
+            else:
+                keep_open = command_result(process_command(out, cmd, payload))
+            if not keep_open:
                 print(f"[DISCONNECT] {addr} requested close.")
                 break
-
-            else:
-                resp = "Unknown command"
-                conn.sendall(encode_message(0, pack_short_string(resp)))
     except Exception as e:
         print(f"Error handling client {addr}: {e}")
     finally:
-        conn.close()
+        if queue is not None:
+            try:
+                queue.drain()
+            except Exception as e:
+                print(f"Error handling client {addr}: {e}")
+        out.close()
         print(f"Connection closed: {addr}")
 
-def main():
+class SelectorLoop:
+    # Owns the selector. Only the loop thread touches it; pool workers hand work back with
+    # call_soon(), which queues a callback and wakes select() through a socketpair
+    def __init__(self):
+        self.sel = selectors.DefaultSelector()
+        self.thread_id = None
+        self.callbacks = deque()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.sel.register(self.wake_r, selectors.EVENT_READ, self)
+
+    def in_loop(self):
+        return threading.get_ident() == self.thread_id
+
+    def call_soon(self, fn, *args):
+        self.callbacks.append((fn, args))
+        try:
+            self.wake_w.send(b"\0")
+        except BlockingIOError:
+            pass  # the loop already has wakeups pending
+
+    def run_callbacks(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.callbacks:
+            fn, args = self.callbacks.popleft()
+            fn(*args)
+
+    def close(self):
+        self.sel.close()
+        self.wake_r.close()
+        self.wake_w.close()
+
+class BufferedConnection:
+    # Non-blocking connection used by the selectors loop. sendall() writes what the kernel
+    # accepts right away and buffers the rest until the socket becomes writable again.
+    # Called from a pool worker, it only appends to the buffer and lets the loop flush it
+    def __init__(self, sock, addr, loop):
+        self.sock = sock
+        self.addr = addr
+        self.loop = loop
+        self.parser = FrameParser()
+        self.outbuf = bytearray()
+        self.lock = threading.Lock()
+        self.events = 0
+        self.inflight = 0  # commands handed to the worker pool and not finished yet
+        self.paused = False
+        # A streamed reply is paused for this client (no pool); frames read meanwhile wait in held
+        self.streaming = False
+        self.held = []
+        self.closing = False
+        self.closed = False
+        self.throttled = False  # see Backpressure.admit
+        self.drain_waiters = []  # (limit, callback), see when_drained
+
+    def sendall(self, data):
+        with self.lock:
+            if self.closed:
+                raise OSError("Connection already closed.")
+            if not self.loop.in_loop():
+                self.outbuf += data
+                self.loop.call_soon(self.update_events)
+                return
+            if not self.outbuf:
+                try:
+                    sent = self.sock.send(data)
+                except BlockingIOError:
+                    sent = 0
+                data = memoryview(data)[sent:]
+            if data:
+                self.outbuf += data
+        self.update_events()
+
+    def sendmsg(self, buffers):
+        # Scatter-gather version of sendall: only what the kernel doesn't take is copied
+        with self.lock:
+            if self.closed:
+                raise OSError("Connection already closed.")
+            if not self.loop.in_loop():
+                for buf in buffers:
+                    self.outbuf += buf
+                self.loop.call_soon(self.update_events)
+                return
+            views = deque(memoryview(buf).cast("B") for buf in buffers)
+            if not self.outbuf:
+                try:
+                    advance(views, self.sock.sendmsg(list(views)[:IOV_MAX]))
+                except BlockingIOError:
+                    pass
+            for view in views:
+                self.outbuf += view
+        self.update_events()
+
+    def pending_bytes(self):
+        with self.lock:
+            return len(self.outbuf)
+
+    # Call callback() once at most limit bytes are unsent, or the connection is gone: right
+    # away if that is already so, otherwise from the loop thread after a flush
+    def when_drained(self, limit, callback):
+        with self.lock:
+            if len(self.outbuf) > limit and not self.closed:
+                self.drain_waiters.append((limit, callback))
+                return
+        callback()
+
+    # Discard unsent output and close without waiting for the peer to read it
+    def abort(self):
+        if not self.loop.in_loop():
+            self.loop.call_soon(self.abort)
+            return
+        with self.lock:
+            self.outbuf.clear()
+        self.closing = False
+        self.close()
+
+    def update_events(self):
+        # Register for exactly the events we care about; a paused or closing connection is not read
+        if self.closed:
+            return
+        events = 0
+        if not self.closing and not self.paused and not self.streaming:
+            events |= selectors.EVENT_READ
+        if self.outbuf:
+            events |= selectors.EVENT_WRITE
+        if events == self.events:
+            return
+        if self.events == 0:
+            self.loop.sel.register(self.sock, events, self)
+        elif events == 0:
+            self.loop.sel.unregister(self.sock)
+        else:
+            self.loop.sel.modify(self.sock, events, self)
+        self.events = events
+
+    def flush(self):
+        with self.lock:
+            if self.outbuf:
+                try:
+                    sent = self.sock.send(self.outbuf)
+                except BlockingIOError:
+                    return
+                except OSError:
+                    self.outbuf.clear()
+                    sent = 0
+                del self.outbuf[:sent]
+            done = not self.outbuf
+            drained = take_drained(self.drain_waiters, len(self.outbuf))
+        for callback in drained:
+            callback()
+        if done and self.closing:
+            self.close()
+        else:
+            self.update_events()
+
+    def close(self):
+        # Close once everything queued has been written, or right away if nothing is pending
+        if self.closed:
+            return
+        if self.outbuf and not self.closing:
+            self.closing = True
+            self.update_events()
+            return
+        with self.lock:
+            self.closed = True
+            drained = take_drained(self.drain_waiters, 0, gone=True)
+        if self.events:
+            self.loop.sel.unregister(self.sock)
+            self.events = 0
+        self.sock.close()
+        print(f"Connection closed: {self.addr}")
+        for callback in drained:
+            callback()
+
+    def command_done(self, future):
+        # Runs on the loop thread when a pooled command for this connection finishes
+        self.inflight -= 1
+        if self.closed:
+            return
+        try:
+            keep_open = future.result()
+        except Exception as e:
+            print(f"Error handling client {self.addr}: {e}")
+            keep_open = False
+        if keep_open is False:
+            self.close()
+            return
+        if self.paused and self.inflight < pool.queue_depth:
+            self.paused = False
+            self.update_events()
+
+def dispatch_frame(conn, cmd, payload):
+    # Run the command inline, or queue it on the pool behind this connection's earlier commands
+    if pool is None:
+        keep_open = process_command(conn, cmd, payload)
+        if isinstance(keep_open, Future):
+            # Its reply is streaming and waiting for the client to read: stop reading from
+            # this connection until the reply is sent (see stream_done)
+            conn.streaming = True
+            conn.update_events()
+            keep_open.add_done_callback(lambda f: conn.loop.call_soon(stream_done, conn, f))
+            return True
+        if not keep_open:
+            print(f"[DISCONNECT] {conn.addr} requested close.")
+            conn.close()
+            return False
+        return True
+    conn.inflight += 1
+    future = pool.submit(conn, process_command, conn, cmd, payload)
+    future.add_done_callback(lambda f: conn.loop.call_soon(conn.command_done, f))
+    if conn.inflight >= pool.queue_depth and not conn.paused:
+        # Stop reading until the pool catches up with this connection
+        conn.paused = True
+        conn.update_events()
+    return True
+
+def handle_readable(conn):
+    # Read whatever is available and dispatch every complete frame
+    try:
+        data = conn.sock.recv(RECV_SIZE)
+    except BlockingIOError:
+        return
+    except OSError as e:
+        print(f"Error handling client {conn.addr}: {e}")
+        conn.abort()
+        return
+    if not data:
+        # The peer is gone: drop what it will never read (under conn.lock, see abort)
+        conn.abort()
+        return
+    try:
+        dispatch_frames(conn, conn.parser.feed(data))
+    except Exception as e:
+        print(f"Error handling client {conn.addr}: {e}")
+        conn.close()
+
+def dispatch_frames(conn, frames):
+    # Dispatch frames in order; those behind a paused streamed reply are held until it is sent
+    for i, (cmd, payload) in enumerate(frames):
+        if conn.streaming:
+            conn.held.extend(frames[i:])
+            return
+        if not dispatch_frame(conn, cmd, payload):
+            return
+
+def stream_done(conn, future):
+    # Runs on the loop thread once a paused streamed reply (inline mode) has been sent
+    conn.streaming = False
+    if conn.closed:
+        return
+    try:
+        keep_open = future.result()
+    except Exception as e:
+        print(f"Error handling client {conn.addr}: {e}")
+        keep_open = False
+    if keep_open is False:
+        conn.close()
+        return
+    held, conn.held = conn.held, []
+    try:
+        dispatch_frames(conn, held)
+    except Exception as e:
+        print(f"Error handling client {conn.addr}: {e}")
+        conn.close()
+        return
+    conn.update_events()
+
+def serve_selectors(server_sock):
+    # Single-threaded event loop: one selector watches the listening socket and every client
+    loop = SelectorLoop()
+    loop.thread_id = threading.get_ident()
+    server_sock.setblocking(False)
+    loop.sel.register(server_sock, selectors.EVENT_READ, None)
+    try:
+        while True:
+            for key, events in loop.sel.select():
+                if key.data is None:
+                    # Accept every pending connection on the listening socket
+                    while True:
+                        try:
+                            sock, addr = server_sock.accept()
+                        except BlockingIOError:
+                            break
+                        print(f"[NEW CONNECTION] {addr} connected.")
+                        sock.setblocking(False)
+                        BufferedConnection(sock, addr, loop).update_events()
+                    continue
+                if key.data is loop:
+                    loop.run_callbacks()
+                    continue
+                conn = key.data
+                if events & selectors.EVENT_WRITE:
+                    conn.flush()
+                if events & selectors.EVENT_READ and not conn.closed and not conn.closing:
+                    handle_readable(conn)
+    finally:
+        loop.close()
+
+# Multi-process mode: workers forward each frame as its command byte plus payload, and the
+# state owners run process_command on them
+def read_forwarded_frames(sock):
+    try:
+        for cmd, payload in FrameReader(sock):
+            yield bytes([cmd]) + payload
+    except OSError:
+        return
+
+def dispatch_forwarded_frame(conn, request):
+    return process_command(conn, request[0], request[1:])
+
+# Commands whose first field is the user they act for (for CMD_SEND, the one after it)
+SHARD_ROUTED = (CMD_LOGIN, CMD_CREATE, CMD_SEND, CMD_READ, CMD_READ_BULK, CMD_DELETE_MSG,
+                CMD_VIEW_CONV, CMD_DELETE, CMD_LOGOFF)
+
+# With several shards, the user whose shard runs a forwarded frame: the one whose login, pushes
+# or logoff it touches, so a send goes to the recipient's shard, where their connection is
+# registered. CMD_HELLO changes the connection itself and runs on every shard
+def route_forwarded_frame(request):
+    try:
+        cmd, _, payload = split_request_id(request[0], request[1:])
+        if cmd == CMD_HELLO:
+            return EVERY_SHARD
+        if cmd not in SHARD_ROUTED:
+            return None
+        username, offset = unpack_short_string(payload, 0)
+        if cmd == CMD_SEND:
+            username, _ = unpack_short_string(payload, offset)
+        return username
+    except (ValueError, IndexError, struct.error):
+        # Malformed; whichever shard gets it replies with the error
+        return None
+
+def main(mode="thread", port=56789, workers=0, queue_depth=DEFAULT_QUEUE_DEPTH, pool_stats=0, processes=0,
+         high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK, slow_consumer="unread",
+         wal_path=None, commit_window=DEFAULT_COMMIT_WINDOW, snapshot_every=DEFAULT_SNAPSHOT_EVERY, db_path=None,
+         segments_dir=None, shards=1):
+    global pool, backpressure, store
+    if mode not in SERVER_MODES:
+        raise ValueError(f"Unknown server mode: {mode}")
+    # Live pushes to a client with more than high_watermark bytes unsent go to its unread
+    # messages (or get it disconnected) until the backlog drains below low_watermark
+    backpressure = Backpressure(high_watermark, low_watermark, slow_consumer)
+    if db_path:
+        store = SqliteStore(db_path)
+    elif segments_dir:
+        store = SegmentStore(segments_dir, wal_path, commit_window, snapshot_every)
+    elif wal_path:
+        # Rebuild the state from the snapshot and log, then log every change before acknowledging it
+        store = MemoryStore(wal_path, commit_window, snapshot_every)
+    if processes > 0:
+        if shards > 1:
+            if not getattr(store, "shareable", False):
+                raise ValueError("Several shards need a store every process can open (--db)")
+            # Every forked owner opens its own database connections
+            store.close()
+        try:
+            run_multiprocess(port, processes, dispatch_forwarded_frame, read_forwarded_frames,
+                             shards=shards, route=route_forwarded_frame, workers=workers,
+                             queue_depth=queue_depth)
+        except KeyboardInterrupt:
+            print("Server shutting down.")
+        return
+    if mode == "selectors":
+        workers = durable_pool_size(workers, store)
+    if workers > 0:
+        # Commands run on a fixed pool; each connection may have queue_depth of them waiting
+        pool = OrderedWorkerPool(workers, queue_depth)
+        if pool_stats > 0:
+            pool.start_reporter(pool_stats)
     HOST = "0.0.0.0"
-    PORT = 56789
+    PORT = port
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_sock.bind((HOST, PORT))
-    server_sock.listen()
+    server_sock.listen(socket.SOMAXCONN)
     print(f"Server listening on {HOST}:{PORT}")
     try:
-        while True:
-            conn, addr = server_sock.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+        if mode == "selectors":
+            serve_selectors(server_sock)
+        else:
+            while True:
+                conn, addr = server_sock.accept()
+                threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
     except KeyboardInterrupt:
         print("Server shutting down.")
+        print(f"[BACKPRESSURE] {backpressure.stats()}")
+        print(f"[COMPRESSION] {compression_stats.snapshot()}")
+        print(f"[STORE] {store.stats()}")
     finally:
         server_sock.close()
+        store.close()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Binary protocol chat server")
+    parser.add_argument("--port", type=int, default=56789)
+    parser.add_argument("--mode", choices=SERVER_MODES, default="thread",
+                        help="thread: one thread per connection, selectors: single-threaded event loop")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run commands on a fixed pool of this many threads (0 = on the I/O thread, or a default pool when an event loop would wait on --wal/--db/--segments; with --processes, each state owner's pool)")
+    parser.add_argument("--queue-depth", type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help="commands a connection may have waiting for the pool")
+    parser.add_argument("--pool-stats", type=float, default=0,
+                        help="print pool queue-wait statistics every N seconds")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="fork this many SO_REUSEPORT worker processes for client I/O; commands "
+                             "run in the state-owner process(es), see --shards")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="with --processes, run commands in this many owner processes, each owning "
+                             "the live sessions of the users that hash to it (needs --db)")
+    parser.add_argument("--high-watermark", type=int, default=DEFAULT_HIGH_WATERMARK,
+                        help="unsent bytes at which live pushes to a client stop")
+    parser.add_argument("--low-watermark", type=int, default=DEFAULT_LOW_WATERMARK,
+                        help="unsent bytes a throttled client must drain to before pushes resume")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default="unread",
+                        help="unread: keep throttled pushes as unread messages, disconnect: drop the client")
+    parser.add_argument("--wal", default=None,
+                        help="write-ahead log file: replayed at startup, every change is fsynced before it is acknowledged")
+    parser.add_argument("--commit-window", type=float, default=DEFAULT_COMMIT_WINDOW * 1000,
+                        help="milliseconds a log write waits for more records when several writers are queued (group commit)")
+    parser.add_argument("--snapshot-every", type=int, default=DEFAULT_SNAPSHOT_EVERY,
+                        help="log records between background snapshots that let the log be truncated (0 = never)")
+    parser.add_argument("--db", default=None,
+                        help="keep accounts and messages in this SQLite database instead of memory")
+    parser.add_argument("--segments", default=None,
+                        help="keep histories in memory-mapped segment files in this directory (accounts use --wal)")
+    args = parser.parse_args()
+    main(mode=args.mode, port=args.port, workers=args.workers, queue_depth=args.queue_depth,
+         pool_stats=args.pool_stats, processes=args.processes, high_watermark=args.high_watermark,
+         low_watermark=args.low_watermark, slow_consumer=args.slow_consumer,
+         wal_path=args.wal, commit_window=args.commit_window / 1000, snapshot_every=args.snapshot_every,
+         db_path=args.db, segments_dir=args.segments, shards=args.shards)
@@ -6,16 +6,28 @@ import re
 from io import StringIO
 import contextlib
 import struct
+import os
+import sys
+import signal
+import shutil
+import subprocess
+import tempfile
 
+import server_custom
+from client_custom import ChatClient
 from server_custom import main as server_main
 from protocol_custom import (
+    FrameParser, FrameReader,
     CMD_CREATE, CMD_LOGIN, CMD_SEND, CMD_READ, CMD_DELETE_MSG,
     CMD_VIEW_CONV, CMD_DELETE_ACC, CMD_LOGOFF, CMD_CLOSE,
-    CMD_LIST, CMD_READ_ACK,
+    CMD_LIST, CMD_READ_ACK, CMD_HELLO, CMD_CHAT, CMD_BATCH, CMD_READ_BULK, CMD_HISTORY_CHUNK, HISTORY_CHUNK,
+    CODEC_V1, CODEC_V2, PROTOCOL_V1, PROTOCOL_V2, COMPRESSED_FLAG, pack_hello,
+    REQUEST_SCHEMAS, DELETE_CONV, STATUS, split_request_id, pack_unread_pages, unpack_unread_page,
     encode_message, decode_message,
     pack_short_string, pack_long_string,
     unpack_short_string, unpack_long_string
 )
+from chat_common.compression import CAP_ZLIB, CAP_ZDICT, FrameCompressor
 
 HOST = "127.0.0.1"
 PORT = 56789
@@ -146,5 +158,535 @@ class CustomServerTests(unittest.TestCase):
         resp, _ = unpack_short_string(resp_payload, 0)
         self.assertIn("does not exist", resp)
 
+SELECTORS_PORT = 56791
+
+class FrameParserTests(unittest.TestCase):
+    def test_frames_split_across_reads(self):
+        data = encode_message(CMD_LOGIN, pack_short_string("a") + pack_short_string("b")) + encode_message(CMD_LIST, pack_short_string("*"))
+        parser = FrameParser()
+        frames = []
+        for i in range(len(data)):
+            frames.extend(parser.feed(data[i:i + 1]))
+        self.assertEqual(frames, [(CMD_LOGIN, b"\x01a\x01b"), (CMD_LIST, b"\x01*")])
+
+    def test_empty_payload_frame(self):
+        parser = FrameParser()
+        self.assertEqual(parser.feed(encode_message(CMD_CLOSE, b"")), [(CMD_CLOSE, b"")])
+
+class CountingSocket:
+    # Wraps a socket and counts recv_into and sendall calls
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+        self.sends = 0
+
+    def recv_into(self, buf):
+        self.calls += 1
+        return self.sock.recv_into(buf)
+
+    def sendall(self, data):
+        self.sends += 1
+        return self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+class FrameReaderTests(unittest.TestCase):
+    def test_burst_read_with_few_syscalls(self):
+        a, b = socket.socketpair()
+        frames = [encode_message(CMD_READ, pack_short_string(f"user{i}") + pack_long_string("hello " * 10)) for i in range(200)]
+        a.sendall(b"".join(frames))
+        a.close()
+        counted = CountingSocket(b)
+        received = [(cmd, unpack_short_string(payload, 0)[0]) for cmd, payload in FrameReader(counted)]
+        self.assertEqual(received, [(CMD_READ, f"user{i}") for i in range(200)])
+        self.assertLess(counted.calls, 10)
+        b.close()
+
+    def test_payload_views_survive_later_reads(self):
+        a, b = socket.socketpair()
+        reader = FrameReader(b, size=64)
+        a.sendall(encode_message(CMD_SEND, pack_long_string("x" * 40)))
+        cmd, first = reader.read_frame()
+        for i in range(20):
+            a.sendall(encode_message(CMD_SEND, pack_long_string(str(i) * 40)))
+            reader.read_frame()
+        self.assertEqual(unpack_long_string(first, 0)[0], "x" * 40)
+        a.close()
+        with self.assertRaises(Exception):
+            reader.read_frame()
+        b.close()
+
+class SelectorsServerTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server_thread = threading.Thread(target=server_main, kwargs={"mode": "selectors", "port": SELECTORS_PORT}, daemon=True)
+        cls.server_thread.start()
+        time.sleep(0.5)
+
+    def connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((HOST, SELECTORS_PORT))
+        return s
+
+    def test_create_and_login_pipelined(self):
+        s = self.connect()
+        creds = pack_short_string("sel_user1") + pack_short_string("pw")
+        s.sendall(encode_message(CMD_CREATE, creds) + encode_message(CMD_LOGIN, creds))
+        _, payload = decode_message(s)
+        self.assertEqual(unpack_short_string(payload, 0)[0], "Account created")
+        _, payload = decode_message(s)
+        self.assertIn("Login successful", unpack_short_string(payload, 0)[0])
+        s.close()
+
+    def test_live_push(self):
+        receiver = self.connect()
+        sender = self.connect()
+        for sock, name in [(receiver, "sel_receiver"), (sender, "sel_sender")]:
+            creds = pack_short_string(name) + pack_short_string("pw")
+            sock.sendall(encode_message(CMD_CREATE, creds))
+            decode_message(sock)
+            sock.sendall(encode_message(CMD_LOGIN, creds))
+            decode_message(sock)
+        frame = encode_message(CMD_SEND, pack_short_string("sel_sender") + pack_short_string("sel_receiver") + pack_long_string("hello"))
+        # Dribble the frame in two pieces to exercise the partial-header path
+        sender.sendall(frame[:2])
+        time.sleep(0.1)
+        sender.sendall(frame[2:])
+        _, payload = decode_message(sender)
+        self.assertEqual(unpack_short_string(payload, 0)[0], "Message sent")
+        cmd, payload = decode_message(receiver)
+        sender_name, offset = unpack_short_string(payload, 0)
+        self.assertEqual(sender_name, "sel_sender")
+        self.assertEqual(unpack_long_string(payload, offset)[0], "hello")
+        sender.close()
+        receiver.close()
+
+    def test_streamed_history_waits_for_the_reader(self):
+        store = server_custom.store
+        for name in ("sel_stream_alice", "sel_stream_bob"):
+            store.create_user(name, "hash")
+        conv_key = ("sel_stream_alice", "sel_stream_bob")
+        for i in range(40000):
+            store.post(conv_key, "sel_stream_alice", f"{i:05d} " + "x" * 300, "2025-01-01T00:00:00")
+        pages = []
+        history_pages = store.history_pages
+
+        def counted_pages(*args):
+            for page in history_pages(*args):
+                pages.append(len(page))
+                yield page
+        store.history_pages = counted_pages
+        self.addCleanup(delattr, store, "history_pages")
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 << 10)
+        s.connect((HOST, SELECTORS_PORT))
+        view = REQUEST_SCHEMAS[CMD_VIEW_CONV].pack(CODEC_V1, ("sel_stream_bob", "sel_stream_alice", 0, 0, 0, 1))
+        s.sendall(encode_message(CMD_VIEW_CONV, view) + encode_message(CMD_LIST, pack_short_string("sel_stream_*")))
+        time.sleep(0.5)
+        # The client reads nothing, so the loop has stopped producing pages
+        self.assertLess(sum(pages), 40000 // 2)
+        other = self.connect()
+        other.sendall(encode_message(CMD_LIST, pack_short_string("*")))
+        self.assertEqual(decode_message(other)[0], CMD_LIST)
+        other.close()
+        reader = FrameReader(s)
+        text = []
+        while True:
+            cmd, payload = reader.read_frame()
+            self.assertEqual(cmd, CMD_HISTORY_CHUNK)
+            more, chunk = HISTORY_CHUNK.unpack(CODEC_V1, payload)
+            text.append(chunk)
+            if not more:
+                break
+        # The pipelined command is answered after the whole stream
+        self.assertEqual(reader.read_frame()[0], CMD_LIST)
+        self.assertEqual(re.findall(r": (\d{5}) ", "".join(text)), [f"{i:05d}" for i in range(40000)])
+        s.close()
+
+V2_PORT = 56794
+
+class ProtocolV2Tests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server_thread = threading.Thread(target=server_main, kwargs={"port": V2_PORT}, daemon=True)
+        cls.server_thread.start()
+        time.sleep(0.5)
+
+    def connect(self, version=PROTOCOL_V2, caps=0):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((HOST, V2_PORT))
+        self.addCleanup(s.close)
+        reader = FrameReader(s)
+        if version == PROTOCOL_V1:
+            return s, reader
+        s.sendall(encode_message(CMD_HELLO, pack_hello(version, caps)))
+        cmd, payload = reader.read_frame()
+        self.assertEqual((cmd, payload[0]), (CMD_HELLO, PROTOCOL_V2))
+        return s, reader
+
+    def request(self, s, reader, codec, cmd, payload):
+        s.sendall(codec.encode_message(cmd, payload))
+        return reader.read_frame()
+
+    def test_large_message_history_and_wide_ids(self):
+        s, reader = self.connect()
+        for name in ("v2_alice", "v2_bob"):
+            creds = pack_short_string(name) + pack_short_string("pw")
+            self.request(s, reader, CODEC_V2, CMD_CREATE, creds)
+        # Push IDs past what a single byte can carry
+        server_custom.store.message_ids.advance_past(1000)
+        big = "x" * 100000
+        payload = pack_short_string("v2_alice") + pack_short_string("v2_bob") + CODEC_V2.pack_long_string(big)
+        _, resp = self.request(s, reader, CODEC_V2, CMD_SEND, payload)
+        self.assertEqual(unpack_short_string(resp, 0)[0], "Message sent")
+        history = server_custom.store.conversations[("v2_alice", "v2_bob")]
+        msg_id = history[-1]["id"]
+        self.assertGreater(msg_id, 255)
+
+        _, resp = self.request(s, reader, CODEC_V2, CMD_VIEW_CONV, pack_short_string("v2_alice") + pack_short_string("v2_bob"))
+        conv = CODEC_V2.unpack_long_string(resp, 0)[0]
+        self.assertIn(f"[ID {msg_id}]", conv)
+        self.assertIn(big, conv)
+
+        # A v1 client can't receive the history, but gets an answer instead of a dropped connection
+        s1, reader1 = self.connect(PROTOCOL_V1)
+        _, resp = self.request(s1, reader1, CODEC_V1, CMD_VIEW_CONV, pack_short_string("v2_alice") + pack_short_string("v2_bob"))
+        self.assertIn("too large", CODEC_V1.unpack_long_string(resp, 0)[0])
+
+        payload = (pack_short_string("v2_alice") + pack_short_string("v2_bob")
+                   + CODEC_V2.pack_count(1) + CODEC_V2.pack_ids([msg_id]))
+        _, resp = self.request(s, reader, CODEC_V2, CMD_DELETE_MSG, payload)
+        self.assertEqual(unpack_short_string(resp, 0)[0], "Specified conversation messages deleted")
+        self.assertNotIn(msg_id, [m["id"] for m in server_custom.store.conversations[("v2_alice", "v2_bob")]])
+
+    def test_compressed_history(self):
+        s, reader = self.connect(caps=CAP_ZLIB | CAP_ZDICT)
+        for name in ("z_alice", "z_bob"):
+            self.request(s, reader, CODEC_V2, CMD_CREATE, pack_short_string(name) + pack_short_string("pw"))
+        for i in range(50):
+            payload = pack_short_string("z_alice") + pack_short_string("z_bob") + CODEC_V2.pack_long_string(f"hello number {i}")
+            self.request(s, reader, CODEC_V2, CMD_SEND, payload)
+        before = server_custom.compression_stats.snapshot()
+        request = pack_short_string("z_alice") + pack_short_string("z_bob")
+        s.sendall(CODEC_V2.encode_message(CMD_VIEW_CONV, request))
+        header = s.recv(CODEC_V2.header.size, socket.MSG_PEEK)
+        self.assertTrue(header[0] & COMPRESSED_FLAG)
+        cmd, resp = reader.read_frame()
+        self.assertEqual(cmd, CMD_VIEW_CONV)
+        conv = CODEC_V2.unpack_long_string(resp, 0)[0]
+        self.assertIn("z_alice: hello number 49", conv)
+        after = server_custom.compression_stats.snapshot()
+        self.assertEqual(after["frames"], before["frames"] + 1)
+        self.assertLess(after["bytes_out"] - before["bytes_out"], len(resp))
+
+    def test_bulk_read_sends_few_frames(self):
+        s, reader = self.connect()
+        for name in ("bulk_alice", "bulk_bob"):
+            self.request(s, reader, CODEC_V2, CMD_CREATE, pack_short_string(name) + pack_short_string("pw"))
+        payload = pack_short_string("bulk_alice") + pack_short_string("bulk_bob") + CODEC_V2.pack_long_string("first")
+        self.request(s, reader, CODEC_V2, CMD_SEND, payload)
+        first = server_custom.store.users["bulk_bob"]["messages"][0]
+        self.assertIn("timestamp", first)
+        server_custom.store.users["bulk_bob"]["messages"].extend(
+            {"id": 5000 + i, "sender": "bulk_alice", "message": f"message {i} " * 5, "timestamp": first["timestamp"]}
+            for i in range(10000))
+        request = REQUEST_SCHEMAS[CMD_READ_BULK].pack(CODEC_V2, ("bulk_bob",))
+        s.sendall(CODEC_V2.encode_message(CMD_READ_BULK, request, 7))
+        records, frames = [], 0
+        while True:
+            cmd, resp = reader.read_frame()
+            cmd, request_id, resp = split_request_id(cmd, resp)
+            self.assertEqual((cmd, request_id), (CMD_READ_BULK, 7))
+            frames += 1
+            more, page = unpack_unread_page(CODEC_V2, resp)
+            records.extend(page)
+            if not more:
+                break
+        self.assertEqual(len(records), 10001)
+        self.assertLess(frames, 10)
+        self.assertEqual(records[0], (first["id"], "bulk_alice", first["timestamp"], "first"))
+        self.assertEqual(records[-1][0], 5000 + 9999)
+        self.assertEqual(server_custom.store.users["bulk_bob"]["messages"], [])
+
+        # Empty inbox: one frame, no records; a v1 connection is told to upgrade
+        _, resp = self.request(s, reader, CODEC_V2, CMD_READ_BULK, request)
+        self.assertEqual(unpack_unread_page(CODEC_V2, resp), (False, []))
+        s1, reader1 = self.connect(PROTOCOL_V1)
+        cmd, resp = self.request(s1, reader1, CODEC_V1, CMD_READ_BULK, REQUEST_SCHEMAS[CMD_READ_BULK].pack(CODEC_V1, ("bulk_bob",)))
+        self.assertEqual(cmd, CMD_READ)
+        self.assertIn("v2", CODEC_V1.unpack_long_string(resp, 0)[0])
+
+    def test_view_conv_since_id_returns_only_new_messages(self):
+        s, reader = self.connect()
+        for name in ("sync_alice", "sync_bob"):
+            self.request(s, reader, CODEC_V2, CMD_CREATE, pack_short_string(name) + pack_short_string("pw"))
+        for i in range(5):
+            self.request(s, reader, CODEC_V2, CMD_SEND, REQUEST_SCHEMAS[CMD_SEND].pack(CODEC_V2, ("sync_alice", "sync_bob", f"msg {i}")))
+        ids = [m["id"] for m in server_custom.store.conversations[("sync_alice", "sync_bob")]]
+        view = REQUEST_SCHEMAS[CMD_VIEW_CONV]
+        _, resp = self.request(s, reader, CODEC_V2, CMD_VIEW_CONV, view.pack(CODEC_V2, ("sync_alice", "sync_bob", ids[2])))
+        conv = CODEC_V2.unpack_long_string(resp, 0)[0]
+        self.assertEqual(re.findall(r"msg \d", conv), ["msg 3", "msg 4"])
+        _, resp = self.request(s, reader, CODEC_V2, CMD_VIEW_CONV, view.pack(CODEC_V2, ("sync_alice", "sync_bob", 0, ids[2], 1)))
+        self.assertEqual(re.findall(r"msg \d", CODEC_V2.unpack_long_string(resp, 0)[0]), ["msg 1"])
+        # Nothing new: an empty reply rather than "No conversation history found"
+        _, resp = self.request(s, reader, CODEC_V2, CMD_VIEW_CONV, view.pack(CODEC_V2, ("sync_alice", "sync_bob", ids[-1])))
+        self.assertEqual(CODEC_V2.unpack_long_string(resp, 0)[0], "")
+
+    def test_streamed_view_conv_matches_full_reply(self):
+        s, reader = self.connect()
+        for name in ("chunk_alice", "chunk_bob"):
+            self.request(s, reader, CODEC_V2, CMD_CREATE, pack_short_string(name) + pack_short_string("pw"))
+        self.request(s, reader, CODEC_V2, CMD_SEND, REQUEST_SCHEMAS[CMD_SEND].pack(CODEC_V2, ("chunk_alice", "chunk_bob", "first")))
+        history = server_custom.store.conversations[("chunk_alice", "chunk_bob")]
+        stamp = history[0]["timestamp"]
+        history.extend({"id": history[0]["id"] + 1 + i, "sender": "chunk_bob", "message": f"line {i} " * 20, "timestamp": stamp}
+                       for i in range(3000))
+        view = REQUEST_SCHEMAS[CMD_VIEW_CONV]
+        _, resp = self.request(s, reader, CODEC_V2, CMD_VIEW_CONV, view.pack(CODEC_V2, ("chunk_alice", "chunk_bob")))
+        full = CODEC_V2.unpack_long_string(resp, 0)[0]
+        s.sendall(CODEC_V2.encode_message(CMD_VIEW_CONV, view.pack(CODEC_V2, ("chunk_alice", "chunk_bob", 0, 0, 0, 1))))
+        chunks = []
+        while True:
+            cmd, resp = reader.read_frame()
+            self.assertEqual(cmd, CMD_HISTORY_CHUNK)
+            more, text = HISTORY_CHUNK.unpack(CODEC_V2, resp)
+            self.assertLessEqual(len(text), server_custom.HISTORY_CHUNK_BYTES)
+            chunks.append(text)
+            if not more:
+                break
+        self.assertGreater(len(chunks), 10)
+        self.assertEqual("".join(chunks), full)
+
+    def test_push_uses_recipient_framing(self):
+        sender, sender_reader = self.connect(PROTOCOL_V1)
+        receiver, receiver_reader = self.connect(PROTOCOL_V2)
+        for s, reader, codec, name in ((sender, sender_reader, CODEC_V1, "v2_carol"), (receiver, receiver_reader, CODEC_V2, "v2_dave")):
+            creds = pack_short_string(name) + pack_short_string("pw")
+            self.request(s, reader, codec, CMD_CREATE, creds)
+        self.request(receiver, receiver_reader, CODEC_V2, CMD_LOGIN, pack_short_string("v2_dave") + pack_short_string("pw"))
+        payload = pack_short_string("v2_carol") + pack_short_string("v2_dave") + CODEC_V1.pack_long_string("hi")
+        self.request(sender, sender_reader, CODEC_V1, CMD_SEND, payload)
+        cmd, push = receiver_reader.read_frame()
+        self.assertEqual(cmd, CMD_CHAT)
+        sender_name, offset = unpack_short_string(push, 0)
+        self.assertEqual((sender_name, CODEC_V2.unpack_long_string(push, offset)[0]), ("v2_carol", "hi"))
+
+    def test_frame_parser_switches_after_hello(self):
+        parser = FrameParser()
+        data = encode_message(CMD_HELLO, pack_hello(PROTOCOL_V2)) + CODEC_V2.encode_message(CMD_LIST, pack_short_string("*"))
+        self.assertEqual(parser.feed(data), [(CMD_HELLO, pack_hello(PROTOCOL_V2)), (CMD_LIST, b"\x01*")])
+
+class SchemaTests(unittest.TestCase):
+    def test_frames_match_hand_built_encoding(self):
+        send = REQUEST_SCHEMAS[CMD_SEND]
+        values = ("alice", "bob", "héllo " * 1000)
+        for codec in (CODEC_V1, CODEC_V2):
+            payload = pack_short_string("alice") + pack_short_string("bob") + codec.pack_long_string(values[2])
+            self.assertEqual(bytes(send.frame(codec, CMD_SEND, values)), codec.encode_message(CMD_SEND, payload))
+            self.assertEqual(bytes(send.frame(codec, CMD_SEND, values, 42)), codec.encode_message(CMD_SEND, payload, 42))
+            self.assertEqual(send.unpack(codec, payload), values)
+            # The scatter-gather buffers carry exactly the same bytes
+            compressed = codec.with_compressor(FrameCompressor())
+            for c in (codec, compressed):
+                for request_id in (None, 42):
+                    parts = send.frame_parts(c, CMD_SEND, values, request_id)
+                    self.assertGreater(len(parts), 1)
+                    self.assertEqual(b"".join(parts), bytes(send.frame(c, CMD_SEND, values, request_id)))
+        ids = [1, 2, 1 << 40]
+        payload = DELETE_CONV.pack(CODEC_V2, ("alice", "bob", ids))
+        self.assertEqual(bytes(payload), pack_short_string("alice") + pack_short_string("bob")
+                         + CODEC_V2.pack_count(3) + CODEC_V2.pack_ids(ids))
+        self.assertEqual(DELETE_CONV.unpack(CODEC_V2, payload), ("alice", "bob", ids))
+
+    def test_unread_pages_round_trip(self):
+        messages = [{"id": i, "sender": "s", "message": "m" * 100, "timestamp": "t"} for i in range(50)]
+        frames = pack_unread_pages(CODEC_V2, messages, page_size=1000)
+        self.assertGreater(len(frames), 1)
+        records = []
+        for i, parts in enumerate(frames):
+            frame = b"".join(parts)
+            cmd, payload_len = CODEC_V2.header.unpack_from(frame)
+            self.assertEqual((cmd, payload_len), (CMD_READ_BULK, len(frame) - CODEC_V2.header.size))
+            more, page = unpack_unread_page(CODEC_V2, frame[CODEC_V2.header.size:])
+            self.assertEqual(more, i < len(frames) - 1)
+            records.extend(page)
+        self.assertEqual(records, [(i, "s", "t", "m" * 100) for i in range(50)])
+
+    def test_defaults_and_limits(self):
+        self.assertEqual(REQUEST_SCHEMAS[CMD_LIST].unpack(CODEC_V1, b""), ("*",))
+        self.assertEqual(REQUEST_SCHEMAS[CMD_READ].unpack(CODEC_V2, pack_short_string("bob")), ("bob", 0))
+        self.assertEqual(bytes(REQUEST_SCHEMAS[CMD_READ].pack(CODEC_V1, ("bob",))), pack_short_string("bob") + b"\x00")
+        with self.assertRaises(ValueError):
+            STATUS.pack(CODEC_V1, ("x" * 256,))
+        with self.assertRaises(ValueError):
+            REQUEST_SCHEMAS[CMD_SEND].frame(CODEC_V1, CMD_SEND, ("a", "b", "x" * 65530))
+        for truncated in (b"", pack_short_string("alice")[:-1], pack_short_string("alice") + pack_short_string("bob") + b"\x00\x09abc"):
+            with self.assertRaises(ValueError):
+                REQUEST_SCHEMAS[CMD_SEND].unpack(CODEC_V1, truncated)
+
+class PipelineTests(unittest.TestCase):
+    # Uses the v2 server started by ProtocolV2Tests' port; start our own if run alone
+    @classmethod
+    def setUpClass(cls):
+        try:
+            socket.create_connection((HOST, V2_PORT)).close()
+        except OSError:
+            threading.Thread(target=server_main, kwargs={"port": V2_PORT}, daemon=True).start()
+            time.sleep(0.5)
+
+    def client(self, name):
+        client = ChatClient(HOST, V2_PORT)
+        self.addCleanup(client.sock.close)
+        with contextlib.redirect_stdout(StringIO()):
+            client.create_account(name, "pw")
+            client.login(name, "pw")
+        return client
+
+    def test_pipelined_sends_match_replies(self):
+        sender = self.client("pipe_sender")
+        receiver = self.client("pipe_receiver")
+        sender.sock = CountingSocket(sender.sock)
+        replies = sender.send_messages("pipe_receiver", [f"m{i}" for i in range(1000)])
+        self.assertEqual(replies, ["Message sent"] * 1000)
+        # All 1000 requests left in a single write
+        self.assertEqual(sender.sock.sends, 1)
+
+        # The receiver's pushes arrive untagged ahead of its own reply and are set aside
+        with contextlib.redirect_stdout(StringIO()):
+            receiver.list_accounts("pipe_*")
+        self.assertEqual(len(receiver.pushes), 1000)
+        self.assertTrue(all(cmd == CMD_CHAT for cmd, _ in receiver.pushes))
+
+    def test_out_of_order_wait(self):
+        client = self.client("pipe_waiter")
+        first = client.submit(CMD_LIST, pack_short_string("pipe_w*"))
+        second = client.submit(CMD_LIST, pack_short_string("nobody*"))
+        cmd, data = client.wait_reply(second)
+        self.assertEqual((cmd, client.codec.unpack_long_string(data, 0)[0]), (CMD_LIST, ""))
+        cmd, data = client.wait_reply(first)
+        self.assertEqual(client.codec.unpack_long_string(data, 0)[0], "pipe_waiter")
+
+    def test_account_commands_set_pushes_aside(self):
+        sender = self.client("push_sender")
+        receiver = self.client("push_receiver")
+        with contextlib.redirect_stdout(StringIO()) as out:
+            for command in (lambda: receiver.delete_messages([]),
+                            lambda: receiver.view_conversation("push_sender"),
+                            lambda: receiver.view_conversation("push_sender", stream=True),
+                            receiver.log_off,
+                            lambda: receiver.login("push_receiver", "pw")):
+                # A push is waiting ahead of each reply (once logged off, the message is kept unread)
+                sender.send_message("push_receiver", "ping")
+                command()
+        self.assertEqual(len(receiver.pushes), 4)
+        self.assertTrue(all(cmd == CMD_CHAT for cmd, _ in receiver.pushes))
+        self.assertIn("log off response User logged off", out.getvalue().splitlines())
+        self.assertEqual(receiver.username, "push_receiver")
+
+class BatchTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        PipelineTests.setUpClass()
+
+    def client(self, name, version=PROTOCOL_V2):
+        client = ChatClient(HOST, V2_PORT, version=version)
+        self.addCleanup(client.sock.close)
+        with contextlib.redirect_stdout(StringIO()):
+            client.create_account(name, "pw")
+            client.login(name, "pw")
+        return client
+
+    def test_batch_sends_to_many_recipients(self):
+        sender = self.client("batch_sender")
+        for name in ("batch_a", "batch_b"):
+            self.client(name).sock.close()
+        sender.sock = CountingSocket(sender.sock)
+        replies = sender.send_batch([("batch_a", "one"), ("batch_b", "two"), ("batch_nobody", "three")])
+        self.assertEqual(replies, ["Message sent", "Message sent", "Recipient not found"])
+        self.assertEqual(sender.sock.sends, 1)
+        self.assertEqual([m["message"] for m in server_custom.store.users["batch_b"]["messages"]], ["two"])
+
+    def test_batch_reply_spanning_frames_and_excluded_commands(self):
+        # v1 caps a frame at 64 KiB; a batch whose replies are larger spans several CMD_BATCH frames
+        client = self.client("batch_v1", version=PROTOCOL_V1)
+        text = "y" * 2000
+        commands = [(CMD_SEND, pack_short_string("batch_v1") + pack_short_string("batch_v1_inbox") + pack_long_string(text))
+                    for _ in range(40)]
+        with contextlib.redirect_stdout(StringIO()):
+            client.create_account("batch_v1_inbox", "pw")
+        client.batch(commands)
+        replies = client.batch([(CMD_READ, pack_short_string("batch_v1_inbox") + CODEC_V1.pack_count(0)),
+                                (CMD_LOGIN, pack_short_string("batch_v1") + pack_short_string("pw"))])
+        reads = [CODEC_V1.unpack_long_string(data, unpack_short_string(data, 0)[1])[0] for cmd, data in replies[:40]]
+        self.assertEqual(reads, [text] * 40)
+        self.assertEqual(CODEC_V1.unpack_long_string(replies[40][1], 0)[0], "END_OF_MESSAGES")
+        self.assertEqual(replies[41][0], CMD_LOGIN)
+        self.assertEqual(unpack_short_string(replies[41][1], 0)[0], "Command not allowed in a batch")
+
+SHARDED_PORT = 56797
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork"), "needs SO_REUSEPORT and fork")
+class ShardedServerTests(unittest.TestCase):
+    # Two worker processes and three owner processes sharing a SQLite database
+    @classmethod
+    def setUpClass(cls):
+        cls.db_dir = tempfile.mkdtemp()
+        server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server_custom.py")
+        cls.proc = subprocess.Popen([sys.executable, server_path, "--processes", "2", "--shards", "3",
+                                     "--db", os.path.join(cls.db_dir, "chat.db"), "--port", str(SHARDED_PORT)],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proc.send_signal(signal.SIGINT)
+        cls.proc.wait(timeout=5)
+        shutil.rmtree(cls.db_dir, ignore_errors=True)
+
+    def connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((HOST, SHARDED_PORT))
+        self.addCleanup(s.close)
+        reader = FrameReader(s)
+        s.sendall(encode_message(CMD_HELLO, pack_hello(PROTOCOL_V2)))
+        cmd, payload = reader.read_frame()
+        self.assertEqual((cmd, payload[0]), (CMD_HELLO, PROTOCOL_V2))
+        return s, reader
+
+    def request(self, s, reader, cmd, payload):
+        s.sendall(CODEC_V2.encode_message(cmd, payload))
+        return reader.read_frame()
+
+    def test_v2_pushes_and_replies_across_shards(self):
+        # Users hash to different shards, so the v2 framing must hold on each of them
+        names = [f"shard_user{i}" for i in range(6)]
+        sender, sender_reader = self.connect()
+        receivers = []
+        for name in names:
+            creds = pack_short_string(name) + pack_short_string("pw")
+            self.request(sender, sender_reader, CMD_CREATE, creds)
+            s, reader = self.connect()
+            cmd, payload = self.request(s, reader, CMD_LOGIN, creds)
+            self.assertIn("Login successful", unpack_short_string(payload, 0)[0])
+            receivers.append((s, reader))
+        # Pipelined sends to every shard still come back in order
+        sends = b"".join(CODEC_V2.encode_message(CMD_SEND, pack_short_string(names[0]) + pack_short_string(name)
+                                                 + CODEC_V2.pack_long_string(f"hi {name}"))
+                         for name in names[1:])
+        sender.sendall(sends + CODEC_V2.encode_message(CMD_LIST, pack_short_string("shard_user*")))
+        for _ in names[1:]:
+            cmd, payload = sender_reader.read_frame()
+            self.assertEqual((cmd, unpack_short_string(payload, 0)[0]), (CMD_SEND, "Message sent"))
+        cmd, payload = sender_reader.read_frame()
+        self.assertEqual(CMD_LIST, cmd)
+        self.assertEqual(sorted(CODEC_V2.unpack_long_string(payload, 0)[0].split(",")), names)
+        for name, (s, reader) in zip(names[1:], receivers[1:]):
+            cmd, push = reader.read_frame()
+            self.assertEqual(cmd, CMD_CHAT)
+            sender_name, offset = unpack_short_string(push, 0)
+            self.assertEqual((sender_name, CODEC_V2.unpack_long_string(push, offset)[0]), (names[0], f"hi {name}"))
+
 if __name__ == "__main__":
     unittest.main()
@@ -6,6 +6,11 @@ import sys
 import os
 import datetime
 
+from framing import LineFramer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from chat_common.compression import SUPPORTED_CAPS, CAP_NESTED, cap_names, expand_json_body
+
 MSGLEN = 409600  # Maximum message length for socket communication
 
 # Print error messages to stderr
@@ -26,13 +31,22 @@ def create_msg(cmd, src="", to="", body="", extra_fields=None):
     return (json.dumps(msg) + "\n").encode()
 
 class ChatClient:
-    def __init__(self, server_host, server_port):
+    # compress=True offers zlib compression in a hello as soon as the socket is connected;
+    # the server then sends large read and view_conv bodies compressed. nested=True asks for
+    # those bodies as nested JSON arrays instead of JSON strings
+    def __init__(self, server_host, server_port, compress=False, nested=False):
         self.server_host = server_host
         self.server_port = server_port
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((server_host, server_port))
         self.username = None
         self.login_err = False  # Flag to track login errors
+        self.history_chunks = []  # messages of a streamed view_conv received so far
+        offered = [cap_names(SUPPORTED_CAPS)] if compress else []
+        if nested:
+            offered.append(CAP_NESTED)
+        if offered:
+            self.sock.sendall(create_msg("hello", body=",".join(offered)))
 
     # Send a login request with username and password
     def login(self, username, password):
@@ -71,8 +85,12 @@ class ChatClient:
         self.sock.sendall(create_msg("delete_msg", src=self.username, body=indices_str))
 
     # Request to view the conversation with a specific user
-    def view_conversation(self, other_user):
-        self.sock.sendall(create_msg("view_conv", src=self.username, to=other_user))
+    def view_conversation(self, other_user, since_id=0, before_id=0, limit=0, stream=False):
+        # Cursor fields are only sent when set; since_id fetches just the messages after it.
+        # stream=True has the history sent in chunks, reassembled by handle_message
+        cursor = {key: value for key, value in (("since_id", since_id), ("before_id", before_id),
+                                                ("limit", limit), ("stream", stream)) if value}
+        self.sock.sendall(create_msg("view_conv", src=self.username, to=other_user, extra_fields=cursor))
 
     # Request deletion of the current account
     def delete_account(self):
@@ -146,31 +164,29 @@ def handle_user():
                 client.log_off()
             elif choice == "7":
                 other_user = input("Enter the username to view conversation with: ")
-                client.view_conversation(other_user)
+                client.view_conversation(other_user, stream=True)
             else:
                 print("Invalid command. Please try again.")
 
 # Function to handle incoming messages from the server
 def handle_message():
-    buffer = ""
+    framer = LineFramer()
     while True:
         try:
-            data = client.sock.recv(MSGLEN).decode()
+            n = framer.recv_into(client.sock)
         except Exception as e:
             eprint("Error receiving data:", e)
             break
-        if not data:
+        if not n:
             break
-        buffer += data
 
         # Process each complete JSON message (delimited by newline)
-        while "\n" in buffer:
-            msg_str, buffer = buffer.split("\n", 1)
+        for msg_str in framer.lines():
             if not msg_str:
                 continue
             try:
-                msg = json.loads(msg_str)
-            except json.JSONDecodeError:
+                msg = expand_json_body(json.loads(msg_str))
+            except (json.JSONDecodeError, ValueError):
                 eprint("Received invalid JSON")
                 continue
 
@@ -186,7 +202,9 @@ def handle_message():
             # Handle read messages response
             elif cmd == "read":
                 try:
-                    parsed = json.loads(msg.get("body", ""))
+                    parsed = msg.get("body", "")
+                    if isinstance(parsed, str):
+                        parsed = json.loads(parsed)
                     if isinstance(parsed, list):
                         display_text = "Unread Messages:\n"
                         for m in parsed:
@@ -236,7 +254,15 @@ def handle_message():
             # Handle view conversation response
             elif cmd == "view_conv":
                 try:
-                    conv = json.loads(msg.get("body", ""))
+                    conv = msg.get("body", "")
+                    if isinstance(conv, str):
+                        conv = json.loads(conv)
+                    # Chunks of a streamed history are collected until the final marker
+                    if "more" in msg:
+                        client.history_chunks.extend(conv)
+                        if msg["more"]:
+                            continue
+                        conv, client.history_chunks = client.history_chunks, []
                     display_text = "Conversation:\n"
                     for m in conv:
                         display_text += f"[ID {m['id']}] {m['sender']} ({m['timestamp']}): {m['message']}\n"
@@ -246,6 +272,9 @@ def handle_message():
             # Handle logoff response
             elif cmd == "logoff":
                 print(msg.get("body", "Logged off"))
+            # The server's answer to our hello needs no output
+            elif cmd == "hello":
+                pass
             else:
                 print("Received:", msg)
     client.sock.close()
@@ -254,7 +283,7 @@ if __name__ == '__main__':
     # Default host and port values
     PORT = 12345
     HOST = "127.0.0.1"
-    client = ChatClient(HOST, PORT)
+    client = ChatClient(HOST, PORT, compress=True, nested=True)
 
     # Start threads for handling user input and incoming messages concurrently
     threading.Thread(target=handle_user, daemon=True).start()
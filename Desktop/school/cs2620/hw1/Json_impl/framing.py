@@ -0,0 +1,59 @@
+RECV_CHUNK = 65536
+
+# Splits the newline-delimited JSON stream into lines. Data is received straight into one
+# growing bytearray with recv_into; the newline search resumes where the previous one stopped,
+# and each complete line is decoded exactly once, so a UTF-8 character split across two recv
+# calls arrives intact. Only the unfinished tail is ever moved, when the buffer needs room
+class LineFramer:
+    def __init__(self, chunk=RECV_CHUNK):
+        self.chunk = chunk
+        self.buf = bytearray(chunk)
+        self.start = 0  # first byte of the line being assembled
+        self.end = 0    # end of received data
+        self.scan = 0   # where the next newline search begins
+
+    # Receive once from sock into the free space; returns the byte count (0 on EOF)
+    def recv_into(self, sock):
+        if len(self.buf) - self.end < self.chunk:
+            self.make_room()
+        with memoryview(self.buf) as view:
+            n = sock.recv_into(view[self.end:])
+        self.end += n
+        return n
+
+    def make_room(self):
+        # Slide the unfinished line to the front, then grow if a single line still doesn't fit
+        if self.start:
+            tail = self.end - self.start
+            self.buf[:tail] = self.buf[self.start:self.end]
+            self.scan -= self.start
+            self.start, self.end = 0, tail
+        if len(self.buf) - self.end < self.chunk:
+            self.buf.extend(bytes(self.end + self.chunk - len(self.buf)))
+
+    # Yield every complete line received so far as raw bytes, without the newline
+    def raw_lines(self):
+        while True:
+            nl = self.buf.find(b"\n", self.scan, self.end)
+            if nl < 0:
+                self.scan = self.end
+                break
+            line = bytes(self.buf[self.start:nl])
+            self.start = self.scan = nl + 1
+            yield line
+        if self.start == self.end:
+            self.start = self.end = self.scan = 0
+
+    # Same as raw_lines, decoded straight from the buffer
+    def lines(self):
+        while True:
+            nl = self.buf.find(b"\n", self.scan, self.end)
+            if nl < 0:
+                self.scan = self.end
+                break
+            with memoryview(self.buf) as view:
+                line = str(view[self.start:nl], "utf-8", "replace")
+            self.start = self.scan = nl + 1
+            yield line
+        if self.start == self.end:
+            self.start = self.end = self.scan = 0
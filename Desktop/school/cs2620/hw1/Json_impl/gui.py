@@ -6,6 +6,12 @@ import json
 import time
 import datetime
 import sys
+import os
+
+from framing import LineFramer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from chat_common.compression import SUPPORTED_CAPS, CAP_NESTED, cap_names, expand_json_body
 
 PORT = 12345
 MSGLEN = 409600
@@ -24,8 +30,8 @@ def create_msg(cmd, src="", to="", body="", extra_fields=None):
 
 def parse_msg(raw_msg):
     try:
-        return json.loads(raw_msg)
-    except json.JSONDecodeError:
+        return expand_json_body(json.loads(raw_msg))
+    except (json.JSONDecodeError, ValueError):
         return None
 
 # Chat Client Class
@@ -37,6 +43,8 @@ class ChatClient:
         self.sock.connect((server_host, server_port))
         self.username = None
         self.running = True
+        # Ask for large history replies to be sent compressed, and for message lists as nested JSON
+        self.send_message({"cmd": "hello", "from": "", "to": "", "body": f"{cap_names(SUPPORTED_CAPS)},{CAP_NESTED}"})
 
     def send_message(self, msg):
         self.sock.sendall((json.dumps(msg) + "\n").encode())
@@ -46,18 +54,16 @@ class ChatClient:
         self.sock.close()
 
     def receive_loop(self, callback):
-        buffer = ""
+        framer = LineFramer()
         while self.running:
             try:
-                data = self.sock.recv(MSGLEN).decode()
+                n = framer.recv_into(self.sock)
             except Exception as e:
                 print("Error receiving data:", e, file=sys.stderr)
                 break
-            if not data:
+            if not n:
                 break
-            buffer += data
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
+            for line in framer.lines():
                 if line:
                     msg = parse_msg(line)
                     if msg:
@@ -305,6 +311,8 @@ class ChatGUI:
     def handle_message(self, msg):
         cmd = msg.get("cmd", "")
         body = msg.get("body", "")
+        if cmd == "hello":
+            return
         if cmd == "list":
             self.append_text("Matching accounts:\n" + body)
             # Update user list from comma-separated body.
@@ -337,7 +345,7 @@ class ChatGUI:
                 messagebox.showinfo("Account Created", body)
         elif cmd == "read":
             try:
-                messages = json.loads(body)
+                messages = body if isinstance(body, list) else json.loads(body)
                 display_text = "Unread Messages:\n"
                 for m in messages:
                     # Try to get the message id from 'id'; if not available, use 'index'
@@ -349,7 +357,7 @@ class ChatGUI:
         elif cmd == "chat":
             try:
 
-                messages = json.loads(body)
+                messages = body if isinstance(body, list) else json.loads(body)
                 if isinstance(messages, list) and messages:
 
                     m = messages[0]
@@ -371,6 +379,8 @@ class ChatGUI:
         elif cmd == "delete_msg":
             self.append_text(body)
         elif cmd == "view_conv":
+            if isinstance(body, list):
+                body = "".join(f"[ID {m['id']}] {m['sender']} ({m['timestamp']}): {m['message']}\n" for m in body)
             self.append_text("Conversation:\n" + body)
         elif cmd == "delete":
             self.append_text(body)
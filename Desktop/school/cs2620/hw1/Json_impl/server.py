@@ -1,16 +1,141 @@
 import socket
 import json
-import fnmatch
 import threading
 import hashlib
 import datetime
-from collections import OrderedDict
+import asyncio
+import argparse
+import os
+import sys
+import itertools
+from collections import deque
+from concurrent.futures import Future
+
+from framing import LineFramer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from chat_common.worker_pool import OrderedWorkerPool, ConnectionQueue, DEFAULT_QUEUE_DEPTH, durable_pool_size
+from chat_common.multiproc import run_multiprocess, EVERY_SHARD
+from chat_common.concurrency import StripedLock, user_lock_key
+from chat_common.outbound import (QueuedConnection, Backpressure, DEFAULT_HIGH_WATERMARK,
+                                  DEFAULT_LOW_WATERMARK, SLOW_CONSUMER_POLICIES, send_parts, send_stream,
+                                  command_result)
+from chat_common.compression import (CompressionStats, FrameCompressor, SUPPORTED_CAPS, CAP_ZLIB,
+                                     CAP_ZDICT, CAP_NESTED, cap_bits, cap_names, compress_json_body)
+from chat_common.wal import DEFAULT_COMMIT_WINDOW
+from chat_common.snapshot import DEFAULT_SNAPSHOT_EVERY
+from chat_common.store import MemoryStore
+from chat_common.sqlite_store import SqliteStore
+from chat_common.segment_store import SegmentStore
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+SERVER_MODES = ("thread", "asyncio")
+
+# Adapts an asyncio StreamWriter to the send() interface the command handlers use on sockets.
+# Writes are buffered by the transport, so a push to another user never blocks the event loop.
+# Handlers running on pool workers hand their writes back to the loop thread
+class AsyncConnection:
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.lock = threading.Lock()
+        self.scheduled = 0  # bytes handed over by other threads and not yet written
+        self.throttled = False  # see Backpressure.admit
+
+    def send(self, data):
+        if threading.get_ident() == self.loop_thread:
+            self.writer.write(data)
+        else:
+            with self.lock:
+                self.scheduled += len(data)
+            self.loop.call_soon_threadsafe(self.write_scheduled, data)
+        return len(data)
+
+    def write_scheduled(self, data):
+        with self.lock:
+            self.scheduled -= len(data)
+        if not self.writer.is_closing():
+            self.writer.write(data)
+
+    # Buffers of one message; writelines lets the transport hand them to the kernel together
+    def sendmsg(self, buffers):
+        if threading.get_ident() == self.loop_thread:
+            self.writer.writelines(buffers)
+            return
+        size = sum(len(buf) for buf in buffers)
+        with self.lock:
+            self.scheduled += size
+        self.loop.call_soon_threadsafe(self.write_scheduled_parts, buffers, size)
+
+    def write_scheduled_parts(self, buffers, size):
+        with self.lock:
+            self.scheduled -= size
+        if not self.writer.is_closing():
+            self.writer.writelines(buffers)
+
+    # Bytes waiting in the transport plus writes still on their way to the loop
+    def pending_bytes(self):
+        with self.lock:
+            return self.scheduled + self.writer.transport.get_write_buffer_size()
+
+    @property
+    def closed(self):
+        return self.writer.is_closing()
+
+    # Call callback() on the loop thread once at most limit bytes are unsent, or the
+    # connection is gone; a streamed reply (send_stream) pauses on this instead of blocking
+    def when_drained(self, limit, callback):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.when_drained, limit, callback)
+        elif self.pending_bytes() <= limit or self.writer.is_closing():
+            callback()
+        else:
+            self.loop.create_task(self.drained(limit, callback))
+
+    async def drained(self, limit, callback):
+        # drain() returns once the transport is down to its low-water mark
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.when_drained(limit, callback)
+
+    def abort(self):
+        if threading.get_ident() == self.loop_thread:
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    def close(self):
+        self.writer.close()
+
+# Raise the soft open-file limit to the hard limit so one process can hold many idle sockets
+def raise_fd_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
 
 class ChatServer:
     MSGLEN = 409600
 
-    # Create a JSON message, add a newline delimiter, and encode to bytes
-    def create_msg(self, cmd, src="", to="", body="", err=False):
+    # Create a JSON message, add a newline delimiter, and encode to bytes. With a compressor
+    # (negotiated by the connection's hello) a large body is sent zlib-compressed in "zbody"
+    def create_msg(self, cmd, src="", to="", body="", err=False, compressor=None, extra_fields=None):
+        return b"".join(self.create_msg_parts(cmd, src, to, body, err, compressor, extra_fields))
+
+    # The same message as buffers for send_parts: the delimiter is a separate buffer, so a
+    # large encoded body is never copied again just to append the newline
+    def create_msg_parts(self, cmd, src="", to="", body="", err=False, compressor=None, extra_fields=None):
         msg = {
             "cmd": cmd,
             "from": src,
@@ -18,23 +143,75 @@ class ChatServer:
             "body": body,
             "error": err
         }
-        return (json.dumps(msg) + "\n").encode()
+        if extra_fields:
+            msg.update(extra_fields)
+        if compressor is not None:
+            compress_json_body(msg, compressor)
+        return [json.dumps(msg).encode(), b"\n"]
+
+    # A live chat push as buffers. Logged-in connections carry the encoder of the protocol they
+    # logged in with, so a push crosses protocols when both servers share state (see dual_server)
+    def chat_push_parts(self, conn, message_entry):
+        return self.create_msg_parts("chat", src=message_entry["sender"],
+                                     body=self.list_body(conn, self.history_entries([message_entry])))
 
-    def __init__(self, host='localhost', port=12345):
+    # A list of message entries as a reply body: nested as is for connections that negotiated
+    # CAP_NESTED, otherwise the indented JSON string older clients decode a second time
+    def list_body(self, conn, entries):
+        if getattr(conn, "nested", False):
+            return entries
+        return json.dumps(entries, indent=2)
+
+    # The fields of history entries a view_conv reply shows
+    def history_entries(self, conversation):
+        return [{"id": msg_entry["id"], "sender": msg_entry["sender"],
+                 "message": msg_entry["message"], "timestamp": msg_entry["timestamp"]}
+                for msg_entry in conversation]
+
+    # workers > 0 moves command execution onto a fixed-size pool; each connection may have
+    # at most queue_depth commands waiting before its reader stops pulling new ones.
+    # bind=False skips the listening socket (the multi-process state owner never accepts clients).
+    # Live pushes to a client with more than high_watermark bytes still unsent are handled by
+    # slow_consumer ("unread" or "disconnect") until its backlog drains below low_watermark.
+    # Accounts and messages live in store (see chat_common.store), by default a MemoryStore; with
+    # wal_path it is restored from that write-ahead log (and its latest snapshot) at startup and
+    # logs every change before the reply, sharing each fsync among the changes that queued up
+    # meanwhile (see WriteAheadLog for commit_window), with a background snapshot every
+    # snapshot_every records. In asyncio mode a store that waits on the disk always gets a worker
+    # pool, so the loop never blocks on an fsync
+    def __init__(self, host='localhost', port=12345, mode="thread", workers=0, queue_depth=DEFAULT_QUEUE_DEPTH,
+                 bind=True, high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK,
+                 slow_consumer="unread", wal_path=None, commit_window=DEFAULT_COMMIT_WINDOW,
+                 snapshot_every=DEFAULT_SNAPSHOT_EVERY, store=None):
+        if mode not in SERVER_MODES:
+            raise ValueError(f"Unknown server mode: {mode}")
+        self.mode = mode
+        if store is None:
+            store = MemoryStore(wal_path, commit_window, snapshot_every)
+        self.store = store
+        if mode == "asyncio":
+            workers = durable_pool_size(workers, store)
+        self.pool = OrderedWorkerPool(workers, queue_depth) if workers > 0 else None
+        self.backpressure = Backpressure(high_watermark, low_watermark, slow_consumer)
+        self.compression_stats = CompressionStats()
         self.host = socket.gethostbyname(socket.gethostname())
         self.port = port
-        # Maps usernames to their data (password hash and unread messages)
-        self.users = OrderedDict()     
         # Maps usernames to their active connection objects
         self.active_users = {}         
-        # Maps a sorted tuple of two usernames to a list of message entries (conversation history)
-        self.conversations = {}        
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.bind(('0.0.0.0', port))
+        self.server = None
+        if bind:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.bind(('0.0.0.0', port))
         self.running = True
-        self.next_msg_id = 1  # Global counter for assigning unique message IDs
+        # Striped locks keyed by ("user", name) guard logging in and out (active_users)
+        self.locks = StripedLock()
+        self.loop = None
+        self.aio_server = None
 
     def start(self):
+        if self.mode == "asyncio":
+            self.start_async()
+            return
         # Start listening for incoming client connections
         self.server.listen()
         print(f"[LISTENING] Server is listening on {self.host}:{self.port}")
@@ -43,241 +220,423 @@ class ChatServer:
             thread = threading.Thread(target=self.handle_client, args=(conn, addr))
             thread.start()
 
+    # Serve every connection from a single event loop instead of one thread per client
+    def start_async(self):
+        raise_fd_limit()
+        try:
+            asyncio.run(self.serve_async())
+        except asyncio.CancelledError:
+            pass
+
+    async def serve_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.server.listen(socket.SOMAXCONN)
+        self.server.setblocking(False)
+        self.aio_server = await asyncio.start_server(
+            self.handle_client_async, sock=self.server, limit=ChatServer.MSGLEN)
+        print(f"[LISTENING] Server (asyncio) is listening on {self.host}:{self.port}")
+        async with self.aio_server:
+            await self.aio_server.serve_forever()
+
     def stop(self):
         self.running = False
-        self.server.close()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+        if self.loop is not None and self.aio_server is not None:
+            self.loop.call_soon_threadsafe(self.aio_server.close)
+        elif self.server is not None:
+            self.server.close()
+        self.store.close()
 
-    def read_messages(self, conn):
-        buffer = ""
+    # Yield each newline-delimited request as a str (raw=True: as bytes) until the client goes away
+    def read_messages(self, conn, raw=False):
+        framer = LineFramer()
         while True:
             try:
-                data = conn.recv(ChatServer.MSGLEN).decode()
+                n = framer.recv_into(conn)
             except Exception as e:
                 print("Error reading from connection:", e)
                 break
-            if not data:
+            if not n:
                 break
-            buffer += data
-            while "\n" in buffer:
-                line, buffer = buffer.split("\n", 1)
-                yield line
+            yield from (framer.raw_lines() if raw else framer.lines())
         return
 
     # Hash a password using SHA256
     def hash_password(self, password):
         return hashlib.sha256(password.encode()).hexdigest()
 
+    # Parse one newline-delimited JSON request and run it; returns False once the client asks to close
+    def handle_line(self, conn, raw_msg):
+        if not raw_msg:
+            return True
+        try:
+            parts = json.loads(raw_msg)
+        except json.JSONDecodeError:
+            conn.send(self.create_msg("error", body="Invalid JSON", err=True))
+            return True
+        return self.handle_command(conn, parts)
+
+    # Run a single parsed command. conn is anything with a send(bytes) method, so the same
+    # logic serves plain sockets and asyncio stream writers
+    def handle_command(self, conn, parts):
+        cmd = parts.get("cmd")
+        username = parts.get("from")
+
+        # Agree on optional features; the body lists the capabilities the client supports
+        # and the reply lists the ones this connection will use from now on
+        if cmd == "hello":
+            offered = parts.get("body", "")
+            if not isinstance(offered, str):
+                conn.send(self.create_msg(cmd, body="Capabilities must be a comma-separated string", err=True))
+                return True
+            caps = cap_bits(offered) & SUPPORTED_CAPS
+            if caps & CAP_ZLIB:
+                conn.compressor = FrameCompressor(use_dictionary=bool(caps & CAP_ZDICT),
+                                                  stats=self.compression_stats)
+            else:
+                conn.compressor = None
+            conn.nested = CAP_NESTED in {name.strip() for name in offered.split(",")}
+            agreed = cap_names(caps)
+            if conn.nested:
+                agreed = f"{agreed},{CAP_NESTED}" if agreed else CAP_NESTED
+            conn.send(self.create_msg(cmd, body=agreed))
+
+        # Ceck credentials and add user to active_users if valid
+        elif cmd == "login":
+            password = parts.get("password", "")
+            with self.locks.holding(user_lock_key(username)):
+                stored_hash = self.store.password_hash(username)
+                if stored_hash is None:
+                    resp = self.create_msg(cmd, body="Username does not exist", err=True)
+                else:
+                    if stored_hash != self.hash_password(password):
+                        resp = self.create_msg(cmd, body="Incorrect password", err=True)
+                    elif username in self.active_users:
+                        resp = self.create_msg(cmd, body="Already logged in elsewhere", err=True)
+                    else:
+                        conn.chat_push_parts = self.chat_push_parts
+                        self.active_users[username] = conn
+                        unread_count = self.store.unread_count(username)
+                        resp = self.create_msg(cmd, body=f"Login successful. Unread messages: {unread_count}", to=username)
+            conn.send(resp)
+
+        # Register a new account if the username is not already taken
+        elif cmd == "create":
+            password = parts.get("password", "")
+            if self.store.create_user(username, self.hash_password(password)):
+                conn.send(self.create_msg(cmd, body="Account created", to=username))
+            else:
+                conn.send(self.create_msg(cmd, body="Username already exists", err=True))
+
+        # Ccomma-separated list of usernames matching the wildcard
+        elif cmd == "list":
+            wildcard = parts.get("body", "*")
+            matching_users = self.store.match_users(wildcard)
+            matching_str = ",".join(matching_users)
+            conn.send(self.create_msg(cmd, body=matching_str))
+
+        # Send a message from one user to another and record it in conversation history
+        elif cmd == "send":
+            recipient = parts.get("to")
+            message = parts.get("body")
+            timestamp = datetime.datetime.now().isoformat()
+            conv_key = tuple(sorted([username, recipient]))
+            message_entry = self.store.post(conv_key, username, message, timestamp)
+
+            if not self.store.has_user(recipient):
+                conn.send(self.create_msg(cmd, body="Recipient not found", err=True))
+            else:
+                recipient_conn = self.active_users.get(recipient)
+                delivered = False
+                if recipient_conn is not None:
+                    # Immediately push the message if the recipient is online and keeping up
+                    encode_push = getattr(recipient_conn, "chat_push_parts", self.chat_push_parts)
+                    chat_msg = encode_push(recipient_conn, message_entry)
+                    if self.backpressure.admit(recipient_conn, sum(len(part) for part in chat_msg)):
+                        try:
+                            send_parts(recipient_conn, chat_msg)
+                            delivered = True
+                        except Exception as e:
+                            print(f"Error sending to active user {recipient}: {e}")
+                    elif self.backpressure.policy == "disconnect":
+                        # The stalled connection was cut; let the recipient log in again
+                        with self.locks.holding(user_lock_key(recipient)):
+                            if self.active_users.get(recipient) is recipient_conn:
+                                del self.active_users[recipient]
+                if not delivered:
+                    self.store.add_unread(recipient, conv_key, message_entry)
+                conn.send(self.create_msg(cmd, body="Message sent"))
+
+        # Return unread messages for a user, optionally limited by a count
+        elif cmd == "read":
+            limit = None
+            body_field = parts.get("body", "")
+            if body_field:
+                try:
+                    limit = int(body_field)
+                except ValueError:
+                    limit = None
+            messages_to_view = self.store.take_unread(username, limit)
+            if messages_to_view is None:
+                conn.send(self.create_msg(cmd, body="User not found", err=True))
+            else:
+                msgs_with_index = []
+                for msg_entry in messages_to_view:
+                    msgs_with_index.append({
+                        "id": msg_entry["id"],
+                        "sender": msg_entry["sender"],
+                        "message": msg_entry["message"]
+                    })
+                composite_body = self.list_body(conn, msgs_with_index)
+                send_parts(conn, self.create_msg_parts(cmd, body=composite_body,
+                                                       compressor=getattr(conn, "compressor", None)))
+
+        # Delete messages by their IDs from unread and conversation histories
+        elif cmd == "delete_msg":
+            if not self.store.has_user(username):
+                conn.send(self.create_msg(cmd, body="User not found", err=True))
+            else:
+                raw_ids = parts.get("body", "")
+                if not raw_ids.strip():
+                    conn.send(self.create_msg(cmd, body="No message ID provided", err=True))
+                    return True
+                try:
+                    ids_to_delete = [int(x.strip()) for x in raw_ids.split(",") if x.strip().isdigit()]
+                except Exception as e:
+                    conn.send(self.create_msg(cmd, body="Invalid message IDs", err=True))
+                    return True
+                if not ids_to_delete:
+                    conn.send(self.create_msg(cmd, body="No valid message IDs provided", err=True))
+                    return True
+
+                if not self.store.delete_messages(username, ids_to_delete):
+                    conn.send(self.create_msg(cmd, body="No matching message found to delete", err=True))
+                    return True
+                conn.send(self.create_msg(cmd, body="Specified messages deleted"))
+
+        # Show the full conversation history between two users
+        # Optional "since_id", "before_id" and "limit" fields select part of the history
+        # (see history_window), so a client that already has it only fetches what's new.
+        # With "stream": true the history comes as view_conv chunks of at most HISTORY_PAGE_SIZE
+        # messages marked "more": true, ended by one with "more": false and an empty list
+        elif cmd == "view_conv":
+            other_user = parts.get("to", "")
+            try:
+                since_id = int(parts.get("since_id") or 0)
+                before_id = int(parts.get("before_id") or 0)
+                limit = int(parts.get("limit") or 0)
+            except (TypeError, ValueError):
+                conn.send(self.create_msg(cmd, body="Invalid history cursor", err=True))
+                return True
+            if not self.store.has_user(other_user):
+                conn.send(self.create_msg(cmd, body="User not found", err=True))
+            else:
+                conv_key = tuple(sorted([username, other_user]))
+                stream = bool(parts.get("stream"))
+                found = self.store.has_history(conv_key)
+                conversation = [] if stream or not found else self.store.history(conv_key, since_id, before_id, limit)
+                # Mark unread messages from the other user as read
+                self.store.mark_read_from(username, other_user)
+                compressor = getattr(conn, "compressor", None)
+                if not found:
+                    conn.send(self.create_msg(cmd, body="No conversation history found"))
+                elif stream:
+                    pages = self.store.history_pages(conv_key, since_id, before_id, limit)
+                    chunks = (self.create_msg_parts(cmd, to=other_user, compressor=compressor,
+                                                    body=self.list_body(conn, self.history_entries(page)),
+                                                    extra_fields={"more": True})
+                              for page in pages)
+                    end = [self.create_msg(cmd, to=other_user, body=self.list_body(conn, []), extra_fields={"more": False})]
+                    # Continues on the pool, if there is one, whenever the client catches up
+                    run = self.pool.executor.submit if self.pool is not None else None
+                    return send_stream(conn, itertools.chain(chunks, [end]), run)
+                else:
+                    conv_str = self.list_body(conn, self.history_entries(conversation))
+                    send_parts(conn, self.create_msg_parts(cmd, to=other_user, body=conv_str, compressor=compressor))
+
+        # Delete a user account 
+        elif cmd == "delete":
+            with self.locks.holding(user_lock_key(username)):
+                existed = self.store.delete_user(username)
+                if existed:
+                    self.active_users.pop(username, None)
+            if not existed:
+                conn.send(self.create_msg(cmd, body="User does not exist", err=True))
+            else:
+                conn.send(self.create_msg(cmd, body="Account deleted"))
+
+        elif cmd == "logoff":
+            self.active_users.pop(username, None)
+            conn.send(self.create_msg(cmd, body="User logged off"))
+
+        # Disconnect the client
+        elif cmd == "close":
+            return False
+        else:
+            conn.send(self.create_msg("error", body="Unknown command", err=True))
+        return True
+
     # Main function to handle a connected client
     def handle_client(self, conn, addr):
         print(f"[NEW CONNECTION] {addr} connected.")
+        # Replies and pushes for this client go through its own outbound queue and writer thread
+        out = QueuedConnection(conn)
+        queue = ConnectionQueue(self.pool, out) if self.pool else None
         try:
             for raw_msg in self.read_messages(conn):
-                if not raw_msg:
-                    continue
-                try:
-                    parts = json.loads(raw_msg)
-                except json.JSONDecodeError:
-                    conn.send(self.create_msg("error", body="Invalid JSON", err=True))
-                    continue
-
-                cmd = parts.get("cmd")
-                username = parts.get("from")
-
-                # Ceck credentials and add user to active_users if valid
-                if cmd == "login":
-                    password = parts.get("password", "")
-                    if username not in self.users:
-                        conn.send(self.create_msg(cmd, body="Username does not exist", err=True))
-                    else:
-                        stored_hash = self.users[username]["password_hash"]
-                        if stored_hash != self.hash_password(password):
-                            conn.send(self.create_msg(cmd, body="Incorrect password", err=True))
-                        elif username in self.active_users:
-                            conn.send(self.create_msg(cmd, body="Already logged in elsewhere", err=True))
-                        else:
-                            self.active_users[username] = conn
-                            unread_count = len(self.users[username]["messages"])
-                            conn.send(self.create_msg(cmd, body=f"Login successful. Unread messages: {unread_count}", to=username))
-
-                # Register a new account if the username is not already taken
-                elif cmd == "create":
-                    password = parts.get("password", "")
-                    if username in self.users:
-                        conn.send(self.create_msg(cmd, body="Username already exists", err=True))
-                    else:
-                        self.users[username] = {"password_hash": self.hash_password(password), "messages": []}
-                        conn.send(self.create_msg(cmd, body="Account created", to=username))
-
-                # Ccomma-separated list of usernames matching the wildcard
-                elif cmd == "list":
-                    wildcard = parts.get("body", "*")
-                    matching_users = fnmatch.filter(list(self.users.keys()), wildcard)
-                    matching_str = ",".join(matching_users)
-                    conn.send(self.create_msg(cmd, body=matching_str))
-
-                # Send a message from one user to another and record it in conversation history
-                elif cmd == "send":
-                    recipient = parts.get("to")
-                    message = parts.get("body")
-                    timestamp = datetime.datetime.now().isoformat()
-                    conv_key = tuple(sorted([username, recipient]))
-                    if conv_key not in self.conversations:
-                        self.conversations[conv_key] = []
-                    msg_id = self.next_msg_id
-                    self.next_msg_id += 1
-                    message_entry = {
-                        "id": msg_id,
-                        "sender": username,
-                        "message": message,
-                        "timestamp": timestamp
-                    }
-                    self.conversations[conv_key].append(message_entry)
-
-                    if recipient not in self.users:
-                        conn.send(self.create_msg(cmd, body="Recipient not found", err=True))
-                    else:
-                        if recipient in self.active_users:
-                            try:
-                                # Immediately push the message if the recipient is online
-                                payload = json.dumps([message_entry])
-                                self.active_users[recipient].send(self.create_msg("chat", src=username, body=payload))
-                            except Exception as e:
-                                print(f"Error sending to active user {recipient}: {e}")
-                                self.users[recipient]["messages"].append(message_entry)
-                        else:
-                            self.users[recipient]["messages"].append(message_entry)
-                        conn.send(self.create_msg(cmd, body="Message sent"))
-
-                # Return unread messages for a user, optionally limited by a count
-                elif cmd == "read":
-                    if username not in self.users:
-                        conn.send(self.create_msg(cmd, body="User not found", err=True))
-                    else:
-                        limit = None
-                        body_field = parts.get("body", "")
-                        if body_field:
-                            try:
-                                limit = int(body_field)
-                            except ValueError:
-                                limit = None
-                        user_messages = self.users[username]["messages"]
-                        if limit is not None and limit > 0:
-                            messages_to_view = user_messages[:limit]
-                            self.users[username]["messages"] = user_messages[limit:]
-                        else:
-                            messages_to_view = user_messages
-                            self.users[username]["messages"] = []
-                        msgs_with_index = []
-                        for msg_entry in messages_to_view:
-                            msgs_with_index.append({
-                                "id": msg_entry["id"],
-                                "sender": msg_entry["sender"],
-                                "message": msg_entry["message"]
-                            })
-                        composite_body = json.dumps(msgs_with_index, indent=2)
-                        conn.send(self.create_msg(cmd, body=composite_body))
-
-                # Delete messages by their IDs from unread and conversation histories
-                elif cmd == "delete_msg":
-                    if username not in self.users:
-                        conn.send(self.create_msg(cmd, body="User not found", err=True))
-                    else:
-                        raw_ids = parts.get("body", "")
-                        if not raw_ids.strip():
-                            conn.send(self.create_msg(cmd, body="No message ID provided", err=True))
-                            continue
-                        try:
-                            ids_to_delete = [int(x.strip()) for x in raw_ids.split(",") if x.strip().isdigit()]
-                        except Exception as e:
-                            conn.send(self.create_msg(cmd, body="Invalid message IDs", err=True))
-                            continue
-                        if not ids_to_delete:
-                            conn.send(self.create_msg(cmd, body="No valid message IDs provided", err=True))
-                            continue
-
-                        message_exists = False
-                        for msg in self.users[username]["messages"]:
-                            if msg["id"] in ids_to_delete:
-                                message_exists = True
-                                break
-                        if not message_exists:
-                            for conv_key in self.conversations:
-                                if username in conv_key:
-                                    for msg in self.conversations[conv_key]:
-                                        if msg["id"] in ids_to_delete:
-                                            message_exists = True
-                                            break
-                                    if message_exists:
-                                        break
-                        if not message_exists:
-                            conn.send(self.create_msg(cmd, body="No matching message found to delete", err=True))
-                            continue
-
-                        current_unread = self.users[username]["messages"]
-                        self.users[username]["messages"] = [msg for msg in current_unread if msg["id"] not in ids_to_delete]
-                        for conv_key in self.conversations:
-                            if username in conv_key:
-                                conv = self.conversations[conv_key]
-                                self.conversations[conv_key] = [msg for msg in conv if msg["id"] not in ids_to_delete]
-                        conn.send(self.create_msg(cmd, body="Specified messages deleted"))
-
-                # Show the full conversation history between two users
-                elif cmd == "view_conv":
-                    other_user = parts.get("to", "")
-                    if other_user not in self.users:
-                        conn.send(self.create_msg(cmd, body="User not found", err=True))
-                    else:
-                        conv_key = tuple(sorted([username, other_user]))
-                        conversation = self.conversations.get(conv_key, [])
-                        # Mark unread messages from the other user as read
-                        if username in self.users:
-                            current_unread = self.users[username]["messages"]
-                            self.users[username]["messages"] = [msg for msg in current_unread if msg["sender"] != other_user]
-                        if not conversation:
-                            conn.send(self.create_msg(cmd, body="No conversation history found"))
-                        else:
-                            conv_with_index = []
-                            for msg_entry in conversation:
-                                conv_with_index.append({
-                                    "id": msg_entry["id"],
-                                    "sender": msg_entry["sender"],
-                                    "message": msg_entry["message"],
-                                    "timestamp": msg_entry["timestamp"]
-                                })
-                            conv_str = json.dumps(conv_with_index, indent=2)
-                            conn.send(self.create_msg(cmd, to=other_user, body=conv_str))
-
-                # Delete a user account 
-                elif cmd == "delete":
-                    if username not in self.users:
-                        conn.send(self.create_msg(cmd, body="User does not exist", err=True))
-                    else:
-                        del self.users[username]
-                        if username in self.active_users:
-                            del self.active_users[username]
-                        conn.send(self.create_msg(cmd, body="Account deleted"))
-
-                elif cmd == "logoff":
-                    if username in self.active_users:
-                        del self.active_users[username]
-                    conn.send(self.create_msg(cmd, body="User logged off"))
-
-                # Disconnect the client
-                elif cmd == "close":
+                if queue is not None:
+                    keep_open = queue.submit(self.handle_line, out, raw_msg)
+                else:
+                    keep_open = command_result(self.handle_line(out, raw_msg))
+                if not keep_open:
                     print(f"[DISCONNECT] {addr} disconnected.")
                     break
+        except Exception as e:
+            print(f"[ERROR] Exception handling client {addr}: {e}")
+        finally:
+            if queue is not None:
+                try:
+                    queue.drain()
+                except Exception as e:
+                    print(f"[ERROR] Exception handling client {addr}: {e}")
+            out.close()
+            print(f"[DISCONNECT] {addr} connection closed.")
+
+    # Event loop counterpart of handle_client: same commands, same newline-delimited JSON framing
+    async def handle_client_async(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        print(f"[NEW CONNECTION] {addr} connected.")
+        conn = AsyncConnection(writer, self.loop)
+        inflight = deque()
+        try:
+            while True:
+                line = await reader.readline()
+                # EOF, possibly in the middle of an unterminated line
+                if not line.endswith(b"\n"):
+                    break
+                if self.pool is None:
+                    keep_open = self.handle_line(conn, line[:-1].decode())
+                    if isinstance(keep_open, Future):
+                        # A streamed reply paused for this client: read nothing more until it is sent
+                        keep_open = await asyncio.wrap_future(keep_open)
                 else:
-                    conn.send(self.create_msg("error", body="Unknown command", err=True))
+                    keep_open = await self.submit_async(inflight, conn, line[:-1].decode())
+                if not keep_open:
+                    print(f"[DISCONNECT] {addr} disconnected.")
+                    break
+                await writer.drain()
         except Exception as e:
             print(f"[ERROR] Exception handling client {addr}: {e}")
         finally:
+            try:
+                while inflight:
+                    await asyncio.wrap_future(inflight.popleft())
+            except Exception as e:
+                print(f"[ERROR] Exception handling client {addr}: {e}")
             conn.close()
             print(f"[DISCONNECT] {addr} connection closed.")
 
+    # Multi-process mode: forked workers own the client sockets and only split the byte stream
+    # into lines; the state owners run the commands on pools of workers threads. With several
+    # shards each owner holds the live sessions of the users that hash to it, and accounts and
+    # messages come from a store they all open (see run_multiprocess)
+    def start_multiprocess(self, processes, shards=1, workers=0, queue_depth=DEFAULT_QUEUE_DEPTH):
+        if shards > 1:
+            if not getattr(self.store, "shareable", False):
+                raise ValueError("Several shards need a store every process can open (--db)")
+            # Every forked owner opens its own database connections
+            self.store.close()
+
+        def read_requests(sock):
+            return self.read_messages(sock, raw=True)
+
+        def dispatch(conn, request):
+            return self.handle_line(conn, request.decode())
+
+        run_multiprocess(self.port, processes, dispatch, read_requests, shards=shards,
+                         route=route_request, workers=workers, queue_depth=queue_depth)
+
+    # Queue a line on the worker pool without blocking the loop. Waits only when the connection
+    # already has queue_depth commands outstanding; returns False once a command asked to close
+    async def submit_async(self, inflight, conn, raw_msg):
+        inflight.append(self.pool.submit(conn, self.handle_line, conn, raw_msg))
+        while inflight and (inflight[0].done() or len(inflight) > self.pool.queue_depth):
+            if await asyncio.wrap_future(inflight.popleft()) is False:
+                return False
+        return True
+
+# With several shards, the user whose shard runs a request line: the one whose login, pushes or
+# logoff it touches, so a send goes to the recipient's shard, where their connection is
+# registered. hello changes the connection itself and runs on every shard
+def route_request(request):
+    try:
+        parts = json.loads(request)
+    except ValueError:
+        return None
+    if not isinstance(parts, dict):
+        return None
+    cmd = parts.get("cmd")
+    if cmd == "hello":
+        return EVERY_SHARD
+    username = parts.get("to") if cmd == "send" else parts.get("from")
+    return username if isinstance(username, str) else None
+
 if __name__ == "__main__":
-    server = ChatServer(host='localhost', port=12345)
+    parser = argparse.ArgumentParser(description="JSON chat server")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--mode", choices=SERVER_MODES, default="thread",
+                        help="thread: one thread per connection, asyncio: single event loop")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run commands on a fixed pool of this many threads (0 = on the I/O thread, or a default pool when an event loop would wait on --wal/--db/--segments; with --processes, each state owner's pool)")
+    parser.add_argument("--queue-depth", type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help="commands a connection may have waiting for the pool")
+    parser.add_argument("--pool-stats", type=float, default=0,
+                        help="print pool queue-wait statistics every N seconds")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="fork this many SO_REUSEPORT worker processes for client I/O; commands "
+                             "run in the state-owner process(es), see --shards")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="with --processes, run commands in this many owner processes, each owning "
+                             "the live sessions of the users that hash to it (needs --db)")
+    parser.add_argument("--high-watermark", type=int, default=DEFAULT_HIGH_WATERMARK,
+                        help="unsent bytes at which live pushes to a client stop")
+    parser.add_argument("--low-watermark", type=int, default=DEFAULT_LOW_WATERMARK,
+                        help="unsent bytes a throttled client must drain to before pushes resume")
+    parser.add_argument("--slow-consumer", choices=SLOW_CONSUMER_POLICIES, default="unread",
+                        help="unread: keep throttled pushes as unread messages, disconnect: drop the client")
+    parser.add_argument("--wal", default=None,
+                        help="write-ahead log file: replayed at startup, every change is fsynced before it is acknowledged")
+    parser.add_argument("--commit-window", type=float, default=DEFAULT_COMMIT_WINDOW * 1000,
+                        help="milliseconds a log write waits for more records when several writers are queued (group commit)")
+    parser.add_argument("--snapshot-every", type=int, default=DEFAULT_SNAPSHOT_EVERY,
+                        help="log records between background snapshots that let the log be truncated (0 = never)")
+    parser.add_argument("--db", default=None,
+                        help="keep accounts and messages in this SQLite database instead of memory")
+    parser.add_argument("--segments", default=None,
+                        help="keep histories in memory-mapped segment files in this directory (accounts use --wal)")
+    args = parser.parse_args()
+    store = None
+    if args.db:
+        store = SqliteStore(args.db)
+    elif args.segments:
+        store = SegmentStore(args.segments, args.wal, args.commit_window / 1000, args.snapshot_every)
+    server = ChatServer(host='localhost', port=args.port, mode=args.mode,
+                        workers=args.workers, queue_depth=args.queue_depth, bind=args.processes <= 0,
+                        high_watermark=args.high_watermark, low_watermark=args.low_watermark,
+                        slow_consumer=args.slow_consumer, wal_path=args.wal,
+                        commit_window=args.commit_window / 1000, snapshot_every=args.snapshot_every,
+                        store=store)
+    if server.pool is not None and args.pool_stats > 0:
+        server.pool.start_reporter(args.pool_stats)
     try:
-        server.start()
+        if args.processes > 0:
+            server.start_multiprocess(args.processes, args.shards, args.workers, args.queue_depth)
+        else:
+            server.start()
     except KeyboardInterrupt:
         print("[SHUTDOWN] Server is shutting down.")
+        print(f"[BACKPRESSURE] {server.backpressure.stats()}")
+        print(f"[COMPRESSION] {server.compression_stats.snapshot()}")
+        print(f"[STORE] {server.store.stats()}")
         server.stop()
\ No newline at end of file
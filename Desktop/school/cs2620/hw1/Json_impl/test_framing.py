@@ -0,0 +1,49 @@
+import socket
+import unittest
+
+from framing import LineFramer
+
+class LineFramerTests(unittest.TestCase):
+    def feed(self, framer, sock, data):
+        sock.sendall(data)
+        received = 0
+        while received < len(data):
+            received += framer.recv_into(self.reader)
+        return list(framer.lines())
+
+    def setUp(self):
+        self.writer, self.reader = socket.socketpair()
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+
+    def test_many_lines_in_one_recv(self):
+        framer = LineFramer()
+        lines = [f'{{"n": {i}}}' for i in range(1000)]
+        self.assertEqual(self.feed(framer, self.writer, ("\n".join(lines) + "\n").encode()), lines)
+
+    def test_partial_line_and_split_utf8(self):
+        framer = LineFramer()
+        data = "héllo wörld\n".encode()
+        # Split in the middle of the two-byte "é"
+        self.assertEqual(self.feed(framer, self.writer, data[:2]), [])
+        self.assertEqual(self.feed(framer, self.writer, data[2:]), ["héllo wörld"])
+
+    def test_line_longer_than_chunk(self):
+        framer = LineFramer(chunk=16)
+        line = "x" * 1000
+        result = []
+        for i in range(0, 1001, 7):
+            result += self.feed(framer, self.writer, (line + "\n").encode()[i:i + 7])
+        self.assertEqual(result, [line])
+        self.assertEqual(self.feed(framer, self.writer, b"a\nb\n"), ["a", "b"])
+
+    def test_raw_lines(self):
+        framer = LineFramer()
+        self.writer.sendall(b"one\ntwo\nthr")
+        framer.recv_into(self.reader)
+        self.assertEqual(list(framer.raw_lines()), [b"one", b"two"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,7 +7,16 @@ import re
 from io import StringIO
 import contextlib
 import struct
+import os
+import sys
+import signal
+import subprocess
+import tempfile
+import shutil
 from server import ChatServer
+from chat_common.wal import segment_path, segment_numbers
+from chat_common.sqlite_store import SqliteStore
+from chat_common.segment_store import SegmentStore
 
 MSGLEN = 409600
 TEST_HOST = '127.0.0.1'
@@ -252,5 +261,506 @@ class TestChatServer(unittest.TestCase):
         s.sendall((json.dumps(msg_close) + "\n").encode())
         s.close()
 
+ASYNC_TEST_PORT = 56790
+
+class TestAsyncChatServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ChatServer(host=TEST_HOST, port=ASYNC_TEST_PORT, mode="asyncio")
+        cls.server_thread = threading.Thread(target=cls.server.start, daemon=True)
+        cls.server_thread.start()
+        time.sleep(0.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.server_thread.join(timeout=1)
+
+    def connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((TEST_HOST, ASYNC_TEST_PORT))
+        return s
+
+    def recv_line(self, s):
+        data = b""
+        while not data.endswith(b"\n"):
+            data += s.recv(MSGLEN)
+        return json.loads(data.decode().strip())
+
+    def test_create_and_login(self):
+        s = self.connect()
+        s.sendall((json.dumps({"cmd": "create", "from": "aio_user1", "to": "", "body": "", "password": "pw"}) + "\n").encode())
+        self.assertIn("Account created", self.recv_line(s).get("body", ""))
+        s.sendall((json.dumps({"cmd": "login", "from": "aio_user1", "to": "", "body": "", "password": "pw"}) + "\n").encode())
+        self.assertIn("Login successful", self.recv_line(s).get("body", ""))
+        s.close()
+
+    def test_live_push_between_connections(self):
+        receiver = self.connect()
+        sender = self.connect()
+        for sock, name in [(receiver, "aio_receiver"), (sender, "aio_sender")]:
+            sock.sendall((json.dumps({"cmd": "create", "from": name, "to": "", "body": "", "password": "pw"}) + "\n").encode())
+            self.recv_line(sock)
+            sock.sendall((json.dumps({"cmd": "login", "from": name, "to": "", "body": "", "password": "pw"}) + "\n").encode())
+            self.recv_line(sock)
+        sender.sendall((json.dumps({"cmd": "send", "from": "aio_sender", "to": "aio_receiver", "body": "hi async"}) + "\n").encode())
+        self.assertIn("Message sent", self.recv_line(sender).get("body", ""))
+        resp_chat = self.recv_line(receiver)
+        self.assertEqual(resp_chat.get("cmd"), "chat")
+        self.assertEqual(json.loads(resp_chat.get("body"))[0]["message"], "hi async")
+        sender.close()
+        receiver.close()
+
+    def test_streamed_history_waits_for_the_reader(self):
+        store = self.server.store
+        for name in ("aio_stream_alice", "aio_stream_bob"):
+            store.create_user(name, "hash")
+        conv_key = ("aio_stream_alice", "aio_stream_bob")
+        for i in range(40000):
+            store.post(conv_key, "aio_stream_alice", f"{i:05d} " + "x" * 300, "2025-01-01T00:00:00")
+        pages = []
+        history_pages = store.history_pages
+
+        def counted_pages(*args):
+            for page in history_pages(*args):
+                pages.append(len(page))
+                yield page
+        store.history_pages = counted_pages
+        self.addCleanup(delattr, store, "history_pages")
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 << 10)
+        s.connect((TEST_HOST, ASYNC_TEST_PORT))
+        requests = [{"cmd": "view_conv", "from": "aio_stream_bob", "to": "aio_stream_alice", "stream": True},
+                    {"cmd": "list", "from": "aio_stream_bob", "body": "aio_stream_*"}]
+        s.sendall("".join(json.dumps(r) + "\n" for r in requests).encode())
+        time.sleep(0.5)
+        # The client reads nothing, so the loop has stopped producing pages
+        self.assertLess(sum(pages), 40000 // 2)
+        # Other clients are still served
+        other = self.connect()
+        other.sendall((json.dumps({"cmd": "list", "from": "", "body": "*"}) + "\n").encode())
+        self.assertEqual(self.recv_line(other).get("cmd"), "list")
+        other.close()
+        data = b""
+        while data.count(b"\n") < 40000 // 256 + 3:
+            data += s.recv(MSGLEN)
+        replies = [json.loads(line) for line in data.decode().strip().split("\n")]
+        # Every message in order, then the list reply after the end of the stream
+        self.assertEqual([r.get("more") for r in replies[-2:]], [False, None])
+        self.assertEqual(replies[-1]["cmd"], "list")
+        messages = [m["message"][:5] for r in replies[:-2] for m in json.loads(r["body"])]
+        self.assertEqual(messages, [f"{i:05d}" for i in range(40000)])
+        s.close()
+
+    def test_many_idle_connections(self):
+        socks = [self.connect() for _ in range(200)]
+        s = socks[-1]
+        s.sendall((json.dumps({"cmd": "list", "from": "", "to": "", "body": "*"}) + "\n").encode())
+        self.assertEqual(self.recv_line(s).get("cmd"), "list")
+        for sock in socks:
+            sock.close()
+
+POOL_TEST_PORT = 56792
+
+class TestPooledChatServer(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ChatServer(host=TEST_HOST, port=POOL_TEST_PORT, mode="asyncio", workers=4, queue_depth=2)
+        cls.server_thread = threading.Thread(target=cls.server.start, daemon=True)
+        cls.server_thread.start()
+        time.sleep(0.5)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.server_thread.join(timeout=1)
+
+    def test_pipelined_commands_answer_in_order(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((TEST_HOST, POOL_TEST_PORT))
+        requests = [{"cmd": "create", "from": "pool_user", "to": "", "body": "", "password": "pw"},
+                    {"cmd": "login", "from": "pool_user", "to": "", "body": "", "password": "pw"}]
+        requests += [{"cmd": "list", "from": "pool_user", "to": "", "body": "pool_*"} for _ in range(10)]
+        s.sendall("".join(json.dumps(r) + "\n" for r in requests).encode())
+        data = b""
+        while data.count(b"\n") < len(requests):
+            data += s.recv(MSGLEN)
+        replies = [json.loads(line) for line in data.decode().strip().split("\n")]
+        self.assertEqual([r["cmd"] for r in replies], [r["cmd"] for r in requests])
+        self.assertIn("Login successful", replies[1]["body"])
+        self.assertGreater(self.server.pool.stats()["completed"], 0)
+        s.close()
+
+class RecordingConn:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+        return len(data)
+
+class TestChatServerConcurrency(unittest.TestCase):
+    def test_concurrent_senders_get_unique_ids_and_lose_nothing(self):
+        server = ChatServer(bind=False)
+        senders = [f"conc_sender{i}" for i in range(8)]
+        for name in senders + ["conc_inbox"]:
+            server.handle_command(RecordingConn(), {"cmd": "create", "from": name, "password": "pw"})
+
+        def blast(name):
+            conn = RecordingConn()
+            for i in range(300):
+                server.handle_command(conn, {"cmd": "send", "from": name, "to": "conc_inbox", "body": str(i)})
+
+        threads = [threading.Thread(target=blast, args=(name,)) for name in senders]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        inbox = server.store.users["conc_inbox"]["messages"]
+        ids = [m["id"] for m in inbox]
+        self.assertEqual(len(ids), 8 * 300)
+        self.assertEqual(len(set(ids)), len(ids))
+        for name in senders:
+            history = [m["id"] for m in server.store.conversations[tuple(sorted([name, "conc_inbox"]))]]
+            self.assertEqual(history, sorted(history))
+
+class StalledConn(RecordingConn):
+    def __init__(self, pending):
+        super().__init__()
+        self.pending = pending
+        self.throttled = False
+        self.aborted = False
+
+    def pending_bytes(self):
+        return self.pending
+
+    def abort(self):
+        self.aborted = True
+
+class TestSlowConsumer(unittest.TestCase):
+    def setup_server(self, policy):
+        server = ChatServer(bind=False, high_watermark=1000, low_watermark=100, slow_consumer=policy)
+        for name in ("slow_sender", "slow_inbox"):
+            server.handle_command(RecordingConn(), {"cmd": "create", "from": name, "password": "pw"})
+        inbox = StalledConn(pending=5000)
+        server.handle_command(inbox, {"cmd": "login", "from": "slow_inbox", "password": "pw"})
+        server.handle_command(RecordingConn(), {"cmd": "send", "from": "slow_sender", "to": "slow_inbox", "body": "hi"})
+        return server, inbox
+
+    def test_push_to_stalled_client_falls_back_to_unread(self):
+        server, inbox = self.setup_server("unread")
+        self.assertEqual(len(inbox.sent), 1)  # only the login reply
+        self.assertEqual([m["message"] for m in server.store.users["slow_inbox"]["messages"]], ["hi"])
+        self.assertIn("slow_inbox", server.active_users)
+        self.assertEqual(server.backpressure.stats()["dropped_to_unread"], 1)
+
+    def test_disconnect_policy_drops_stalled_client(self):
+        server, inbox = self.setup_server("disconnect")
+        self.assertTrue(inbox.aborted)
+        self.assertNotIn("slow_inbox", server.active_users)
+        self.assertEqual([m["message"] for m in server.store.users["slow_inbox"]["messages"]], ["hi"])
+        self.assertEqual(server.backpressure.stats()["disconnected"], 1)
+
+class TestCompression(unittest.TestCase):
+    def test_hello_enables_compressed_history(self):
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+        from chat_common.compression import expand_json_body
+        server = ChatServer(bind=False)
+        for name in ("zip_alice", "zip_bob"):
+            server.handle_command(RecordingConn(), {"cmd": "create", "from": name, "password": "pw"})
+        for i in range(50):
+            server.handle_command(RecordingConn(), {"cmd": "send", "from": "zip_alice", "to": "zip_bob", "body": f"hello {i}"})
+        conn = RecordingConn()
+        server.handle_command(conn, {"cmd": "hello", "body": "zlib,zdict,unknown"})
+        self.assertEqual(json.loads(conn.sent[-1])["body"], "zlib,zdict")
+        server.handle_command(conn, {"cmd": "view_conv", "from": "zip_bob", "to": "zip_alice"})
+        reply = json.loads(conn.sent[-1])
+        self.assertEqual(reply["body"], "")
+        conv = json.loads(expand_json_body(reply)["body"])
+        self.assertEqual([m["message"] for m in conv], [f"hello {i}" for i in range(50)])
+        self.assertEqual(server.compression_stats.snapshot()["frames"], 1)
+
+        # Without a hello the reply is plain
+        plain = RecordingConn()
+        server.handle_command(plain, {"cmd": "view_conv", "from": "zip_bob", "to": "zip_alice"})
+        self.assertNotIn("zbody", json.loads(plain.sent[-1]))
+
+    def test_hello_with_a_non_string_body_is_rejected(self):
+        server = ChatServer(bind=False)
+        conn = RecordingConn()
+        for body in (None, ["zlib"], 3):
+            self.assertTrue(server.handle_command(conn, {"cmd": "hello", "body": body}))
+            reply = json.loads(conn.sent[-1])
+            self.assertTrue(reply["error"])
+        # The connection still works and can negotiate afterwards
+        server.handle_command(conn, {"cmd": "hello", "body": "zlib"})
+        self.assertEqual(json.loads(conn.sent[-1])["body"], "zlib")
+
+class TestNestedBodies(unittest.TestCase):
+    def test_hello_nested_sends_structured_lists(self):
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+        from chat_common.compression import expand_json_body
+        server = ChatServer(bind=False)
+        for name in ("nest_alice", "nest_bob"):
+            server.handle_command(RecordingConn(), {"cmd": "create", "from": name, "password": "pw"})
+        for i in range(3):
+            server.handle_command(RecordingConn(), {"cmd": "send", "from": "nest_alice", "to": "nest_bob", "body": f'say "{i}"'})
+        legacy = RecordingConn()
+        server.handle_command(legacy, {"cmd": "view_conv", "from": "nest_bob", "to": "nest_alice"})
+        conn = RecordingConn()
+        server.handle_command(conn, {"cmd": "hello", "body": "nested"})
+        self.assertEqual(json.loads(conn.sent[-1])["body"], "nested")
+        server.handle_command(conn, {"cmd": "view_conv", "from": "nest_bob", "to": "nest_alice"})
+        conv = json.loads(conn.sent[-1])["body"]
+        self.assertEqual([m["message"] for m in conv], [f'say "{i}"' for i in range(3)])
+        self.assertLess(len(conn.sent[-1]), len(legacy.sent[-1]))
+
+        # Pushes to a nested connection carry the entry list too
+        server.handle_command(conn, {"cmd": "login", "from": "nest_bob", "password": "pw"})
+        server.handle_command(RecordingConn(), {"cmd": "send", "from": "nest_alice", "to": "nest_bob", "body": "live"})
+        push = json.loads(conn.sent[-1])
+        self.assertEqual((push["cmd"], push["body"][0]["message"]), ("chat", "live"))
+
+        # Combined with compression, the body still expands to the structure
+        zipped = RecordingConn()
+        server.handle_command(zipped, {"cmd": "hello", "body": "zlib,nested"})
+        self.assertEqual(json.loads(zipped.sent[-1])["body"], "zlib,nested")
+        for i in range(100):
+            server.handle_command(RecordingConn(), {"cmd": "send", "from": "nest_alice", "to": "nest_bob", "body": f"bulk {i}"})
+        server.handle_command(zipped, {"cmd": "view_conv", "from": "nest_bob", "to": "nest_alice"})
+        reply = expand_json_body(json.loads(zipped.sent[-1]))
+        self.assertEqual(reply["body"][-1]["message"], "bulk 99")
+
+class TestHistoryCursor(unittest.TestCase):
+    def test_view_conv_since_and_before_id(self):
+        server = ChatServer(bind=False)
+        for name in ("cur_alice", "cur_bob"):
+            server.handle_command(RecordingConn(), {"cmd": "create", "from": name, "password": "pw"})
+        for i in range(6):
+            server.handle_command(RecordingConn(), {"cmd": "send", "from": "cur_alice", "to": "cur_bob", "body": f"m{i}"})
+        ids = [m["id"] for m in server.store.conversations[("cur_alice", "cur_bob")]]
+        conn = RecordingConn()
+
+        def view(**cursor):
+            server.handle_command(conn, dict({"cmd": "view_conv", "from": "cur_bob", "to": "cur_alice"}, **cursor))
+            return json.loads(conn.sent[-1])
+
+        body = json.loads(view(since_id=ids[3])["body"])
+        self.assertEqual([m["message"] for m in body], ["m4", "m5"])
+        body = json.loads(view(before_id=ids[3], limit=2)["body"])
+        self.assertEqual([m["message"] for m in body], ["m1", "m2"])
+        self.assertEqual(json.loads(view(since_id=ids[-1])["body"]), [])
+        self.assertTrue(view(since_id="abc")["error"])
+
+    def test_streamed_view_conv_chunks(self):
+        server = ChatServer(bind=False)
+        for name in ("str_alice", "str_bob"):
+            server.handle_command(RecordingConn(), {"cmd": "create", "from": name, "password": "pw"})
+        for i in range(600):
+            server.handle_command(RecordingConn(), {"cmd": "send", "from": "str_alice", "to": "str_bob", "body": f"m{i}"})
+        conn = RecordingConn()
+        server.handle_command(conn, {"cmd": "view_conv", "from": "str_bob", "to": "str_alice", "stream": True})
+        replies = [json.loads(line) for line in conn.sent]
+        self.assertEqual([r["more"] for r in replies], [True, True, True, False])
+        messages = [m["message"] for r in replies for m in json.loads(r["body"])]
+        self.assertEqual(messages, [f"m{i}" for i in range(600)])
+
+class TestWriteAheadLog(unittest.TestCase):
+    def test_restart_replays_accounts_histories_and_unread(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "chat.wal")
+        server = ChatServer(bind=False, wal_path=path, commit_window=0)
+        for name in ("wal_alice", "wal_bob", "wal_carol"):
+            server.handle_command(RecordingConn(), {"cmd": "create", "from": name, "password": "pw"})
+        for i in range(4):
+            server.handle_command(RecordingConn(), {"cmd": "send", "from": "wal_alice", "to": "wal_bob", "body": f"m{i}"})
+        ids = [m["id"] for m in server.store.conversations[("wal_alice", "wal_bob")]]
+        server.handle_command(RecordingConn(), {"cmd": "read", "from": "wal_bob", "body": "1"})
+        server.handle_command(RecordingConn(), {"cmd": "delete_msg", "from": "wal_alice", "body": str(ids[2])})
+        server.handle_command(RecordingConn(), {"cmd": "delete", "from": "wal_carol"})
+        live_unread = [m["message"] for m in server.store.users["wal_bob"]["messages"]]
+        server.stop()
+
+        restored = ChatServer(bind=False, wal_path=path, commit_window=0)
+        self.addCleanup(restored.stop)
+        self.assertEqual(list(restored.store.users), ["wal_alice", "wal_bob"])
+        self.assertEqual(restored.store.users["wal_alice"]["password_hash"], restored.hash_password("pw"))
+        history = restored.store.conversations[("wal_alice", "wal_bob")]
+        self.assertEqual([m["message"] for m in history], ["m0", "m1", "m3"])
+        # Deleting from alice's side leaves bob's unread copy, live and after replay
+        self.assertEqual(live_unread, ["m1", "m2", "m3"])
+        self.assertEqual([m["message"] for m in restored.store.users["wal_bob"]["messages"]], live_unread)
+        # New IDs continue after the restored ones
+        restored.handle_command(RecordingConn(), {"cmd": "send", "from": "wal_bob", "to": "wal_alice", "body": "again"})
+        self.assertGreater(restored.store.conversations[("wal_alice", "wal_bob")][-1]["id"], ids[-1])
+
+    def test_event_loop_never_waits_for_the_log(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.assertIsNone(ChatServer(bind=False, mode="asyncio").pool)
+        server = ChatServer(bind=False, mode="asyncio", wal_path=os.path.join(tmpdir, "chat.wal"))
+        self.addCleanup(server.stop)
+        # Handlers that wait for fsyncs run on a pool, off the loop thread
+        self.assertIsNotNone(server.pool)
+        threaded = ChatServer(bind=False, wal_path=os.path.join(tmpdir, "other.wal"))
+        self.addCleanup(threaded.stop)
+        self.assertIsNone(threaded.pool)
+
+    def test_background_snapshot_truncates_log(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "chat.wal")
+        server = ChatServer(bind=False, wal_path=path, commit_window=0, snapshot_every=20)
+        for name in ("snap_alice", "snap_bob"):
+            server.handle_command(RecordingConn(), {"cmd": "create", "from": name, "password": "pw"})
+        for i in range(100):
+            server.handle_command(RecordingConn(), {"cmd": "send", "from": "snap_alice", "to": "snap_bob", "body": f"m{i}"})
+        server.stop()
+        self.assertGreater(server.store.snapshots.stats()["snapshots"], 0)
+        # Only the segments after the latest snapshot are kept
+        self.assertLess(sum(os.path.getsize(segment_path(path, n)) for n in segment_numbers(path)),
+                        server.store.wal.stats()["bytes"])
+
+        restored = ChatServer(bind=False, wal_path=path, commit_window=0)
+        self.addCleanup(restored.stop)
+        self.assertEqual(restored.store.conversations, server.store.conversations)
+        self.assertEqual(restored.store.users, server.store.users)
+
+class TestSqliteStore(unittest.TestCase):
+    def test_commands_on_sqlite(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        server = ChatServer(bind=False, store=SqliteStore(os.path.join(tmpdir, "chat.db")))
+        self.addCleanup(server.stop)
+        conn = RecordingConn()
+
+        def request(**msg):
+            server.handle_command(conn, msg)
+            return json.loads(conn.sent[-1])
+
+        for name in ("sql_alice", "sql_bob"):
+            self.assertEqual(request(cmd="create", **{"from": name}, password="pw")["body"], "Account created")
+        self.assertEqual(request(cmd="login", **{"from": "sql_bob"}, password="pw")["body"],
+                         "Login successful. Unread messages: 0")
+        server.handle_command(conn, {"cmd": "logoff", "from": "sql_bob"})
+        for i in range(3):
+            request(cmd="send", **{"from": "sql_alice"}, to="sql_bob", body=f"m{i}")
+        unread = json.loads(request(cmd="read", **{"from": "sql_bob"}, body="2")["body"])
+        self.assertEqual([m["message"] for m in unread], ["m0", "m1"])
+        self.assertFalse(request(cmd="delete_msg", **{"from": "sql_bob"}, body=str(unread[0]["id"]))["error"])
+        history = json.loads(request(cmd="view_conv", **{"from": "sql_bob"}, to="sql_alice")["body"])
+        self.assertEqual([m["message"] for m in history], ["m1", "m2"])
+        # view_conv marked m2 read
+        self.assertEqual(json.loads(request(cmd="read", **{"from": "sql_bob"})["body"]), [])
+
+class TestSegmentStore(unittest.TestCase):
+    def test_view_conv_from_segments_after_restart(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        segments, wal_path = os.path.join(tmpdir, "segments"), os.path.join(tmpdir, "chat.wal")
+        conn = RecordingConn()
+
+        def request(server, **msg):
+            server.handle_command(conn, msg)
+            return json.loads(conn.sent[-1])
+
+        server = ChatServer(bind=False, store=SegmentStore(segments, wal_path, commit_window=0))
+        for name in ("seg_alice", "seg_bob"):
+            request(server, cmd="create", **{"from": name}, password="pw")
+        for i in range(5):
+            request(server, cmd="send", **{"from": "seg_alice"}, to="seg_bob", body=f"m{i}")
+        server.stop()
+        server = ChatServer(bind=False, store=SegmentStore(segments, wal_path, commit_window=0))
+        self.addCleanup(server.stop)
+        self.assertEqual(request(server, cmd="login", **{"from": "seg_bob"}, password="pw")["body"],
+                         "Login successful. Unread messages: 5")
+        history = json.loads(request(server, cmd="view_conv", **{"from": "seg_bob"}, to="seg_alice")["body"])
+        self.assertEqual([m["message"] for m in history], [f"m{i}" for i in range(5)])
+        page = json.loads(request(server, cmd="view_conv", **{"from": "seg_bob"}, to="seg_alice",
+                                  before_id=history[3]["id"], limit=2)["body"])
+        self.assertEqual([m["message"] for m in page], ["m1", "m2"])
+
+MULTIPROC_TEST_PORT = 56793
+SHARDED_TEST_PORT = 56796
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT") and hasattr(os, "fork"), "needs SO_REUSEPORT and fork")
+class TestMultiProcessChatServer(unittest.TestCase):
+    port = MULTIPROC_TEST_PORT
+
+    @classmethod
+    def server_args(cls):
+        return []
+
+    @classmethod
+    def setUpClass(cls):
+        server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+        cls.proc = subprocess.Popen([sys.executable, server_path, "--processes", "3", "--port", str(cls.port)] + cls.server_args(),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proc.send_signal(signal.SIGINT)
+        cls.proc.wait(timeout=5)
+
+    def request(self, s, msg_dict):
+        s.sendall((json.dumps(msg_dict) + "\n").encode())
+        data = b""
+        while not data.endswith(b"\n"):
+            data += s.recv(MSGLEN)
+        return json.loads(data.decode().strip())
+
+    def test_state_shared_and_pushes_routed_across_workers(self):
+        socks = []
+        for i in range(6):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.connect((TEST_HOST, self.port))
+            name = f"mp_user{i}"
+            self.assertIn("Account created", self.request(s, {"cmd": "create", "from": name, "to": "", "body": "", "password": "pw"}).get("body", ""))
+            self.assertIn("Login successful", self.request(s, {"cmd": "login", "from": name, "to": "", "body": "", "password": "pw"}).get("body", ""))
+            socks.append(s)
+        resp_list = self.request(socks[0], {"cmd": "list", "from": "mp_user0", "to": "", "body": "mp_user*"})
+        self.assertEqual(len(resp_list["body"].split(",")), 6)
+        for i in range(1, 6):
+            self.assertIn("Message sent", self.request(socks[0], {"cmd": "send", "from": "mp_user0", "to": f"mp_user{i}", "body": f"hi {i}"}).get("body", ""))
+        for i in range(1, 6):
+            data = b""
+            while not data.endswith(b"\n"):
+                data += socks[i].recv(MSGLEN)
+            resp_chat = json.loads(data.decode().strip())
+            self.assertEqual(resp_chat.get("cmd"), "chat")
+            self.assertEqual(json.loads(resp_chat["body"])[0]["message"], f"hi {i}")
+        for s in socks:
+            s.close()
+
+# The same, with commands run by three owner processes sharing a SQLite database
+class TestShardedChatServer(TestMultiProcessChatServer):
+    port = SHARDED_TEST_PORT
+
+    @classmethod
+    def server_args(cls):
+        cls.db_dir = tempfile.mkdtemp()
+        return ["--shards", "3", "--db", os.path.join(cls.db_dir, "chat.db")]
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(cls.db_dir, ignore_errors=True)
+
+    def test_hello_applies_on_every_shard(self):
+        # The connection's users hash to different shards; each must answer with nested bodies
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(s.close)
+        s.connect((TEST_HOST, self.port))
+        self.assertEqual(self.request(s, {"cmd": "hello", "body": "nested"})["body"], "nested")
+        names = [f"hello_user{i}" for i in range(6)]
+        for name in names:
+            self.request(s, {"cmd": "create", "from": name, "password": "pw"})
+            self.request(s, {"cmd": "send", "from": name, "to": names[0], "body": "hi"})
+        for name in names:
+            resp = self.request(s, {"cmd": "read", "from": name})
+            self.assertIsInstance(resp["body"], list, name)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1 @@
+# Transport-level building blocks shared by the JSON (Json_impl) and binary (Custom_impl) servers
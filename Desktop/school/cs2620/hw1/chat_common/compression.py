@@ -0,0 +1,120 @@
+import base64
+import json
+import threading
+import time
+import zlib
+
+# Payloads shorter than this go out as they are; zlib's header and the CPU time aren't worth it
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+
+# Capabilities a client can offer in its hello. The binary protocol sends them as bit flags,
+# the JSON protocol as a comma-separated list of the names
+CAP_ZLIB = 0x01   # large frames may be zlib-compressed
+CAP_ZDICT = 0x02  # ... using PRESET_DICTIONARY
+SUPPORTED_CAPS = CAP_ZLIB | CAP_ZDICT
+CAP_NAMES = {CAP_ZLIB: "zlib", CAP_ZDICT: "zdict"}
+
+# Seeds the compressor's window with field names and markers every history reply repeats, so
+# even the first occurrence in a frame compresses. Decompressors always load it; zlib only
+# uses it for streams that were compressed with it
+PRESET_DICTIONARY = (
+    b'NO_MESSAGES END_OF_MESSAGES No conversation history found [ID ] [20'
+    b'{"cmd": "read", "from": "", "to": "", "body": "", "error": false}\n'
+    b'{"cmd": "view_conv", "cmd": "chat", '
+    b'[\n  {\n    "id": , \n    "sender": "", \n    "message": "", \n    "timestamp": "20'
+)
+
+def cap_names(caps):
+    return ",".join(name for bit, name in sorted(CAP_NAMES.items()) if caps & bit)
+
+def cap_bits(names):
+    wanted = {name.strip() for name in names.split(",")}
+    return sum(bit for bit, name in CAP_NAMES.items() if name in wanted)
+
+class CompressionStats:
+    # Totals over every compressed frame: how much was saved and what it cost in CPU
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0          # frames sent compressed
+        self.skipped = 0         # frames over the threshold that didn't shrink
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0   # compressing, including the skipped attempts
+
+    def record(self, raw_len, packed_len, cpu, used):
+        with self.lock:
+            self.cpu_seconds += cpu
+            if used:
+                self.frames += 1
+                self.bytes_in += raw_len
+                self.bytes_out += packed_len
+            else:
+                self.skipped += 1
+
+    def snapshot(self):
+        with self.lock:
+            ratio = self.bytes_in / self.bytes_out if self.bytes_out else 0.0
+            return {"frames": self.frames, "skipped": self.skipped, "bytes_in": self.bytes_in,
+                    "bytes_out": self.bytes_out, "ratio": round(ratio, 2),
+                    "cpu_ms": round(self.cpu_seconds * 1000, 1)}
+
+class FrameCompressor:
+    # Compresses one payload at a time (each frame is self-contained, so frames can be
+    # decoded independently and in any order). compress() returns None when the payload
+    # should be sent as is: below the threshold, or not smaller once compressed
+    def __init__(self, use_dictionary=True, threshold=COMPRESS_THRESHOLD, stats=None):
+        self.zdict = PRESET_DICTIONARY if use_dictionary else None
+        self.threshold = threshold
+        self.stats = stats
+
+    def compress(self, data):
+        if len(data) < self.threshold:
+            return None
+        start = time.thread_time()
+        if self.zdict is not None:
+            packer = zlib.compressobj(COMPRESS_LEVEL, zdict=self.zdict)
+        else:
+            packer = zlib.compressobj(COMPRESS_LEVEL)
+        packed = packer.compress(data) + packer.flush()
+        used = len(packed) < len(data)
+        if self.stats is not None:
+            self.stats.record(len(data), len(packed), time.thread_time() - start, used)
+        return packed if used else None
+
+def decompress(data, max_length):
+    # Inflate one compressed payload, refusing anything that expands past max_length
+    unpacker = zlib.decompressobj(zdict=PRESET_DICTIONARY)
+    out = unpacker.decompress(data, max_length)
+    if unpacker.unconsumed_tail:
+        raise ValueError(f"Compressed payload expands past {max_length} bytes.")
+    if not unpacker.eof:
+        raise ValueError("Truncated compressed payload.")
+    return out
+
+# JSON-only capability (offered in the same hello): read, view_conv and chat replies carry
+# their message list as a nested JSON array in "body" instead of a JSON-encoded string
+CAP_NESTED = "nested"
+
+# JSON wire format: a compressed message keeps its other fields readable and carries the
+# body as base64 of the zlib stream in "zbody" instead of "body". A nested body is compressed
+# as compact JSON text and flagged with "zjson", so it expands back into the same structure
+def compress_json_body(msg, compressor):
+    body = msg["body"]
+    nested = not isinstance(body, str)
+    if nested:
+        body = json.dumps(body, separators=(",", ":"))
+    packed = compressor.compress(body.encode())
+    if packed is not None:
+        msg["body"] = ""
+        msg["zbody"] = base64.b64encode(packed).decode("ascii")
+        if nested:
+            msg["zjson"] = True
+    return msg
+
+def expand_json_body(msg, max_length=1 << 26):
+    if isinstance(msg, dict) and "zbody" in msg:
+        msg["body"] = decompress(base64.b64decode(msg.pop("zbody")), max_length).decode()
+        if msg.pop("zjson", False):
+            msg["body"] = json.loads(msg["body"])
+    return msg
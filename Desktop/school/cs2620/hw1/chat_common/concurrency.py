@@ -0,0 +1,63 @@
+import threading
+from contextlib import contextmanager
+
+DEFAULT_STRIPES = 64
+
+class StripedLock:
+    # Fixed table of locks shared by all keys. A key always maps to the same stripe, so
+    # operations on different users/conversations rarely contend, while the table size
+    # stays bounded no matter how many keys exist. Keys are namespaced by the caller,
+    # e.g. ("user", name) or ("conv", conv_key).
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        self.locks = [threading.RLock() for _ in range(stripes)]
+
+    def stripe(self, key):
+        return hash(key) % len(self.locks)
+
+    @contextmanager
+    def holding(self, *keys):
+        # Acquire the stripes for every key in index order so two threads asking for the
+        # same keys in a different order cannot deadlock
+        indices = sorted({self.stripe(key) for key in keys})
+        for i in indices:
+            self.locks[i].acquire()
+        try:
+            yield
+        finally:
+            for i in reversed(indices):
+                self.locks[i].release()
+
+    @contextmanager
+    def holding_all(self):
+        # Quiesce every writer, e.g. to take a consistent copy of the whole state
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self.locks):
+                lock.release()
+
+def user_lock_key(username):
+    return ("user", username)
+
+def conv_lock_key(conv_key):
+    return ("conv", conv_key)
+
+class IdAllocator:
+    # Hands out strictly increasing message IDs from any number of threads
+    def __init__(self, start=1):
+        self.lock = threading.Lock()
+        self.next_id = start
+
+    def allocate(self):
+        with self.lock:
+            value = self.next_id
+            self.next_id += 1
+            return value
+
+    def advance_past(self, used_id):
+        # Make sure future IDs are greater than an ID restored from elsewhere
+        with self.lock:
+            if used_id >= self.next_id:
+                self.next_id = used_id + 1
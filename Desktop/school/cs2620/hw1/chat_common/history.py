@@ -0,0 +1,51 @@
+import bisect
+
+from chat_common.concurrency import conv_lock_key
+
+# Messages per chunk of a streamed history reply (see history_pages)
+HISTORY_PAGE_SIZE = 256
+
+def entry_id(entry):
+    return entry["id"]
+
+# Index range [start, end) of the part of a conversation a client asked for. Histories are
+# kept sorted by message ID (IDs are allocated under the conversation lock and deletes keep
+# the order), so both ends are found by binary search instead of a scan.
+# since_id: only messages after it; before_id: only messages before it; 0/None means no bound.
+# limit > 0 keeps the oldest messages of the window, or the newest when paging back with
+# before_id, so a client can continue from the last (or first) ID it received.
+# key=None searches a plain sorted sequence of IDs instead of message entries
+def window_bounds(conv, since_id=None, before_id=None, limit=0, key=entry_id):
+    start = bisect.bisect_right(conv, since_id, key=key) if since_id else 0
+    end = bisect.bisect_left(conv, before_id, key=key) if before_id else len(conv)
+    if limit and limit > 0 and end - start > limit:
+        if before_id:
+            start = end - limit
+        else:
+            end = start + limit
+    return start, end
+
+# Copy of just that part of the history
+def history_window(conv, since_id=None, before_id=None, limit=0):
+    start, end = window_bounds(conv, since_id, before_id, limit)
+    return conv[start:end]
+
+# The same window as successive lists of at most page_size entries. The window is fixed by
+# message ID on the first page, so messages sent meanwhile don't extend it; each page is copied
+# under the conversation lock on its own, so a reply never holds more than one page in memory
+# and other senders aren't kept waiting while the pages go out
+def history_pages(conversations, conv_key, locks, since_id=None, before_id=None, limit=0,
+                  page_size=HISTORY_PAGE_SIZE):
+    with locks.holding(conv_lock_key(conv_key)):
+        conv = conversations.get(conv_key, [])
+        start, end = window_bounds(conv, since_id, before_id, limit)
+        if start >= end:
+            return
+        before_id = conv[end - 1]["id"] + 1
+        page = conv[start:min(end, start + page_size)]
+    while page:
+        yield page
+        with locks.holding(conv_lock_key(conv_key)):
+            conv = conversations.get(conv_key, [])
+            start, end = window_bounds(conv, page[-1]["id"], before_id)
+            page = conv[start:min(end, start + page_size)]
@@ -0,0 +1,73 @@
+import datetime
+import sys
+
+# Timestamps are kept as whole microseconds since this (naive, like the ISO strings the
+# handlers pass in), so converting back gives exactly the same string. Anything that isn't
+# an ISO timestamp is kept as given
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+FIELDS = ("id", "sender", "message", "timestamp")
+
+def to_micros(timestamp):
+    try:
+        return (datetime.datetime.fromisoformat(timestamp) - EPOCH) // MICROSECOND
+    except (TypeError, ValueError):
+        return timestamp
+
+def from_micros(micros):
+    if not isinstance(micros, int):
+        return micros
+    return (EPOCH + micros * MICROSECOND).isoformat()
+
+class Message:
+    # One message of a MemoryStore history. A dict entry costs a hash table plus a 26-character
+    # timestamp string per message; this is four slots, the sender shared through sys.intern and
+    # the timestamp an integer formatted only when it is read. The history and the recipient's
+    # unread list hold the same object. It reads like the dict entries other stores return
+    # (msg["id"], msg.get("timestamp")), so handlers take either; fields() is the dict form
+    # for JSON
+    __slots__ = ("id", "sender", "message", "micros")
+
+    def __init__(self, msg_id, sender, message, timestamp):
+        self.id = msg_id
+        self.sender = sys.intern(sender)
+        self.message = message
+        self.micros = to_micros(timestamp)
+
+    @classmethod
+    def from_fields(cls, entry):
+        return cls(entry["id"], entry["sender"], entry["message"], entry["timestamp"])
+
+    @property
+    def timestamp(self):
+        return from_micros(self.micros)
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in FIELDS
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in FIELDS else default
+
+    def fields(self):
+        return {"id": self.id, "sender": self.sender, "message": self.message, "timestamp": self.timestamp}
+
+    def __eq__(self, other):
+        if isinstance(other, (Message, dict)):
+            return self.fields() == (other.fields() if isinstance(other, Message) else other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Message({self.fields()!r})"
+
+# json.dumps(..., default=json_default) writes Messages as their dict form
+def json_default(value):
+    if isinstance(value, Message):
+        return value.fields()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -0,0 +1,444 @@
+import itertools
+import os
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import wait
+
+from chat_common.outbound import QueuedConnection, send_buffers
+from chat_common.worker_pool import OrderedWorkerPool, DEFAULT_QUEUE_DEPTH
+from chat_common.concurrency import user_lock_key
+
+# Frames on the worker <-> state owner channel: kind, client connection id, data length
+FRAME_HEADER = struct.Struct("!BII")
+KIND_REQUEST = 1  # worker -> owner: one complete client request
+KIND_SEND = 2     # owner -> worker: bytes to write to a client connection
+KIND_CLOSE = 3    # either way: the client connection is finished
+KIND_WRITTEN = 4  # worker -> owner: bytes routed to a client connection that it has now written
+KIND_ABORT = 5    # owner -> worker: drop what is queued for the client and cut it off
+KIND_DONE = 6     # owner -> worker: a request has finished (only with several shards)
+KIND_REPLAY = 7   # worker -> owner: a request to run for its effect on the connection only
+WRITTEN = struct.Struct("!Q")
+
+# Threads each state owner runs commands on when the server doesn't ask for a number
+DEFAULT_OWNER_WORKERS = 8
+# route(request) result for a request that changes the connection itself (e.g. its protocol
+# version): every shard runs it, and only the connection's current shard replies
+EVERY_SHARD = object()
+
+# The shard whose owner process holds username's live state: the stripe user_lock_key(username)
+# would take in a StripedLock of shards stripes. Workers and owners are forked from one process,
+# so they all hash alike
+def shard_of(username, shards):
+    return hash(user_lock_key(username)) % shards
+
+def recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+class Channel:
+    # One Unix socket between a worker and the state owner; sends are serialised by a lock
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+
+    def send(self, kind, conn_id, data=b""):
+        self.send_parts(kind, conn_id, [data])
+
+    # One frame whose data is the concatenation of parts, written without joining them
+    def send_parts(self, kind, conn_id, parts):
+        header = FRAME_HEADER.pack(kind, conn_id, sum(len(part) for part in parts))
+        with self.lock:
+            send_buffers(self.sock, [header] + list(parts))
+
+    def recv(self):
+        # Returns (kind, conn_id, data), or None once the other side has gone away
+        header = recv_exact(self.sock, FRAME_HEADER.size)
+        if header is None:
+            return None
+        kind, conn_id, length = FRAME_HEADER.unpack(header)
+        data = recv_exact(self.sock, length) if length else b""
+        if data is None:
+            return None
+        return kind, conn_id, data
+
+class RemoteConnection:
+    # Owner-side stand-in for a client socket held by a worker process. Command handlers call
+    # send()/sendall() exactly as they would on a local socket, so a push to any user is
+    # routed to whichever worker owns that user's connection. The worker reports how much of
+    # what was routed here the client has taken (KIND_WRITTEN), so pending_bytes() covers
+    # both the channel and the worker's outbound queue and Backpressure.admit applies as it
+    # does to a local connection
+    def __init__(self, channel, conn_id):
+        self.channel = channel
+        self.conn_id = conn_id
+        self.closed = False
+        self.muted = False      # while a replayed request runs (KIND_REPLAY)
+        self.throttled = False  # see Backpressure.admit
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.written = 0
+
+    def sendall(self, data):
+        self.sendmsg([data])
+
+    def sendmsg(self, buffers):
+        if self.closed:
+            raise OSError("Connection already closed.")
+        if self.muted:
+            return
+        with self.lock:
+            self.sent += sum(len(buf) for buf in buffers)
+        self.channel.send_parts(KIND_SEND, self.conn_id, buffers)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.channel.send(KIND_CLOSE, self.conn_id)
+
+    def pending_bytes(self):
+        with self.lock:
+            return self.sent - self.written
+
+    def report_written(self, written):
+        with self.lock:
+            if written > self.written:
+                self.written = written
+
+    # Slow-consumer disconnect: the worker drops the client's queue instead of flushing it
+    def abort(self):
+        if not self.closed:
+            self.closed = True
+            self.channel.send(KIND_ABORT, self.conn_id)
+
+# Run one forwarded request. A replayed request only updates the connection's state in this
+# shard; its replies belong to the shard that runs it for real
+def run_request(dispatch, conn, request, replay):
+    conn.muted = replay
+    try:
+        return dispatch(conn, request)
+    finally:
+        conn.muted = False
+
+def owner_channel_loop(channel, dispatch, pool=None, report_done=False):
+    # Serve every request coming from one worker. dispatch(conn, request) runs the command
+    # against the authoritative state and returns False when the client asked to close.
+    # With a pool (an OrderedWorkerPool keyed by connection) each request runs on it, so one
+    # slow command holds up only its own connection's later requests rather than this whole
+    # channel; a connection more than queue_depth requests ahead makes the channel wait for
+    # them. report_done sends KIND_DONE after each request, for a worker spreading one
+    # connection's requests over several shards
+    conns = {}
+
+    def finished(conn, keep_open):
+        if report_done:
+            try:
+                channel.send(KIND_DONE, conn.conn_id)
+            except OSError:
+                pass
+        if not keep_open:
+            if conns.get(conn.conn_id) is conn:
+                del conns[conn.conn_id]
+            conn.close()
+
+    def completed(conn, future):
+        try:
+            keep_open = future.result()
+        except Exception as e:
+            print(f"[ERROR] Exception handling remote client {conn.conn_id}: {e}")
+            keep_open = False
+        finished(conn, keep_open)
+
+    while True:
+        frame = channel.recv()
+        if frame is None:
+            break
+        kind, conn_id, data = frame
+        if kind == KIND_REQUEST or kind == KIND_REPLAY:
+            conn = conns.get(conn_id)
+            if conn is None:
+                conn = conns[conn_id] = RemoteConnection(channel, conn_id)
+            replay = kind == KIND_REPLAY
+            if pool is not None:
+                future = pool.submit(conn, run_request, dispatch, conn, data, replay)
+                if not replay:
+                    future.add_done_callback(lambda future, conn=conn: completed(conn, future))
+                if pool.pending(conn) > pool.queue_depth:
+                    wait([future])
+                continue
+            try:
+                keep_open = run_request(dispatch, conn, data, replay)
+            except Exception as e:
+                print(f"[ERROR] Exception handling remote client {conn_id}: {e}")
+                keep_open = replay
+            if not replay:
+                finished(conn, keep_open)
+        elif kind == KIND_WRITTEN:
+            conn = conns.get(conn_id)
+            if conn is not None:
+                conn.report_written(WRITTEN.unpack(data)[0])
+        elif kind == KIND_CLOSE:
+            conn = conns.pop(conn_id, None)
+            if conn is not None:
+                conn.closed = True
+    for conn in list(conns.values()):
+        conn.closed = True
+
+class RoutedClient:
+    # Worker-side end of one client connection: its outbound queue, plus a count of the bytes
+    # the owner routed to it. Once the queue has drained, everything delivered before that is
+    # on the socket and the total goes back to the owner (KIND_WRITTEN). At most one report is
+    # outstanding, so a busy connection sends one per drain rather than one per push.
+    # cursor is the connection's ShardCursor when its requests are spread over several shards
+    def __init__(self, channel, conn_id, out, cursor=None):
+        self.channel = channel
+        self.conn_id = conn_id
+        self.out = out
+        self.cursor = cursor
+        self.lock = threading.Lock()
+        self.delivered = 0
+        self.waiting = False
+
+    def deliver(self, data):
+        self.out.sendall(data)
+        with self.lock:
+            self.delivered += len(data)
+            if self.waiting:
+                return
+            self.waiting = True
+            delivered = self.delivered
+        self.out.when_drained(0, lambda: self.drained(delivered))
+
+    def drained(self, written):
+        try:
+            self.channel.send(KIND_WRITTEN, self.conn_id, WRITTEN.pack(written))
+        except OSError:
+            pass
+        with self.lock:
+            if self.delivered == written:
+                self.waiting = False
+                return
+            delivered = self.delivered
+        self.out.when_drained(0, lambda: self.drained(delivered))
+
+class ShardCursor:
+    # Keeps one connection's replies in request order when its requests go to different
+    # shards: a request may go to another shard than the one before it only once every
+    # request already sent has finished (KIND_DONE), so their replies are queued first
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.shard = 0
+        self.outstanding = 0
+        self.closed = False
+
+    # Wait until a request may go to shard; False once the connection is finished
+    def enter(self, shard):
+        with self.cond:
+            while self.outstanding and shard != self.shard and not self.closed:
+                self.cond.wait()
+            self.shard = shard
+            self.outstanding += 1
+            return not self.closed
+
+    def done(self):
+        with self.cond:
+            self.outstanding -= 1
+            if not self.outstanding:
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+def worker_delivery_loop(channel, clients):
+    # Hand everything the owner routes to this worker's clients to their outbound queues, so
+    # one slow client never holds up deliveries to the others
+    while True:
+        frame = channel.recv()
+        if frame is None:
+            break
+        kind, conn_id, data = frame
+        client = clients.get(conn_id)
+        if client is None:
+            continue
+        if kind == KIND_SEND:
+            try:
+                client.deliver(data)
+            except OSError:
+                pass
+        elif kind == KIND_DONE:
+            client.cursor.done()
+        elif kind == KIND_CLOSE:
+            # The writer flushes pending replies, then shuts the socket down, which also
+            # ends the reader thread
+            clients.pop(conn_id, None)
+            client.out.close()
+            if client.cursor is not None:
+                client.cursor.close()
+        elif kind == KIND_ABORT:
+            clients.pop(conn_id, None)
+            client.out.abort()
+            if client.cursor is not None:
+                client.cursor.close()
+    # Without the owner there is no state to serve
+    os._exit(0)
+
+def worker_client_loop(channels, clients, conn_id, sock, out, addr, read_requests, route=None, cursor=None):
+    # Forward each request to its shard: route(request) names the user whose shard runs it,
+    # None keeps it on the connection's current shard and EVERY_SHARD replays it everywhere
+    print(f"[NEW CONNECTION] {addr} connected (worker {os.getpid()}).")
+    try:
+        for request in read_requests(sock):
+            if cursor is None:
+                channels[0].send(KIND_REQUEST, conn_id, request)
+                continue
+            key = route(request)
+            shard = cursor.shard if key is None or key is EVERY_SHARD else shard_of(key, len(channels))
+            if not cursor.enter(shard):
+                break
+            if key is EVERY_SHARD:
+                for other, channel in enumerate(channels):
+                    if other != shard:
+                        channel.send(KIND_REPLAY, conn_id, request)
+            channels[shard].send(KIND_REQUEST, conn_id, request)
+    except Exception as e:
+        print(f"[ERROR] Exception handling client {addr}: {e}")
+    finally:
+        for channel, routed in zip(channels, clients):
+            if routed.pop(conn_id, None) is not None:
+                channel.send(KIND_CLOSE, conn_id)
+        out.close()
+        print(f"[DISCONNECT] {addr} connection closed.")
+
+def connect_owner(path, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return sock
+        except OSError:
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+def run_worker(host, port, owner_paths, read_requests, route=None):
+    # Every worker binds the same port; the kernel spreads new connections across them. The
+    # worker has a channel to each shard's owner, and every client is known on all of them
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(socket.SOMAXCONN)
+    channels = [Channel(connect_owner(path)) for path in owner_paths]
+    clients = [{} for _ in channels]
+    ids = itertools.count(1)
+    for channel, routed in zip(channels, clients):
+        threading.Thread(target=worker_delivery_loop, args=(channel, routed), daemon=True).start()
+    print(f"[WORKER {os.getpid()}] listening on {host}:{port}")
+    while True:
+        sock, addr = listener.accept()
+        conn_id = next(ids)
+        out = QueuedConnection(sock)
+        cursor = ShardCursor() if len(channels) > 1 else None
+        for channel, routed in zip(channels, clients):
+            routed[conn_id] = RoutedClient(channel, conn_id, out, cursor)
+        threading.Thread(target=worker_client_loop,
+                         args=(channels, clients, conn_id, sock, out, addr, read_requests, route, cursor),
+                         daemon=True).start()
+
+def serve_owner(listener, num_workers, dispatch, pool, report_done):
+    # Accept one channel per worker and serve them until every worker has gone
+    threads = []
+    for _ in range(num_workers):
+        sock, _ = listener.accept()
+        thread = threading.Thread(target=owner_channel_loop,
+                                  args=(Channel(sock), dispatch, pool, report_done), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+def run_multiprocess(port, num_workers, dispatch, read_requests, host="0.0.0.0", shards=1, route=None,
+                     workers=0, queue_depth=DEFAULT_QUEUE_DEPTH):
+    # Fork num_workers I/O processes sharing the port through SO_REUSEPORT. Workers frame
+    # client requests with read_requests(sock) and forward them over Unix sockets to the state
+    # owners, which run dispatch(conn, request) on an OrderedWorkerPool of workers threads
+    # (DEFAULT_OWNER_WORKERS when 0) keyed by connection.
+    # With shards > 1 this process is the owner of shard 0 and forks the others, so commands
+    # run on that many cores. Each request goes to shard_of(route(request)), so everything
+    # about a user's live session (logging in, pushes to them, logging off) happens in one
+    # owner; what the owners share must live in a store every process opens for itself, such
+    # as SqliteStore. A command that pushes to users on other shards (a CMD_BATCH of sends)
+    # leaves those messages unread instead
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT is not available on this platform")
+    if shards > 1 and route is None:
+        raise ValueError("Several shards need a route for each request")
+    tmpdir = tempfile.mkdtemp(prefix="chat-owner-")
+    owner_paths = [os.path.join(tmpdir, f"owner-{shard}.sock") for shard in range(shards)]
+    listeners = []
+    for path in owner_paths:
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(num_workers)
+        listeners.append(listener)
+    pids = []
+    try:
+        for shard in range(1, shards):
+            pid = os.fork()
+            if pid == 0:
+                for other, listener in enumerate(listeners):
+                    if other != shard:
+                        listener.close()
+                try:
+                    pool = OrderedWorkerPool(workers or DEFAULT_OWNER_WORKERS, queue_depth)
+                    serve_owner(listeners[shard], num_workers, dispatch, pool, True)
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for _ in range(num_workers):
+            pid = os.fork()
+            if pid == 0:
+                for listener in listeners:
+                    listener.close()
+                try:
+                    run_worker(host, port, owner_paths, read_requests, route)
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        print(f"[OWNER {os.getpid()}] serving state for {num_workers} workers in {shards} shard(s) on port {port}")
+        pool = OrderedWorkerPool(workers or DEFAULT_OWNER_WORKERS, queue_depth)
+        serve_owner(listeners[0], num_workers, dispatch, pool, shards > 1)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        for listener in listeners:
+            listener.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,281 @@
+import itertools
+import os
+import socket
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+# Pending outbound bytes at which live pushes to a connection stop, and the level its
+# queue has to drain back to before they resume
+DEFAULT_HIGH_WATERMARK = 1 << 20
+DEFAULT_LOW_WATERMARK = 256 << 10
+# unread: store the push as an unread message instead, disconnect: drop the slow client
+SLOW_CONSUMER_POLICIES = ("unread", "disconnect")
+
+# Most buffers the kernel accepts in one sendmsg call
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):  # no sysconf on Windows
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# Drop the first sent bytes from a deque of memoryviews
+def advance(views, sent):
+    while sent:
+        first = views[0]
+        if sent < len(first):
+            views[0] = first[sent:]
+            return
+        sent -= len(first)
+        views.popleft()
+
+# sendall() for a list of buffers on a blocking socket: they go to sendmsg as they are, so
+# a header and its payload (or a whole queue of messages) are written without first being
+# joined into one bytes object. Partial writes resume where the kernel stopped. Sockets
+# without sendmsg (Windows) get a single joined sendall instead
+def send_buffers(sock, buffers):
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    views = deque(memoryview(buf).cast("B") for buf in buffers if len(buf))
+    while views:
+        advance(views, sock.sendmsg(list(itertools.islice(views, IOV_MAX))))
+
+# Send the buffers of one message on any connection object: scatter-gather where the
+# connection supports it (sendmsg), otherwise joined into a single send
+def send_parts(conn, parts):
+    if isinstance(conn, socket.socket):
+        send_buffers(conn, parts)
+    elif hasattr(conn, "sendmsg"):
+        conn.sendmsg(parts)
+    elif hasattr(conn, "sendall"):
+        conn.sendall(b"".join(parts))
+    else:
+        conn.send(b"".join(parts))
+
+# Unsent bytes a streamed reply may leave queued before it pauses for the reader
+STREAM_HIGH_WATERMARK = 256 << 10
+
+# Drain callbacks registered with a connection's when_drained(): takes out and returns the
+# callbacks whose limit pending is now within (all of them once the connection is gone), for
+# the caller to run after releasing its lock
+def take_drained(waiters, pending, gone=False):
+    ready = [callback for limit, callback in waiters if gone or pending <= limit]
+    if ready:
+        waiters[:] = [(limit, callback) for limit, callback in waiters if not gone and pending > limit]
+    return ready
+
+class ReplyStream:
+    # A reply sent as many chunks (see send_stream). pump() queues chunks while the connection
+    # has at most STREAM_HIGH_WATERMARK bytes unsent; past that it asks the connection to call
+    # resume() once it has drained, and returns, so no thread waits for a slow reader. run, if
+    # given, is where the stream continues after a pause (a pool's executor.submit, to keep
+    # store reads off an I/O thread); without it, it continues on the thread that saw the drain.
+    # done is a Future resolved with True once the last chunk is queued
+    def __init__(self, conn, chunks, run=None):
+        self.conn = conn
+        self.chunks = iter(chunks)
+        self.run = run
+        self.done = Future()
+
+    def pump(self):
+        try:
+            while self.conn.pending_bytes() <= STREAM_HIGH_WATERMARK:
+                if self.conn.closed:
+                    raise OSError("Connection closed before the reply was sent.")
+                parts = next(self.chunks, None)
+                if parts is None:
+                    self.done.set_result(True)
+                    return
+                send_parts(self.conn, parts)
+            self.conn.when_drained(STREAM_HIGH_WATERMARK, self.resume)
+        except Exception as e:
+            self.done.set_exception(e)
+
+    def resume(self):
+        if self.run is None:
+            self.pump()
+            return
+        try:
+            self.run(self.pump)
+        except RuntimeError as e:  # the pool has shut down
+            self.done.set_exception(e)
+
+# Send a streamed reply: chunks yields the buffer lists of its frames, produced as they are
+# needed, so a long reply only ever holds a few chunks in memory. Returns True once every
+# chunk is queued. If the reader falls behind on a connection that can call back when it
+# drains (when_drained), the rest of the stream is sent from that callback and the ReplyStream's
+# done Future is returned instead: the caller must not run the connection's next command until
+# it resolves (OrderedWorkerPool and the servers' read loops do that). Connections without
+# when_drained get every chunk at once
+def send_stream(conn, chunks, run=None):
+    if not hasattr(conn, "when_drained"):
+        for parts in chunks:
+            send_parts(conn, parts)
+        return True
+    stream = ReplyStream(conn, chunks, run)
+    stream.pump()
+    if stream.done.done():
+        return stream.done.result()
+    return stream.done
+
+# The outcome of a command run on the caller's thread: its return value, after waiting for a
+# reply it was still streaming (see send_stream)
+def command_result(result):
+    return result.result() if isinstance(result, Future) else result
+
+# Decides whether a live chat push may be queued on a connection. Connections report their
+# backlog through pending_bytes() (a multi-process RemoteConnection counts what its worker has
+# not yet written); anything without it is always admitted. Counters: pushed, dropped_to_unread, disconnected
+class Backpressure:
+    def __init__(self, high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK,
+                 policy="unread"):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow-consumer policy: {policy}")
+        if low_watermark > high_watermark:
+            raise ValueError("Low watermark must not exceed the high watermark.")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.counters = {"pushed": 0, "dropped_to_unread": 0, "disconnected": 0}
+
+    # Returns True if the caller should send the push of size bytes to conn. On False the
+    # caller keeps the message as unread; under the disconnect policy conn has been aborted
+    def admit(self, conn, size):
+        pending_bytes = getattr(conn, "pending_bytes", None)
+        if pending_bytes is None:
+            with self.lock:
+                self.counters["pushed"] += 1
+            return True
+        pending = pending_bytes()
+        with self.lock:
+            # Once over the high watermark, stay throttled until the backlog drains to the low one
+            if conn.throttled and pending <= self.low_watermark:
+                conn.throttled = False
+            elif not conn.throttled and pending + size > self.high_watermark:
+                conn.throttled = True
+                print(f"[BACKPRESSURE] {pending} bytes pending on a connection, policy: {self.policy}")
+            if not conn.throttled:
+                self.counters["pushed"] += 1
+                return True
+            if self.policy == "disconnect":
+                self.counters["disconnected"] += 1
+            else:
+                self.counters["dropped_to_unread"] += 1
+        if self.policy == "disconnect":
+            conn.abort()
+        return False
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+class QueuedConnection:
+    # Outbound side of a blocking socket: send()/sendall() only append to a per-connection
+    # queue and a dedicated writer thread drains it. A command handler pushing a chat
+    # message to another user therefore never waits on that user's socket, and one stalled
+    # reader only delays its own queue. Reads still go to the underlying socket directly.
+    def __init__(self, sock):
+        self.sock = sock
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.pending = 0  # bytes queued or being written
+        self.throttled = False  # see Backpressure.admit
+        self.drain_waiters = []  # (limit, callback), see when_drained
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def sendall(self, data):
+        with self.cond:
+            if self.closed:
+                raise OSError("Connection already closed.")
+            self.queue.append(data)
+            self.pending += len(data)
+            self.cond.notify()
+
+    # Queue the buffers of one message as they are; the writer hands them to sendmsg
+    def sendmsg(self, buffers):
+        with self.cond:
+            if self.closed:
+                raise OSError("Connection already closed.")
+            self.queue.extend(buffers)
+            self.pending += sum(len(buf) for buf in buffers)
+            self.cond.notify()
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def close(self):
+        # Stop accepting data; the writer flushes what is queued and then closes the socket
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def pending_bytes(self):
+        with self.cond:
+            return self.pending
+
+    # Call callback() once at most limit bytes are still unsent, or the connection is gone:
+    # right away if that is already so, otherwise from the writer thread
+    def when_drained(self, limit, callback):
+        with self.cond:
+            if self.pending > limit and not self.closed:
+                self.drain_waiters.append((limit, callback))
+                return
+        callback()
+
+    # Drop whatever is queued and cut the connection without waiting for the peer to read;
+    # shutting the socket down also unblocks a writer stuck in sendall() and the reader thread
+    def abort(self):
+        with self.cond:
+            self.closed = True
+            self.queue.clear()
+            self.pending = 0
+            self.cond.notify()
+            drained = take_drained(self.drain_waiters, 0, gone=True)
+        for callback in drained:
+            callback()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                # Everything queued so far goes out in one scatter-gather write, without copying
+                batch = list(self.queue)
+                self.queue.clear()
+            written = sum(len(buf) for buf in batch)
+            try:
+                send_buffers(self.sock, batch)
+            except OSError:
+                with self.cond:
+                    self.closed = True
+                    self.queue.clear()
+                    self.pending = 0
+                    self.cond.notify_all()
+                break
+            with self.cond:
+                self.pending = max(0, self.pending - written)
+                self.cond.notify_all()
+                drained = take_drained(self.drain_waiters, self.pending)
+            for callback in drained:
+                callback()
+        with self.cond:
+            drained = take_drained(self.drain_waiters, 0, gone=True)
+        for callback in drained:
+            callback()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
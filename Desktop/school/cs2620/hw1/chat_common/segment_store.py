@@ -0,0 +1,304 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+
+from chat_common.concurrency import conv_lock_key, user_lock_key
+from chat_common.history import HISTORY_PAGE_SIZE, window_bounds
+from chat_common.snapshot import DEFAULT_SNAPSHOT_EVERY
+from chat_common.store import MemoryStore
+from chat_common.wal import DEFAULT_COMMIT_WINDOW, unread_record
+
+# Each record is its body length and CRC-32, then the body: kind and message ID, the two
+# usernames of the conversation and, for a message, its sender, timestamp and text. Strings
+# are UTF-8 behind a length (SHORT for names and timestamps, LONG for the text)
+RECORD_HEADER = struct.Struct("!II")
+RECORD_BODY = struct.Struct("!BQ")
+SHORT = struct.Struct("!H")
+LONG = struct.Struct("!I")
+MESSAGE = 0
+DELETE = 1
+
+# Segment files are created at this size (sparse) and mapped whole; a message too big for one
+# gets a segment of its own size
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+# A message's location in the index: segment number above these bits, byte offset below
+OFFSET_BITS = 40
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+
+def segment_file(directory, number):
+    return os.path.join(directory, f"{number:06d}.seg")
+
+def encode_string(value, length=SHORT):
+    data = value.encode("utf-8")
+    return length.pack(len(data)) + data
+
+def read_string(view, pos, length=SHORT):
+    (size,) = length.unpack_from(view, pos)
+    pos += length.size
+    return str(view[pos:pos + size], "utf-8"), pos + size
+
+def encode_record(kind, msg_id, conv_key, sender="", timestamp="", message=""):
+    body = RECORD_BODY.pack(kind, msg_id) + encode_string(conv_key[0]) + encode_string(conv_key[1])
+    if kind == MESSAGE:
+        body += encode_string(sender) + encode_string(timestamp) + encode_string(message, LONG)
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+# Kind, ID and conversation of a record body, and where the rest of it starts
+def decode_head(view):
+    kind, msg_id = RECORD_BODY.unpack_from(view, 0)
+    user1, pos = read_string(view, RECORD_BODY.size)
+    user2, pos = read_string(view, pos)
+    return kind, msg_id, (user1, user2), pos
+
+# The message entry held in a record body
+def decode_entry(view):
+    _, msg_id, _, pos = decode_head(view)
+    sender, pos = read_string(view, pos)
+    timestamp, pos = read_string(view, pos)
+    message, _ = read_string(view, pos, LONG)
+    return {"id": msg_id, "sender": sender, "message": message, "timestamp": timestamp}
+
+class Segment:
+    # One preallocated segment file, mapped into memory; records are copied in at tail and read
+    # back as slices of the map, so reads come straight from the page cache
+    def __init__(self, path, size):
+        self.path = path
+        self.file = open(path, "a+b")
+        if os.path.getsize(path) < size:
+            self.file.truncate(size)
+        self.size = os.path.getsize(path)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.view = memoryview(self.map)
+        self.tail = 0
+        # Everything before synced has been msynced; sync_lock lets one caller msync for all
+        self.synced = 0
+        self.sync_lock = threading.Lock()
+
+    # Walk the intact records from the start, calling found(offset, body) for each; stops at
+    # the unwritten (zeroed) rest of the file or at a torn record, where the next append goes
+    def scan(self, found):
+        pos = 0
+        while pos + RECORD_HEADER.size <= self.size:
+            length, crc = RECORD_HEADER.unpack_from(self.map, pos)
+            end = pos + RECORD_HEADER.size + length
+            if length == 0 or end > self.size:
+                break
+            body = self.view[pos + RECORD_HEADER.size:end]
+            if zlib.crc32(body) != crc:
+                break
+            found(pos, body)
+            pos = end
+        self.tail = pos
+        self.synced = pos
+
+    def write(self, data):
+        offset = self.tail
+        self.map[offset:offset + len(data)] = data
+        self.tail += len(data)
+        return offset
+
+    # Return once the bytes before end are on disk. Callers queue on sync_lock, and whoever
+    # gets it msyncs everything written so far, so writers that arrived meanwhile find their
+    # records already covered and skip their own msync (group commit, as in the WAL)
+    def sync_to(self, end):
+        with self.sync_lock:
+            if self.synced >= end:
+                return
+            tail = self.tail
+            # msync wants a page-aligned start
+            start = self.synced - self.synced % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(start, tail - start)
+            self.synced = tail
+
+    def body(self, offset):
+        (length,) = LONG.unpack_from(self.map, offset)
+        start = offset + RECORD_HEADER.size
+        return self.view[start:start + length]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # A history slice is still out there; the map goes when it does
+            pass
+        self.file.close()
+
+class SegmentStore(MemoryStore):
+    # The store interface (see chat_common.store) with the histories in append-only segment
+    # files under directory instead of the Python heap. A message is one record appended to the
+    # newest segment; all that stays in memory is, per conversation, an array('Q') of message
+    # IDs and a parallel one of record locations (16 bytes a message), rebuilt by scanning the
+    # segments on open. view_conv finds its window by binary search on the IDs and reads the
+    # records as memoryview slices of the maps (body_at), decoding only those.
+    # Deleting a message appends a tombstone record; the space is not reclaimed.
+    # Accounts and unread messages stay in MemoryStore's dicts, durable with wal_path as
+    # there; their log records carry the whole message, which the dicts no longer hold.
+    # sync: msync each record before post() returns (without it a record survives a server
+    # crash, not a machine crash). The msync runs after the conversation lock is released and
+    # covers every record written so far, so concurrent posts share one (see Segment.sync_to)
+    def __init__(self, directory, wal_path=None, commit_window=DEFAULT_COMMIT_WINDOW,
+                 snapshot_every=DEFAULT_SNAPSHOT_EVERY, segment_bytes=DEFAULT_SEGMENT_BYTES, sync=True):
+        super().__init__(wal_path, commit_window, snapshot_every)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.sync = sync
+        self.waits_on_disk = sync or self.wal is not None
+        # Maps a conversation key to its (IDs, locations) arrays, both in ID order
+        self.index = {}
+        self.segments = []
+        # Guards the newest segment's tail and the segment list
+        self.append_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        numbers = sorted(int(name[:-4]) for name in os.listdir(directory)
+                         if name.endswith(".seg") and name[:-4].isdigit())
+        for i, number in enumerate(numbers):
+            segment = Segment(segment_file(directory, number), segment_bytes)
+            self.segments.append(segment)
+            segment.scan(lambda offset, body: self.restore(i, offset, body))
+        # Locations number the segments by their place in self.segments, files by this
+        self.next_number = numbers[-1] + 1 if numbers else 0
+        if not self.segments:
+            self.new_segment(segment_bytes)
+        messages = sum(len(ids) for ids, _ in self.index.values())
+        print(f"[STORE] Indexed {messages} messages in {len(self.index)} conversations from "
+              f"{len(self.segments)} segments in {directory}")
+
+    # Redo one record found while scanning the segments
+    def restore(self, segment, offset, body):
+        kind, msg_id, conv_key, _ = decode_head(body)
+        if kind == MESSAGE:
+            ids, locations = self.index.setdefault(conv_key, (array("Q"), array("Q")))
+            ids.append(msg_id)
+            locations.append(segment << OFFSET_BITS | offset)
+            self.message_ids.advance_past(msg_id)
+        elif kind == DELETE:
+            self.unindex(conv_key, msg_id)
+
+    # Drop a message from its conversation's arrays; False if it isn't there
+    def unindex(self, conv_key, msg_id):
+        ids, locations = self.index.get(conv_key, ((), ()))
+        i = bisect.bisect_left(ids, msg_id)
+        if i == len(ids) or ids[i] != msg_id:
+            return False
+        del ids[i]
+        del locations[i]
+        return True
+
+    # Append an encoded record, starting a new segment when it doesn't fit; returns its location.
+    # Pass it to wait_synced, once no lock is held, before acknowledging the change
+    def append(self, data):
+        with self.append_lock:
+            segment = self.segments[-1]
+            if segment.tail + len(data) > segment.size:
+                segment = self.new_segment(max(self.segment_bytes, len(data)))
+            return (len(self.segments) - 1) << OFFSET_BITS | segment.write(data)
+
+    # With sync, block until the record at location (and all before it) is msynced
+    def wait_synced(self, location):
+        if self.sync:
+            segment = self.segments[location >> OFFSET_BITS]
+            offset = location & OFFSET_MASK
+            (length,) = LONG.unpack_from(segment.map, offset)
+            segment.sync_to(offset + RECORD_HEADER.size + length)
+
+    def new_segment(self, size):
+        segment = Segment(segment_file(self.directory, self.next_number), size)
+        self.next_number += 1
+        self.segments.append(segment)
+        return segment
+
+    def body_at(self, location):
+        return self.segments[location >> OFFSET_BITS].body(location & OFFSET_MASK)
+
+    def post(self, conv_key, sender, message, timestamp):
+        # Allocate the ID under the conversation lock so each index stays sorted by ID
+        with self.locks.holding(conv_lock_key(conv_key)):
+            msg_id = self.message_ids.allocate()
+            location = self.append(encode_record(MESSAGE, msg_id, conv_key, sender, timestamp, message))
+            ids, locations = self.index.setdefault(conv_key, (array("Q"), array("Q")))
+            ids.append(msg_id)
+            locations.append(location)
+        self.wait_synced(location)
+        return {"id": msg_id, "sender": sender, "message": message, "timestamp": timestamp}
+
+    def add_unread(self, username, conv_key, entry):
+        seq = 0
+        with self.locks.holding(user_lock_key(username)):
+            if username in self.users:
+                self.users[username]["messages"].append(entry)
+                seq = self.log_event(unread_record(username, conv_key, entry["id"], entry))
+        self.wait_durable(seq)
+
+    def conversation_keys(self):
+        return list(self.index)
+
+    def has_conversation(self, conv_key):
+        return conv_key in self.index
+
+    def conversation_holds(self, conv_key, ids):
+        conv_ids = self.index.get(conv_key, ((), ()))[0]
+        for msg_id in ids:
+            i = bisect.bisect_left(conv_ids, msg_id)
+            if i < len(conv_ids) and conv_ids[i] == msg_id:
+                return True
+        return False
+
+    # The tombstones are the log here: nothing goes to the write-ahead log. This runs under the
+    # conversation lock, so unlike post() a delete msyncs its tombstones while holding it;
+    # deletes are rare next to posts
+    def remove_from_conversation(self, conv_key, ids):
+        location = None
+        for msg_id in sorted(ids):
+            if self.unindex(conv_key, msg_id):
+                location = self.append(encode_record(DELETE, msg_id, conv_key))
+        if location is not None:
+            self.wait_synced(location)
+        return 0
+
+    def has_history(self, conv_key):
+        return bool(self.index.get(conv_key, ((), ()))[0])
+
+    def history(self, conv_key, since_id=None, before_id=None, limit=0):
+        with self.locks.holding(conv_lock_key(conv_key)):
+            ids, locations = self.index.get(conv_key, ((), ()))
+            start, end = window_bounds(ids, since_id, before_id, limit, key=None)
+            locations = locations[start:end]
+        return [decode_entry(self.body_at(location)) for location in locations]
+
+    # As chat_common.history.history_pages: the window is fixed by ID on the first page, and
+    # each page's locations are copied under the conversation lock on their own
+    def history_pages(self, conv_key, since_id=None, before_id=None, limit=0, page_size=HISTORY_PAGE_SIZE):
+        with self.locks.holding(conv_lock_key(conv_key)):
+            ids, locations = self.index.get(conv_key, ((), ()))
+            start, end = window_bounds(ids, since_id, before_id, limit, key=None)
+            if start >= end:
+                return
+            before_id = ids[end - 1] + 1
+            locations = locations[start:min(end, start + page_size)]
+        while locations:
+            page = [decode_entry(self.body_at(location)) for location in locations]
+            yield page
+            with self.locks.holding(conv_lock_key(conv_key)):
+                ids, locations = self.index.get(conv_key, ((), ()))
+                start, end = window_bounds(ids, page[-1]["id"], before_id, key=None)
+                locations = locations[start:min(end, start + page_size)]
+
+    def stats(self):
+        stats = super().stats()
+        stats["conversations"] = len(self.index)
+        stats["messages"] = sum(len(ids) for ids, _ in list(self.index.values()))
+        stats["segments"] = len(self.segments)
+        stats["index_bytes"] = sum(ids.itemsize * len(ids) * 2 for ids, _ in list(self.index.values()))
+        return stats
+
+    def close(self):
+        super().close()
+        with self.append_lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
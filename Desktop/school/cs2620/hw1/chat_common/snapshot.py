@@ -0,0 +1,173 @@
+import json
+import os
+import threading
+import time
+
+from chat_common.message import Message, json_default
+from chat_common.wal import WriteAheadLog, DEFAULT_COMMIT_WINDOW, apply_record
+
+# Log records between automatic snapshots; replay after a restart never reads more than this
+DEFAULT_SNAPSHOT_EVERY = 100000
+
+def snapshot_path(wal_path):
+    return wal_path + ".snapshot"
+
+# The whole state as one JSON document, written to a temporary file and renamed into place so
+# a crash mid-write leaves the previous snapshot intact. segment is the first log segment the
+# snapshot does not cover. json.dumps rather than json.dump: only the former uses the C encoder
+def write_snapshot(path, segment, users, conversations, next_id):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"segment": segment, "next_id": next_id, "users": users,
+                            "conversations": [[list(conv_key), conv] for conv_key, conv in conversations.items()]},
+                           separators=(",", ":"), default=json_default))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# Load a snapshot into the (empty) state; returns the segment replay should start from.
+# The snapshot spells out unread messages in full; they are matched back to the history's
+# Message objects by ID so the two share them again
+def load_snapshot(path, users, conversations, message_ids):
+    if not os.path.exists(path):
+        return 0
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    unread_ids = {entry["id"] for user in data["users"].values() for entry in user["messages"]}
+    shared = {}
+    for conv_key, conv in data["conversations"]:
+        conv = [Message.from_fields(entry) for entry in conv]
+        conversations[tuple(conv_key)] = conv
+        shared.update((msg.id, msg) for msg in conv if msg.id in unread_ids)
+    for user in data["users"].values():
+        user["messages"] = [shared.get(entry["id"]) or Message.from_fields(entry) for entry in user["messages"]]
+    users.update(data["users"])
+    message_ids.advance_past(data["next_id"] - 1)
+    return data["segment"]
+
+class Snapshotter:
+    # Snapshots the state without stopping the server. With every writer held off for just
+    # long enough, it starts a new log segment and forks; the child writes its copy-on-write
+    # view of the state while the parent keeps serving, and once the snapshot is on disk the
+    # segments it covers are deleted. Without fork (Windows) the snapshot is written in place,
+    # writers waiting. every: log records between automatic snapshots (0: only when asked).
+    # Automatic snapshots are started by a background thread, never by the request that crossed
+    # the threshold, which may be running on an event loop
+    def __init__(self, path, wal, locks, users, conversations, message_ids, every=DEFAULT_SNAPSHOT_EVERY):
+        self.path = path
+        self.wal = wal
+        self.locks = locks
+        self.users = users
+        self.conversations = conversations
+        self.message_ids = message_ids
+        self.every = every
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.last_seq = 0
+        self.taken = 0
+        self.failed = 0
+        self.pause_ms = 0.0      # how long writers were held off for the last snapshot
+        self.write_ms = 0.0      # ... and how long it took to reach the disk
+        self.wanted = threading.Event()
+        self.stopping = False
+        self.trigger = None
+        if every:
+            self.trigger = threading.Thread(target=self.trigger_loop, daemon=True)
+            self.trigger.start()
+
+    # Called with a logged record's sequence number, outside every state lock; only wakes the
+    # trigger thread
+    def maybe_snapshot(self, seq):
+        if self.every and seq - self.last_seq >= self.every:
+            self.wanted.set()
+
+    def trigger_loop(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            if self.stopping:
+                return
+            self.snapshot()
+
+    # Start a snapshot; False if one is already being written
+    def snapshot(self):
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+        start = time.perf_counter()
+        pid = None
+        with self.locks.holding_all():
+            segment, seq = self.wal.rotate()
+            next_id = self.message_ids.next_id
+            if hasattr(os, "fork"):
+                pid = os.fork()
+                if pid == 0:
+                    # Only this thread exists in the child; it never touches the locks or the log
+                    code = 1
+                    try:
+                        write_snapshot(self.path, segment, self.users, self.conversations, next_id)
+                        code = 0
+                    finally:
+                        os._exit(code)
+            else:
+                write_snapshot(self.path, segment, self.users, self.conversations, next_id)
+        self.pause_ms = (time.perf_counter() - start) * 1000
+        self.last_seq = seq
+        self.thread = threading.Thread(target=self.finish, args=(pid, segment, seq, start), daemon=True)
+        self.thread.start()
+        return True
+
+    def finish(self, pid, segment, seq, start):
+        ok = True
+        if pid is not None:
+            _, status = os.waitpid(pid, 0)
+            ok = status == 0
+        if ok:
+            # The switch to the new segment is on disk before the old ones go
+            self.wal.wait(seq)
+            self.wal.remove_segments_before(segment)
+        with self.lock:
+            self.write_ms = (time.perf_counter() - start) * 1000
+            if ok:
+                self.taken += 1
+            else:
+                self.failed += 1
+            self.running = False
+        if not ok:
+            print(f"[SNAPSHOT] Writing {self.path} failed; keeping the log")
+
+    # Block until the snapshot being written (if any) is done
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    # Stop taking automatic snapshots and wait for the one being written
+    def close(self):
+        self.stopping = True
+        self.wanted.set()
+        if self.trigger is not None:
+            self.trigger.join()
+        self.wait()
+
+    def stats(self):
+        with self.lock:
+            return {"snapshots": self.taken, "failed": self.failed, "pause_ms": round(self.pause_ms, 1),
+                    "write_ms": round(self.write_ms, 1)}
+
+# Rebuild the state from the latest snapshot plus the log after it, then open the log for
+# appending. Returns the log and the Snapshotter that keeps it short
+def open_durable_state(wal_path, locks, users, conversations, message_ids,
+                       commit_window=DEFAULT_COMMIT_WINDOW, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+    start = time.perf_counter()
+    path = snapshot_path(wal_path)
+    segment = load_snapshot(path, users, conversations, message_ids)
+    wal = WriteAheadLog(wal_path, commit_window)
+    # Segments a finished snapshot covers but a crash left behind
+    wal.remove_segments_before(segment)
+    restored = wal.replay(lambda record: apply_record(record, users, conversations, message_ids), segment)
+    print(f"[WAL] Restored {'snapshot and ' if segment else ''}{restored} log records from {wal_path} "
+          f"in {time.perf_counter() - start:.2f}s")
+    wal.start()
+    return wal, Snapshotter(path, wal, locks, users, conversations, message_ids, snapshot_every)
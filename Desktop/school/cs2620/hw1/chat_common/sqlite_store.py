@@ -0,0 +1,252 @@
+import fnmatch
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from chat_common.history import HISTORY_PAGE_SIZE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    password_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user1 TEXT NOT NULL,
+    user2 TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (user1, user2, id);
+CREATE TABLE IF NOT EXISTS unread (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS unread_by_recipient ON unread (recipient, seq);
+"""
+
+# Connections kept open between calls; a burst of more concurrent calls opens extra ones that
+# are closed as they are returned
+DEFAULT_POOL_SIZE = 4
+
+# Upper bound for "no before_id", so every history query is one of a few fixed statements
+MAX_ID = (1 << 63) - 1
+
+# The fixed statements; sqlite3 keeps each connection's prepared statements cached by their text
+USER_EXISTS = "SELECT 1 FROM users WHERE name = ?"
+HAS_HISTORY = "SELECT 1 FROM messages WHERE user1 = ? AND user2 = ? LIMIT 1"
+HISTORY_COLUMNS = "SELECT id, sender, message, timestamp FROM messages"
+IN_CONVERSATION = "user1 = ? AND user2 = ? AND id > ? AND id < ?"
+OLDEST_FIRST = f"{HISTORY_COLUMNS} WHERE {IN_CONVERSATION} ORDER BY id LIMIT ?"
+NEWEST_FIRST = f"{HISTORY_COLUMNS} WHERE {IN_CONVERSATION} ORDER BY id DESC LIMIT ?"
+WINDOW_OLDEST = f"SELECT MIN(id), MAX(id) FROM (SELECT id FROM messages WHERE {IN_CONVERSATION} ORDER BY id LIMIT ?)"
+WINDOW_NEWEST = f"SELECT MIN(id), MAX(id) FROM (SELECT id FROM messages WHERE {IN_CONVERSATION} ORDER BY id DESC LIMIT ?)"
+UNREAD_COLUMNS = "SELECT seq, message_id, sender, message, timestamp FROM unread WHERE recipient = ? ORDER BY seq"
+
+def history_entry(row):
+    return {"id": row[0], "sender": row[1], "message": row[2], "timestamp": row[3]}
+
+def unread_entry(row):
+    return {"id": row[1], "sender": row[2], "message": row[3], "timestamp": row[4]}
+
+class SqliteStore:
+    # The store interface (see chat_common.store) on a SQLite database, so the data no longer
+    # has to fit in memory. The database runs in WAL mode: readers never wait for the writer,
+    # and a commit is one append to the WAL file. Histories are read through the (user1, user2, id)
+    # index and unread messages through (recipient, seq), so view_conv, read with a limit and
+    # delete_msg touch only the rows they return. Each call borrows a connection from a pool of
+    # at most pool_size idle ones, so client threads coming and going don't leave connections
+    # (and their file descriptors) behind; changes that read before they write run in BEGIN
+    # IMMEDIATE transactions so they can't interleave.
+    # Unread rows carry a copy of the message, so deleting it from the history leaves them, as in
+    # MemoryStore. synchronous: "FULL" syncs every commit, "NORMAL" only at WAL checkpoints
+    def __init__(self, path, synchronous="FULL", pool_size=DEFAULT_POOL_SIZE):
+        self.path = path
+        self.synchronous = synchronous
+        self.pool_size = pool_size
+        self.waits_on_disk = True
+        # Other processes may open the same database (see run_multiprocess)
+        self.shareable = True
+        self.lock = threading.Lock()
+        self.connections = []    # every open connection
+        self.idle = []           # ... and the ones not lent out
+        with self.db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    # Borrow a connection for the duration of a with block
+    @contextmanager
+    def db(self):
+        with self.lock:
+            db = self.idle.pop() if self.idle else None
+        if db is None:
+            # isolation_level=None: statements commit on their own unless inside transaction()
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute(f"PRAGMA synchronous={self.synchronous}")
+            with self.lock:
+                self.connections.append(db)
+        try:
+            yield db
+        finally:
+            with self.lock:
+                keep = db in self.connections and len(self.idle) < self.pool_size
+                if keep:
+                    self.idle.append(db)
+                elif db in self.connections:
+                    self.connections.remove(db)
+            if not keep:
+                db.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    # Run one statement and fetch its first row
+    def fetchone(self, sql, params=()):
+        with self.db() as db:
+            return db.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self.db() as db:
+            return db.execute(sql, params).fetchall()
+
+    def execute(self, sql, params=()):
+        with self.db() as db:
+            return db.execute(sql, params)
+
+    def has_user(self, username):
+        return self.fetchone(USER_EXISTS, (username,)) is not None
+
+    def create_user(self, username, password_hash):
+        cursor = self.execute("INSERT OR IGNORE INTO users (name, password_hash) VALUES (?, ?)",
+                              (username, password_hash))
+        return cursor.rowcount == 1
+
+    def password_hash(self, username):
+        row = self.fetchone("SELECT password_hash FROM users WHERE name = ?", (username,))
+        return row[0] if row is not None else None
+
+    def unread_count(self, username):
+        return self.fetchone("SELECT COUNT(*) FROM unread WHERE recipient = ?", (username,))[0]
+
+    def match_users(self, wildcard):
+        names = [row[0] for row in self.fetchall("SELECT name FROM users ORDER BY id")]
+        return fnmatch.filter(names, wildcard)
+
+    def delete_user(self, username):
+        with self.transaction() as db:
+            if db.execute("DELETE FROM users WHERE name = ?", (username,)).rowcount == 0:
+                return False
+            db.execute("DELETE FROM unread WHERE recipient = ?", (username,))
+        return True
+
+    def post(self, conv_key, sender, message, timestamp):
+        cursor = self.execute(
+            "INSERT INTO messages (user1, user2, sender, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+            (conv_key[0], conv_key[1], sender, message, timestamp))
+        return {"id": cursor.lastrowid, "sender": sender, "message": message, "timestamp": timestamp}
+
+    def add_unread(self, username, conv_key, entry):
+        self.execute(
+            "INSERT INTO unread (recipient, message_id, sender, message, timestamp) "
+            f"SELECT ?, ?, ?, ?, ? WHERE EXISTS ({USER_EXISTS})",
+            (username, entry["id"], entry["sender"], entry["message"], entry["timestamp"], username))
+
+    def take_unread(self, username, limit):
+        with self.transaction() as db:
+            if db.execute(USER_EXISTS, (username,)).fetchone() is None:
+                return None
+            rows = db.execute(f"{UNREAD_COLUMNS} LIMIT ?", (username, limit if limit and limit > 0 else -1)).fetchall()
+            if rows:
+                db.execute("DELETE FROM unread WHERE recipient = ? AND seq <= ?", (username, rows[-1][0]))
+        return [unread_entry(row) for row in rows]
+
+    def mark_read_from(self, username, sender):
+        self.execute("DELETE FROM unread WHERE recipient = ? AND sender = ?", (username, sender))
+
+    def delete_messages(self, username, ids):
+        ids = set(ids)
+        with self.transaction() as db:
+            found = any(
+                db.execute("SELECT 1 FROM unread WHERE recipient = ? AND message_id = ?", (username, msg_id)).fetchone()
+                or db.execute("SELECT 1 FROM messages WHERE id = ? AND (user1 = ? OR user2 = ?)",
+                              (msg_id, username, username)).fetchone()
+                for msg_id in ids)
+            if not found:
+                return False
+            db.executemany("DELETE FROM unread WHERE recipient = ? AND message_id = ?",
+                           [(username, msg_id) for msg_id in ids])
+            db.executemany("DELETE FROM messages WHERE id = ? AND (user1 = ? OR user2 = ?)",
+                           [(msg_id, username, username) for msg_id in ids])
+        return True
+
+    def delete_from_conversation(self, conv_key, ids):
+        with self.transaction() as db:
+            if db.execute(HAS_HISTORY, conv_key).fetchone() is None:
+                return False
+            db.executemany("DELETE FROM messages WHERE id = ? AND user1 = ? AND user2 = ?",
+                           [(msg_id, conv_key[0], conv_key[1]) for msg_id in set(ids)])
+        return True
+
+    def delete_unread_at(self, username, indices):
+        with self.transaction() as db:
+            if db.execute(USER_EXISTS, (username,)).fetchone() is None:
+                return False
+            seqs = [row[0] for row in db.execute("SELECT seq FROM unread WHERE recipient = ? ORDER BY seq", (username,))]
+            db.executemany("DELETE FROM unread WHERE seq = ?", [(seqs[i],) for i in set(indices) if 0 <= i < len(seqs)])
+        return True
+
+    def has_history(self, conv_key):
+        return self.fetchone(HAS_HISTORY, conv_key) is not None
+
+    # Same window as history_window: limit keeps the oldest messages, or the newest with before_id
+    def history(self, conv_key, since_id=None, before_id=None, limit=0):
+        params = (conv_key[0], conv_key[1], since_id or 0, before_id or MAX_ID, limit if limit and limit > 0 else -1)
+        if before_id and limit and limit > 0:
+            return [history_entry(row) for row in reversed(self.fetchall(NEWEST_FIRST, params))]
+        return [history_entry(row) for row in self.fetchall(OLDEST_FIRST, params)]
+
+    # The window is fixed by ID on the first query, then read page_size rows at a time
+    def history_pages(self, conv_key, since_id=None, before_id=None, limit=0, page_size=HISTORY_PAGE_SIZE):
+        params = (conv_key[0], conv_key[1], since_id or 0, before_id or MAX_ID, limit if limit and limit > 0 else -1)
+        window = WINDOW_NEWEST if before_id and limit and limit > 0 else WINDOW_OLDEST
+        first, last = self.fetchone(window, params)
+        if first is None:
+            return
+        after = first - 1
+        while True:
+            # A connection per page, so a slow reader doesn't hold one between pages
+            page = [history_entry(row) for row in
+                    self.fetchall(OLDEST_FIRST, (conv_key[0], conv_key[1], after, last + 1, page_size))]
+            if not page:
+                return
+            yield page
+            after = page[-1]["id"]
+
+    def stats(self):
+        with self.db() as db:
+            return {"users": db.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+                    "messages": db.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+                    "unread": db.execute("SELECT COUNT(*) FROM unread").fetchone()[0],
+                    "connections": len(self.connections)}
+
+    # Close the idle connections; one still lent out is closed when it comes back
+    def close(self):
+        with self.lock:
+            for db in self.idle:
+                db.close()
+            self.idle = []
+            self.connections = []
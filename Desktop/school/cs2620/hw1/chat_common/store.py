@@ -0,0 +1,230 @@
+import fnmatch
+from collections import OrderedDict
+
+from chat_common.concurrency import StripedLock, IdAllocator, user_lock_key, conv_lock_key
+from chat_common.history import HISTORY_PAGE_SIZE, history_window, history_pages
+from chat_common.message import Message
+from chat_common.wal import (DEFAULT_COMMIT_WINDOW, create_record, delete_user_record, post_record,
+                             unread_record, drop_unread_record, delete_conv_record)
+from chat_common.snapshot import DEFAULT_SNAPSHOT_EVERY, open_durable_state
+
+# Accounts, conversation histories and unread messages, behind the command handlers of both
+# servers. A store is safe to call from any thread, and every change is durable (as far as
+# the store goes) once the call returns, so a handler can reply right after it. Message
+# entries are dicts with "id", "sender", "message" and "timestamp"; conversations are keyed by
+# the sorted tuple of the two usernames, and histories come back in ID order.
+#
+#   has_user(username), create_user(username, password_hash) -> False if taken,
+#   password_hash(username) -> None if unknown, unread_count(username), match_users(wildcard),
+#   delete_user(username) -> False if unknown
+#   post(conv_key, sender, message, timestamp) -> the new entry, with its ID
+#   add_unread(username, conv_key, entry), take_unread(username, limit) -> None if unknown,
+#   mark_read_from(username, sender)
+#   delete_messages(username, ids) -> False if none of them is the user's: removes them from
+#   the user's unread messages and conversations
+#   delete_from_conversation(conv_key, ids) -> False if there is no such conversation
+#   delete_unread_at(username, indices) -> False if unknown
+#   has_history(conv_key), history(conv_key, since_id, before_id, limit) (see history_window),
+#   history_pages(conv_key, since_id, before_id, limit, page_size)
+#   stats(), close()
+#   waits_on_disk: True if calls block on disk writes (event-loop servers then run commands
+#   on a worker pool, see durable_pool_size)
+#
+# MemoryStore keeps everything in dicts; SqliteStore (chat_common.sqlite_store) in a database;
+# SegmentStore (chat_common.segment_store) keeps the histories in memory-mapped files
+
+class MemoryStore:
+    # wal_path: make the dicts durable with a write-ahead log and background snapshots (see
+    # open_durable_state). Changes are logged under the lock that orders them and waited for
+    # after it is released
+    def __init__(self, wal_path=None, commit_window=DEFAULT_COMMIT_WINDOW, snapshot_every=DEFAULT_SNAPSHOT_EVERY):
+        # Maps usernames to their data (password hash and unread messages)
+        self.users = OrderedDict()
+        # Maps a sorted tuple of two usernames to a list of Messages (conversation history); a
+        # user's unread list holds the same Message objects
+        self.conversations = {}
+        # Global allocator for unique message IDs, safe to call from any thread
+        self.message_ids = IdAllocator()
+        # Striped locks keyed by ("user", name) and ("conv", conv_key) guard the state above
+        self.locks = StripedLock()
+        self.wal = None
+        self.snapshots = None
+        if wal_path:
+            self.wal, self.snapshots = open_durable_state(wal_path, self.locks, self.users, self.conversations,
+                                                          self.message_ids, commit_window, snapshot_every)
+        # Calls block until their change is on disk, so an event loop must not make them
+        self.waits_on_disk = self.wal is not None
+
+    # Append a change to the write-ahead log, if there is one, while its lock is still held.
+    # Returns the sequence number to hand to wait_durable (0: nothing to wait for)
+    def log_event(self, record):
+        return self.wal.append(record) if self.wal is not None else 0
+
+    # Block until the logged changes up to seq are on disk; call after releasing the locks
+    def wait_durable(self, seq):
+        if seq:
+            self.wal.wait(seq)
+            self.snapshots.maybe_snapshot(seq)
+
+    def has_user(self, username):
+        return username in self.users
+
+    def create_user(self, username, password_hash):
+        seq = 0
+        with self.locks.holding(user_lock_key(username)):
+            created = username not in self.users
+            if created:
+                self.users[username] = {"password_hash": password_hash, "messages": []}
+                seq = self.log_event(create_record(username, password_hash))
+        self.wait_durable(seq)
+        return created
+
+    def password_hash(self, username):
+        user = self.users.get(username)
+        return user["password_hash"] if user is not None else None
+
+    def unread_count(self, username):
+        user = self.users.get(username)
+        return len(user["messages"]) if user is not None else 0
+
+    def match_users(self, wildcard):
+        return fnmatch.filter(list(self.users.keys()), wildcard)
+
+    def delete_user(self, username):
+        seq = 0
+        with self.locks.holding(user_lock_key(username)):
+            existed = self.users.pop(username, None) is not None
+            if existed:
+                seq = self.log_event(delete_user_record(username))
+        self.wait_durable(seq)
+        return existed
+
+    def post(self, conv_key, sender, message, timestamp):
+        # Allocate the ID under the conversation lock so each history stays sorted by ID
+        with self.locks.holding(conv_lock_key(conv_key)):
+            entry = Message(self.message_ids.allocate(), sender, message, timestamp)
+            self.conversations.setdefault(conv_key, []).append(entry)
+            seq = self.log_event(post_record(conv_key, entry))
+        self.wait_durable(seq)
+        return entry
+
+    def add_unread(self, username, conv_key, entry):
+        seq = 0
+        with self.locks.holding(user_lock_key(username)):
+            if username in self.users:
+                self.users[username]["messages"].append(entry)
+                seq = self.log_event(unread_record(username, conv_key, entry["id"]))
+        self.wait_durable(seq)
+
+    # Remove and return up to limit (0 or None: all) of a user's unread messages
+    def take_unread(self, username, limit):
+        with self.locks.holding(user_lock_key(username)):
+            if username not in self.users:
+                return None
+            msgs = self.users[username]["messages"]
+            if limit and limit > 0:
+                taken = msgs[:limit]
+                self.users[username]["messages"] = msgs[limit:]
+            else:
+                taken = msgs
+                self.users[username]["messages"] = []
+            seq = self.log_event(drop_unread_record(username, [msg["id"] for msg in taken])) if taken else 0
+        self.wait_durable(seq)
+        return taken
+
+    def mark_read_from(self, username, sender):
+        seq = 0
+        with self.locks.holding(user_lock_key(username)):
+            if username in self.users:
+                current_unread = self.users[username]["messages"]
+                self.users[username]["messages"] = [msg for msg in current_unread if msg["sender"] != sender]
+                seen = [msg["id"] for msg in current_unread if msg["sender"] == sender]
+                if seen:
+                    seq = self.log_event(drop_unread_record(username, seen))
+        self.wait_durable(seq)
+
+    def delete_messages(self, username, ids):
+        ids = set(ids)
+        # Snapshot the keys so concurrent sends that create conversations don't break iteration
+        user_convs = [conv_key for conv_key in self.conversation_keys() if username in conv_key]
+        user = self.users.get(username)
+        found = user is not None and any(msg["id"] in ids for msg in user["messages"])
+        if not found:
+            found = any(self.conversation_holds(conv_key, ids) for conv_key in user_convs)
+        if not found:
+            return False
+        seq = 0
+        with self.locks.holding(user_lock_key(username)):
+            if username in self.users:
+                current_unread = self.users[username]["messages"]
+                self.users[username]["messages"] = [msg for msg in current_unread if msg["id"] not in ids]
+                if len(self.users[username]["messages"]) != len(current_unread):
+                    seq = self.log_event(drop_unread_record(username, sorted(ids)))
+        for conv_key in user_convs:
+            with self.locks.holding(conv_lock_key(conv_key)):
+                seq = self.remove_from_conversation(conv_key, ids) or seq
+        self.wait_durable(seq)
+        return True
+
+    def delete_from_conversation(self, conv_key, ids):
+        with self.locks.holding(conv_lock_key(conv_key)):
+            if not self.has_conversation(conv_key):
+                return False
+            seq = self.remove_from_conversation(conv_key, ids)
+        self.wait_durable(seq)
+        return True
+
+    # Where the histories live; a subclass keeping them elsewhere overrides these four.
+    # remove_from_conversation runs under the conversation lock and returns the log sequence
+    # number to wait for (0: nothing changed)
+    def conversation_keys(self):
+        return list(self.conversations)
+
+    def has_conversation(self, conv_key):
+        return conv_key in self.conversations
+
+    def conversation_holds(self, conv_key, ids):
+        return any(msg["id"] in ids for msg in self.conversations.get(conv_key, []))
+
+    def remove_from_conversation(self, conv_key, ids):
+        conv = self.conversations[conv_key]
+        self.conversations[conv_key] = [msg for msg in conv if msg.get("id") not in ids]
+        if len(self.conversations[conv_key]) == len(conv):
+            return 0
+        return self.log_event(delete_conv_record(conv_key, sorted(ids)))
+
+    def delete_unread_at(self, username, indices):
+        seq = 0
+        with self.locks.holding(user_lock_key(username)):
+            if username not in self.users:
+                return False
+            current_msgs = self.users[username]["messages"]
+            self.users[username]["messages"] = [msg for i, msg in enumerate(current_msgs) if i not in indices]
+            # Indices only mean something against this list, so the log gets the IDs
+            dropped = [msg["id"] for i, msg in enumerate(current_msgs) if i in indices]
+            if dropped:
+                seq = self.log_event(drop_unread_record(username, dropped))
+        self.wait_durable(seq)
+        return True
+
+    def has_history(self, conv_key):
+        return bool(self.conversations.get(conv_key))
+
+    def history(self, conv_key, since_id=None, before_id=None, limit=0):
+        with self.locks.holding(conv_lock_key(conv_key)):
+            return history_window(self.conversations.get(conv_key, []), since_id, before_id, limit)
+
+    def history_pages(self, conv_key, since_id=None, before_id=None, limit=0, page_size=HISTORY_PAGE_SIZE):
+        return history_pages(self.conversations, conv_key, self.locks, since_id, before_id, limit, page_size)
+
+    def stats(self):
+        stats = {"users": len(self.users), "conversations": len(self.conversations)}
+        if self.wal is not None:
+            stats["wal"] = self.wal.stats()
+            stats["snapshots"] = self.snapshots.stats()
+        return stats
+
+    def close(self):
+        if self.wal is not None:
+            self.snapshots.close()
+            self.wal.close()
@@ -0,0 +1,47 @@
+import json
+import os
+import unittest
+
+from chat_common.compression import (FrameCompressor, CompressionStats, decompress, cap_bits, cap_names,
+                                     compress_json_body, expand_json_body, CAP_ZLIB, CAP_ZDICT)
+
+HISTORY = json.dumps([{"id": i, "sender": "alice", "message": f"message {i}", "timestamp": "2025-02-12"}
+                      for i in range(100)], indent=2).encode()
+
+class FrameCompressorTests(unittest.TestCase):
+    def test_round_trip_with_and_without_dictionary(self):
+        for use_dictionary in (True, False):
+            packed = FrameCompressor(use_dictionary).compress(HISTORY)
+            self.assertLess(len(packed), len(HISTORY))
+            self.assertEqual(decompress(packed, len(HISTORY)), HISTORY)
+
+    def test_small_and_incompressible_payloads_are_left_alone(self):
+        stats = CompressionStats()
+        compressor = FrameCompressor(stats=stats)
+        self.assertIsNone(compressor.compress(b"short"))
+        self.assertIsNone(compressor.compress(os.urandom(4096)))
+        self.assertIsNotNone(compressor.compress(HISTORY))
+        snapshot = stats.snapshot()
+        self.assertEqual((snapshot["frames"], snapshot["skipped"]), (1, 1))
+        self.assertEqual(snapshot["bytes_in"], len(HISTORY))
+
+    def test_decompress_refuses_oversized_or_truncated_input(self):
+        packed = FrameCompressor().compress(HISTORY)
+        with self.assertRaises(ValueError):
+            decompress(packed, len(HISTORY) - 1)
+        with self.assertRaises(ValueError):
+            decompress(packed[:-4], len(HISTORY))
+
+    def test_caps_and_json_body(self):
+        self.assertEqual(cap_bits(cap_names(CAP_ZLIB | CAP_ZDICT)), CAP_ZLIB | CAP_ZDICT)
+        self.assertEqual(cap_bits("zlib, unknown"), CAP_ZLIB)
+        msg = compress_json_body({"cmd": "view_conv", "body": HISTORY.decode()}, FrameCompressor())
+        self.assertEqual(msg["body"], "")
+        self.assertEqual(expand_json_body(json.loads(json.dumps(msg)))["body"], HISTORY.decode())
+        nested = [{"id": i, "sender": "alice", "message": f"hello {i}"} for i in range(100)]
+        msg = compress_json_body({"cmd": "view_conv", "body": nested}, FrameCompressor())
+        self.assertTrue(msg["zjson"])
+        self.assertEqual(expand_json_body(json.loads(json.dumps(msg)))["body"], nested)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import threading
+import unittest
+
+from chat_common.concurrency import StripedLock, IdAllocator, user_lock_key, conv_lock_key
+
+class IdAllocatorTests(unittest.TestCase):
+    def test_ids_are_unique_across_threads(self):
+        ids = IdAllocator()
+        seen = []
+        def grab():
+            local = [ids.allocate() for _ in range(2000)]
+            seen.extend(local)
+        threads = [threading.Thread(target=grab) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(seen), list(range(1, 16001)))
+
+    def test_advance_past(self):
+        ids = IdAllocator()
+        ids.advance_past(41)
+        self.assertEqual(ids.allocate(), 42)
+        ids.advance_past(10)
+        self.assertEqual(ids.allocate(), 43)
+
+class StripedLockTests(unittest.TestCase):
+    def test_opposite_acquisition_order_does_not_deadlock(self):
+        locks = StripedLock(stripes=4)
+        a, b = user_lock_key("alice"), conv_lock_key(("alice", "bob"))
+        counter = [0]
+        def worker(keys):
+            for _ in range(2000):
+                with locks.holding(*keys):
+                    counter[0] += 1
+        threads = [threading.Thread(target=worker, args=((a, b),)), threading.Thread(target=worker, args=((b, a),))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=10)
+            self.assertFalse(t.is_alive())
+        self.assertEqual(counter[0], 4000)
+
+    def test_reentrant_for_keys_on_the_same_stripe(self):
+        locks = StripedLock(stripes=1)
+        with locks.holding(user_lock_key("a")):
+            with locks.holding(user_lock_key("b")):
+                pass
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+from chat_common.concurrency import StripedLock
+from chat_common.history import history_window, history_pages
+
+class HistoryWindowTests(unittest.TestCase):
+    def setUp(self):
+        # IDs with gaps, as left by deletes and by other conversations' messages
+        self.conv = [{"id": i} for i in range(1, 200, 3)]
+
+    def ids(self, window):
+        return [entry["id"] for entry in window]
+
+    def test_whole_history_by_default(self):
+        self.assertEqual(self.ids(history_window(self.conv)), self.ids(self.conv))
+
+    def test_since_id_returns_only_newer(self):
+        self.assertEqual(self.ids(history_window(self.conv, since_id=190)), [193, 196, 199])
+        # An ID that was deleted (or never in this conversation) still works as a cursor
+        self.assertEqual(self.ids(history_window(self.conv, since_id=191)), [193, 196, 199])
+        self.assertEqual(history_window(self.conv, since_id=199), [])
+
+    def test_limit_pages_forward_and_back(self):
+        self.assertEqual(self.ids(history_window(self.conv, since_id=1, limit=2)), [4, 7])
+        self.assertEqual(self.ids(history_window(self.conv, before_id=10, limit=2)), [4, 7])
+        self.assertEqual(self.ids(history_window(self.conv, limit=2, before_id=1000)), [196, 199])
+        self.assertEqual(self.ids(history_window(self.conv, since_id=4, before_id=16)), [7, 10, 13])
+
+    def test_pages_cover_the_window_once(self):
+        conversations = {("a", "b"): self.conv}
+        pages = history_pages(conversations, ("a", "b"), StripedLock(), since_id=10, page_size=5)
+        first = next(pages)
+        self.assertEqual(self.ids(first), [13, 16, 19, 22, 25])
+        # Sent after the reply started: outside the window it was asked for
+        self.conv.append({"id": 500})
+        rest = [entry for page in pages for entry in page]
+        self.assertEqual(self.ids(first + rest), [i for i in range(13, 200, 3)])
+        self.assertEqual(list(history_pages(conversations, ("a", "c"), StripedLock())), [])
+
+if __name__ == "__main__":
+    unittest.main()
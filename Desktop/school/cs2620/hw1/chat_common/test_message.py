@@ -0,0 +1,52 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from chat_common.message import Message, json_default
+from chat_common.store import MemoryStore
+
+CONV = ("alice", "bob")
+
+class MessageTests(unittest.TestCase):
+    def test_reads_like_a_dict_entry(self):
+        stamp = datetime.datetime(2025, 3, 1, 12, 30, 5, 123456).isoformat()
+        msg = Message(7, "".join(["ali", "ce"]), "hi", stamp)
+        self.assertIsInstance(msg.micros, int)
+        self.assertEqual(msg["timestamp"], stamp)
+        self.assertEqual(msg.fields(), {"id": 7, "sender": "alice", "message": "hi", "timestamp": stamp})
+        self.assertEqual(msg, msg.fields())
+        self.assertEqual(msg.get("id"), 7)
+        self.assertIsNone(msg.get("other"))
+        self.assertIn("timestamp", msg)
+        with self.assertRaises(KeyError):
+            msg["other"]
+        # Every message from a sender shares one name string
+        self.assertIs(msg.sender, Message(8, "".join(["al", "ice"]), "", stamp).sender)
+        self.assertEqual(json.loads(json.dumps([msg], default=json_default)), [msg.fields()])
+        # Whole seconds: isoformat leaves out the microseconds, and so does the round trip
+        self.assertEqual(Message(9, "bob", "", "2025-03-01T12:30:05")["timestamp"], "2025-03-01T12:30:05")
+        self.assertEqual(Message(10, "bob", "", "")["timestamp"], "")
+
+    def test_unread_shares_the_history_message(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "chat.wal")
+        store = MemoryStore(path, commit_window=0, snapshot_every=0)
+        for name in CONV:
+            store.create_user(name, "hash")
+        entry = store.post(CONV, "alice", "hi", datetime.datetime.now().isoformat())
+        store.add_unread("bob", CONV, entry)
+        self.assertIs(store.users["bob"]["messages"][0], store.conversations[CONV][0])
+        store.snapshots.snapshot()
+        store.close()
+        # ... and again after a restart from the snapshot
+        restored = MemoryStore(path, commit_window=0, snapshot_every=0)
+        self.addCleanup(restored.close)
+        self.assertIs(restored.users["bob"]["messages"][0], restored.conversations[CONV][0])
+        self.assertEqual(restored.conversations[CONV][0], entry)
+
+if __name__ == "__main__":
+    unittest.main()
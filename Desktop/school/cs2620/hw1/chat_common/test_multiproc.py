@@ -0,0 +1,162 @@
+import socket
+import threading
+import time
+import unittest
+
+from chat_common.multiproc import (Channel, RemoteConnection, RoutedClient, ShardCursor, EVERY_SHARD,
+                                   KIND_REQUEST, KIND_SEND, KIND_CLOSE, owner_channel_loop,
+                                   worker_delivery_loop, worker_client_loop, shard_of)
+from chat_common.outbound import QueuedConnection, Backpressure
+from chat_common.worker_pool import OrderedWorkerPool
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class RemoteBackpressureTests(unittest.TestCase):
+    def setUp(self):
+        # owner <-> worker channel, and one client socket held by the worker
+        owner_sock, worker_sock = socket.socketpair()
+        self.owner = Channel(owner_sock)
+        self.worker = Channel(worker_sock)
+        self.client_sock, self.reader = socket.socketpair()
+        self.client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+        self.out = QueuedConnection(self.client_sock)
+        self.clients = {1: RoutedClient(self.worker, 1, self.out)}
+        threading.Thread(target=worker_delivery_loop, args=(self.worker, self.clients), daemon=True).start()
+        self.conns = {}
+
+        def dispatch(conn, request):
+            self.conns[request] = conn
+            return True
+        threading.Thread(target=owner_channel_loop, args=(self.owner, dispatch), daemon=True).start()
+        self.worker.send(1, 1, b"hello")  # KIND_REQUEST
+        self.assertTrue(wait_for(lambda: b"hello" in self.conns))
+        self.conn = self.conns[b"hello"]
+
+    def tearDown(self):
+        self.reader.close()
+
+    def test_backlog_reaches_the_owner_and_drains(self):
+        self.assertIsInstance(self.conn, RemoteConnection)
+        bp = Backpressure(high_watermark=256 * 1024, low_watermark=1024)
+        chunk = b"x" * 65536
+        admitted = 0
+        for _ in range(16):
+            if bp.admit(self.conn, len(chunk)):
+                self.conn.sendall(chunk)
+                admitted += 1
+        # The stalled reader throttles the pushes instead of every one being admitted
+        self.assertLess(admitted, 16)
+        self.assertTrue(self.conn.throttled)
+        received = 0
+        while received < admitted * len(chunk):
+            received += len(self.reader.recv(1 << 20))
+        self.assertTrue(wait_for(lambda: self.conn.pending_bytes() == 0))
+        self.assertTrue(bp.admit(self.conn, len(chunk)))
+
+    def test_abort_drops_the_client(self):
+        self.conn.sendall(b"x" * 100)
+        self.conn.abort()
+        self.assertTrue(wait_for(lambda: 1 not in self.clients))
+        with self.assertRaises(OSError):
+            self.conn.sendall(b"late")
+
+class OwnerPoolTests(unittest.TestCase):
+    def setUp(self):
+        owner_sock, worker_sock = socket.socketpair()
+        self.worker = Channel(worker_sock)
+        self.pool = OrderedWorkerPool(max_workers=2)
+        self.addCleanup(self.pool.shutdown, False)
+        self.release = threading.Event()
+        self.handled = []
+
+        def dispatch(conn, request):
+            if request == b"slow":
+                self.release.wait(5)
+            self.handled.append((conn.conn_id, request))
+            conn.sendall(request)
+            return request != b"close"
+        threading.Thread(target=owner_channel_loop, args=(Channel(owner_sock), dispatch, self.pool),
+                         daemon=True).start()
+
+    def test_slow_command_does_not_stall_the_channel(self):
+        self.worker.send(KIND_REQUEST, 1, b"slow")
+        self.worker.send(KIND_REQUEST, 2, b"fast")
+        self.assertTrue(wait_for(lambda: (2, b"fast") in self.handled))
+        self.assertNotIn((1, b"slow"), self.handled)
+        self.release.set()
+        self.assertTrue(wait_for(lambda: (1, b"slow") in self.handled))
+
+    def test_connection_keeps_its_order_and_closes_after_its_replies(self):
+        for request in (b"a", b"b", b"close"):
+            self.worker.send(KIND_REQUEST, 1, request)
+        frames = [self.worker.recv() for _ in range(4)]
+        self.assertEqual(frames, [(KIND_SEND, 1, b"a"), (KIND_SEND, 1, b"b"),
+                                  (KIND_SEND, 1, b"close"), (KIND_CLOSE, 1, b"")])
+
+class ShardRoutingTests(unittest.TestCase):
+    def setUp(self):
+        # Two shards, each with its own owner and channel to the one worker
+        self.channels = []
+        self.handled = []
+        for shard in range(2):
+            owner_sock, worker_sock = socket.socketpair()
+            pool = OrderedWorkerPool(max_workers=2)
+            self.addCleanup(pool.shutdown, False)
+
+            def dispatch(conn, request, shard=shard):
+                if request.endswith(b"slow"):
+                    time.sleep(0.05)
+                self.handled.append((shard, request, conn.muted))
+                conn.sendall(b"%d:%s;" % (shard, request))
+                return True
+            threading.Thread(target=owner_channel_loop, args=(Channel(owner_sock), dispatch, pool, True),
+                             daemon=True).start()
+            self.channels.append(Channel(worker_sock))
+        self.client_sock, self.reader = socket.socketpair()
+        self.addCleanup(self.reader.close)
+        self.out = QueuedConnection(self.client_sock)
+        self.cursor = ShardCursor()
+        self.clients = [{1: RoutedClient(channel, 1, self.out, self.cursor)} for channel in self.channels]
+        for channel, routed in zip(self.channels, self.clients):
+            threading.Thread(target=worker_delivery_loop, args=(channel, routed), daemon=True).start()
+        # One user on each shard
+        names = ["user%d" % i for i in range(64)]
+        self.users = [next(name for name in names if shard_of(name, 2) == shard) for shard in range(2)]
+
+    def serve(self, requests):
+        finished = threading.Event()
+
+        def read_requests(_):
+            yield from requests
+            finished.wait(5)
+
+        def route(request):
+            return EVERY_SHARD if request == b"hello" else request.split(b" ")[0].decode()
+        threading.Thread(target=worker_client_loop,
+                         args=(self.channels, self.clients, 1, None, self.out, "test", read_requests,
+                               route, self.cursor),
+                         daemon=True).start()
+        return finished
+
+    def test_requests_run_on_their_users_shard_and_reply_in_order(self):
+        first, second = (name.encode() for name in self.users)
+        requests = [b"hello", second + b" slow", first + b" next", second + b" last"]
+        finished = self.serve(requests)
+        expected = b"0:hello;1:" + requests[1] + b";0:" + requests[2] + b";1:" + requests[3] + b";"
+        received = b""
+        while len(received) < len(expected):
+            received += self.reader.recv(4096)
+        finished.set()
+        self.assertEqual(received, expected)
+        # The other shard saw the hello too, without replying to it
+        self.assertIn((1, b"hello", True), self.handled)
+        self.assertIn((0, b"hello", False), self.handled)
+
+if __name__ == "__main__":
+    unittest.main()
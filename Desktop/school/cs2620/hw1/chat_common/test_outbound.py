@@ -0,0 +1,173 @@
+import socket
+import time
+import unittest
+
+from chat_common.outbound import (QueuedConnection, Backpressure, STREAM_HIGH_WATERMARK, send_buffers,
+                                  send_parts, send_stream)
+
+class QueuedConnectionTests(unittest.TestCase):
+    def test_send_does_not_block_on_a_stalled_reader(self):
+        a, b = socket.socketpair()
+        conn = QueuedConnection(a)
+        chunk = b"x" * 65536
+        start = time.monotonic()
+        for _ in range(64):
+            conn.send(chunk)
+        self.assertLess(time.monotonic() - start, 1.0)
+        received = bytearray()
+        while len(received) < 64 * len(chunk):
+            received += b.recv(1 << 20)
+        self.assertEqual(bytes(received), chunk * 64)
+        conn.close()
+        b.close()
+
+    def test_close_flushes_in_order(self):
+        a, b = socket.socketpair()
+        conn = QueuedConnection(a)
+        for i in range(100):
+            conn.sendall(f"{i}\n".encode())
+        conn.close()
+        with self.assertRaises(OSError):
+            conn.sendall(b"late")
+        data = b""
+        while True:
+            chunk = b.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        self.assertEqual(data.decode().split(), [str(i) for i in range(100)])
+        b.close()
+
+class StreamTests(unittest.TestCase):
+    def test_stream_pauses_for_a_stalled_reader_without_a_thread(self):
+        a, b = socket.socketpair()
+        conn = QueuedConnection(a)
+        produced = []
+
+        def chunks():
+            for i in range(200):
+                produced.append(i)
+                yield [b"x" * 65535 + b"\n"]
+        done = send_stream(conn, chunks())
+        # The caller got control back with the reply paused near the watermark
+        self.assertFalse(done.done())
+        time.sleep(0.2)
+        self.assertLess(len(produced), 200)
+        self.assertLessEqual(conn.pending_bytes(), STREAM_HIGH_WATERMARK + 65536)
+        received = bytearray()
+        while len(received) < 200 * 65536:
+            received += b.recv(1 << 20)
+        self.assertTrue(done.result(timeout=5))
+        self.assertEqual(len(produced), 200)
+        self.assertEqual(received.count(b"\n"), 200)
+        conn.close()
+        b.close()
+
+    def test_stream_on_a_dropped_connection_fails(self):
+        a, b = socket.socketpair()
+        conn = QueuedConnection(a)
+        done = send_stream(conn, ([b"x" * 65536] for _ in range(200)))
+        conn.abort()
+        with self.assertRaises(OSError):
+            done.result(timeout=5)
+        b.close()
+
+    def test_connections_without_callbacks_get_everything(self):
+        sock = TrickleSocket(1 << 20)
+        self.assertTrue(send_stream(sock, ([b"ab", b"c"] for _ in range(3))))
+        self.assertEqual(bytes(sock.data), b"abc" * 3)
+
+class TrickleSocket:
+    # sendmsg takes at most a few bytes per call, like a kernel with a nearly full buffer
+    def __init__(self, step):
+        self.step = step
+        self.data = bytearray()
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        room = self.step
+        for buf in buffers:
+            take = bytes(buf[:room])
+            self.data += take
+            room -= len(take)
+            if not room:
+                break
+        return self.step - room
+
+class ScatterGatherTests(unittest.TestCase):
+    def test_partial_writes_resume_mid_buffer(self):
+        sock = TrickleSocket(7)
+        buffers = [b"header", b"", bytearray(b"field"), memoryview(b"payload" * 20)]
+        send_buffers(sock, buffers)
+        self.assertEqual(bytes(sock.data), b"".join(buffers))
+        self.assertGreater(sock.calls, 1)
+
+    def test_queued_sendmsg_keeps_order(self):
+        a, b = socket.socketpair()
+        conn = QueuedConnection(a)
+        for i in range(100):
+            if i % 2:
+                send_parts(conn, [f"{i}".encode(), b"\n"])
+            else:
+                conn.sendall(f"{i}\n".encode())
+        conn.close()
+        data = b""
+        while True:
+            chunk = b.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        self.assertEqual(data.decode().split(), [str(i) for i in range(100)])
+        b.close()
+
+class StubConn:
+    def __init__(self):
+        self.pending = 0
+        self.throttled = False
+        self.aborted = False
+
+    def pending_bytes(self):
+        return self.pending
+
+    def abort(self):
+        self.aborted = True
+
+class BackpressureTests(unittest.TestCase):
+    def test_watermarks_have_hysteresis(self):
+        bp = Backpressure(high_watermark=1000, low_watermark=100)
+        conn = StubConn()
+        self.assertTrue(bp.admit(conn, 500))
+        conn.pending = 900
+        self.assertFalse(bp.admit(conn, 200))
+        # Below the high watermark again, but not yet drained to the low one
+        conn.pending = 500
+        self.assertFalse(bp.admit(conn, 10))
+        conn.pending = 50
+        self.assertTrue(bp.admit(conn, 10))
+        self.assertEqual(bp.stats(), {"pushed": 2, "dropped_to_unread": 2, "disconnected": 0})
+        self.assertFalse(conn.aborted)
+
+    def test_disconnect_policy_aborts(self):
+        bp = Backpressure(high_watermark=1000, low_watermark=100, policy="disconnect")
+        conn = StubConn()
+        conn.pending = 2000
+        self.assertFalse(bp.admit(conn, 1))
+        self.assertTrue(conn.aborted)
+        self.assertEqual(bp.stats()["disconnected"], 1)
+
+    def test_queued_connection_abort_does_not_wait_for_reader(self):
+        a, b = socket.socketpair()
+        conn = QueuedConnection(a)
+        for _ in range(64):
+            conn.sendall(b"x" * 65536)
+        time.sleep(0.1)
+        self.assertGreater(conn.pending_bytes(), 0)
+        conn.abort()
+        self.assertEqual(conn.pending_bytes(), 0)
+        conn.writer.join(timeout=2)
+        self.assertFalse(conn.writer.is_alive())
+        b.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+from chat_common.concurrency import StripedLock, IdAllocator
+from chat_common.snapshot import open_durable_state
+from chat_common.wal import segment_numbers, apply_record, create_record, post_record, unread_record
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "chat.wal")
+
+    def open(self):
+        state = (OrderedDict(), {}, IdAllocator())
+        wal, snapshots = open_durable_state(self.path, StripedLock(), *state, commit_window=0, snapshot_every=0)
+        return state, wal, snapshots
+
+    # Apply and log a record the way a handler does
+    def change(self, state, wal, record):
+        apply_record(record, *state)
+        return wal.append(record)
+
+    def send(self, state, wal, text):
+        users, conversations, ids = state
+        entry = {"id": ids.allocate(), "sender": "alice", "message": text, "timestamp": ""}
+        self.change(state, wal, post_record(("alice", "bob"), entry))
+        return self.change(state, wal, unread_record("bob", ("alice", "bob"), entry["id"]))
+
+    def test_restart_from_snapshot_and_log_tail(self):
+        state, wal, snapshots = self.open()
+        for name in ("alice", "bob"):
+            self.change(state, wal, create_record(name, "hash"))
+        for i in range(50):
+            self.send(state, wal, f"before {i}")
+        self.assertTrue(snapshots.snapshot())
+        for i in range(5):
+            seq = self.send(state, wal, f"after {i}")
+        wal.wait(seq)
+        snapshots.wait()
+        wal.close()
+        self.assertEqual(snapshots.stats()["snapshots"], 1)
+        # The log before the snapshot is gone; only the tail is left to replay
+        self.assertEqual(segment_numbers(self.path), [1])
+
+        restored, wal, _ = self.open()
+        wal.close()
+        users, conversations, ids = restored
+        self.assertEqual(users, state[0])
+        self.assertEqual(conversations, state[1])
+        self.assertEqual([m["message"] for m in users["bob"]["messages"]][-2:], ["after 3", "after 4"])
+        self.assertEqual(ids.allocate(), state[2].allocate())
+
+    def test_each_snapshot_compacts_the_log(self):
+        state, wal, snapshots = self.open()
+        self.change(state, wal, create_record("alice", "hash"))
+        self.assertTrue(snapshots.snapshot())
+        snapshots.wait()
+        self.change(state, wal, create_record("bob", "hash"))
+        self.assertTrue(snapshots.snapshot())
+        snapshots.wait()
+        wal.close()
+        self.assertEqual(snapshots.stats()["snapshots"], 2)
+        self.assertEqual(segment_numbers(self.path), [2])
+
+    def test_automatic_snapshots_start_off_the_request_thread(self):
+        state = (OrderedDict(), {}, IdAllocator())
+        wal, snapshots = open_durable_state(self.path, StripedLock(), *state, commit_window=0, snapshot_every=10)
+        started_on = []
+        take = snapshots.snapshot
+        snapshots.snapshot = lambda: started_on.append(threading.current_thread()) or take()
+        for name in ("alice", "bob"):
+            self.change(state, wal, create_record(name, "hash"))
+        for i in range(20):
+            seq = self.send(state, wal, f"m{i}")
+            # What a request does after its record is durable
+            wal.wait(seq)
+            snapshots.maybe_snapshot(seq)
+        deadline = time.monotonic() + 5
+        while snapshots.stats()["snapshots"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        snapshots.close()
+        wal.close()
+        self.assertGreater(snapshots.stats()["snapshots"], 0)
+        self.assertNotIn(threading.current_thread(), started_on)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,214 @@
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from chat_common.store import MemoryStore
+from chat_common.sqlite_store import SqliteStore
+from chat_common.segment_store import SegmentStore, decode_entry
+
+CONV = ("alice", "bob")
+
+class StoreContract:
+    # The same behaviour from every store; subclasses provide make_store()
+    def setUp(self):
+        self.store = self.make_store()
+        self.addCleanup(self.store.close)
+        for name in ("alice", "bob"):
+            self.assertTrue(self.store.create_user(name, f"hash-{name}"))
+
+    def send(self, text, sender="alice", recipient="bob", unread=True):
+        conv_key = tuple(sorted([sender, recipient]))
+        entry = self.store.post(conv_key, sender, text, "2025-01-01T00:00:00")
+        if unread:
+            self.store.add_unread(recipient, conv_key, entry)
+        return entry
+
+    def messages(self, entries):
+        return [entry["message"] for entry in entries]
+
+    def test_accounts(self):
+        self.assertFalse(self.store.create_user("alice", "other"))
+        self.assertEqual(self.store.password_hash("alice"), "hash-alice")
+        self.assertIsNone(self.store.password_hash("nobody"))
+        self.assertEqual(self.store.match_users("*"), ["alice", "bob"])
+        self.assertEqual(self.store.match_users("b*"), ["bob"])
+        self.send("hi")
+        self.assertTrue(self.store.delete_user("bob"))
+        self.assertFalse(self.store.delete_user("bob"))
+        self.assertFalse(self.store.has_user("bob"))
+        self.assertIsNone(self.store.take_unread("bob", 0))
+        # A recreated account starts without the old account's unread messages
+        self.store.create_user("bob", "new")
+        self.assertEqual(self.store.unread_count("bob"), 0)
+
+    def test_unread_in_order_with_limit(self):
+        for i in range(5):
+            self.send(f"m{i}")
+        self.assertEqual(self.store.unread_count("bob"), 5)
+        self.assertEqual(self.messages(self.store.take_unread("bob", 2)), ["m0", "m1"])
+        self.assertEqual(self.messages(self.store.take_unread("bob", 0)), ["m2", "m3", "m4"])
+        self.assertEqual(self.store.take_unread("bob", 0), [])
+
+    def test_history_windows_and_pages(self):
+        ids = [self.send(f"m{i}", unread=False)["id"] for i in range(10)]
+        self.assertEqual(ids, sorted(ids))
+        self.assertTrue(self.store.has_history(CONV))
+        self.assertFalse(self.store.has_history(("alice", "carol")))
+        self.assertEqual(self.messages(self.store.history(CONV)), [f"m{i}" for i in range(10)])
+        self.assertEqual(self.messages(self.store.history(CONV, since_id=ids[6])), ["m7", "m8", "m9"])
+        self.assertEqual(self.messages(self.store.history(CONV, since_id=ids[1], limit=2)), ["m2", "m3"])
+        self.assertEqual(self.messages(self.store.history(CONV, before_id=ids[5], limit=2)), ["m3", "m4"])
+        pages = list(self.store.history_pages(CONV, since_id=ids[0], limit=7, page_size=3))
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertEqual(self.messages(sum(pages, [])), [f"m{i}" for i in range(1, 8)])
+        pages = self.store.history_pages(CONV, page_size=4)
+        first = next(pages)
+        # Sent after the reply started: outside the window it was asked for
+        self.send("late", unread=False)
+        self.assertEqual(self.messages(first + sum(pages, [])), [f"m{i}" for i in range(10)])
+
+    def test_deletes(self):
+        kept, gone, other = self.send("kept"), self.send("gone"), self.send("other", "bob", "alice")
+        self.assertFalse(self.store.delete_messages("alice", [10 ** 9]))
+        self.assertTrue(self.store.delete_messages("bob", [gone["id"]]))
+        self.assertEqual(self.messages(self.store.history(CONV)), ["kept", "other"])
+        self.assertEqual(self.messages(self.store.take_unread("bob", 0)), ["kept"])
+        self.assertFalse(self.store.delete_from_conversation(("alice", "carol"), [1]))
+        self.assertTrue(self.store.delete_from_conversation(CONV, [kept["id"]]))
+        self.assertEqual(self.messages(self.store.history(CONV)), ["other"])
+        # By position in the unread list; a history delete leaves the unread copy
+        for text in ("u0", "u1", "u2"):
+            self.send(text, "bob", "alice")
+        self.assertTrue(self.store.delete_unread_at("alice", [0, 2]))
+        self.assertFalse(self.store.delete_unread_at("nobody", [0]))
+        self.assertEqual(self.messages(self.store.take_unread("alice", 0)), ["u0", "u2"])
+        self.send("from bob", "bob", "alice")
+        self.send("from alice", "alice", "bob")
+        self.store.mark_read_from("alice", "bob")
+        self.assertEqual(self.store.unread_count("alice"), 0)
+        self.assertEqual(self.store.unread_count("bob"), 1)
+
+    def test_concurrent_sends(self):
+        def sender(n):
+            for i in range(50):
+                self.send(f"{n}-{i}")
+        threads = [threading.Thread(target=sender, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ids = [entry["id"] for entry in self.store.history(CONV)]
+        self.assertEqual(len(set(ids)), 200)
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(self.store.take_unread("bob", 0)), 200)
+
+class MemoryStoreTests(StoreContract, unittest.TestCase):
+    def make_store(self):
+        return MemoryStore()
+
+class SqliteStoreTests(StoreContract, unittest.TestCase):
+    def make_store(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, "chat.db")
+        return SqliteStore(self.path)
+
+    def test_data_survives_reopening(self):
+        self.send("persisted")
+        self.store.close()
+        reopened = SqliteStore(self.path)
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.password_hash("alice"), "hash-alice")
+        self.assertEqual(self.messages(reopened.take_unread("bob", 0)), ["persisted"])
+
+    def test_queries_use_the_indices(self):
+        plan = " ".join(row[-1] for row in self.store.fetchall(
+            "EXPLAIN QUERY PLAN SELECT id FROM messages WHERE user1 = ? AND user2 = ? AND id > ? ORDER BY id LIMIT 5",
+            ("alice", "bob", 0)))
+        self.assertIn("messages_by_conversation", plan)
+        plan = " ".join(row[-1] for row in self.store.fetchall(
+            "EXPLAIN QUERY PLAN SELECT seq FROM unread WHERE recipient = ? ORDER BY seq LIMIT 5", ("bob",)))
+        self.assertIn("unread_by_recipient", plan)
+
+    def test_client_threads_leave_no_connections_behind(self):
+        # Like thread-per-client: every client is a short-lived thread calling the store
+        def client(n):
+            self.store.has_user("alice")
+            self.send(f"from client {n}", unread=False)
+        for batch in range(10):
+            threads = [threading.Thread(target=client, args=(batch * 30 + n,)) for n in range(30)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(len(self.store.history(CONV)), 300)
+        self.assertLessEqual(len(self.store.connections), self.store.pool_size)
+        self.assertEqual(len(self.store.connections), len(self.store.idle))
+
+class SegmentStoreTests(StoreContract, unittest.TestCase):
+    def make_store(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, "segments")
+        self.wal_path = os.path.join(tmpdir, "chat.wal")
+        # Small segments, so the tests cross from one to the next
+        return SegmentStore(self.path, self.wal_path, commit_window=0, segment_bytes=4096)
+
+    def test_data_survives_reopening(self):
+        entries = [self.send(f"m{i} " + "x" * 100) for i in range(60)]
+        self.assertGreater(len(self.store.segments), 1)
+        self.store.delete_from_conversation(CONV, [entries[3]["id"], entries[40]["id"]])
+        expected = self.store.history(CONV)
+        self.store.close()
+        reopened = SegmentStore(self.path, self.wal_path, commit_window=0, segment_bytes=4096)
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.history(CONV), expected)
+        self.assertEqual(len(reopened.take_unread("bob", 0)), 60)
+        self.assertEqual(reopened.password_hash("alice"), "hash-alice")
+        self.assertGreater(reopened.post(CONV, "bob", "next", "now")["id"], entries[-1]["id"])
+
+    def test_history_reads_map_slices(self):
+        entry = self.send("mapped")
+        (location,) = self.store.index[CONV][1]
+        view = self.store.body_at(location)
+        self.assertIsInstance(view, memoryview)
+        self.assertIsInstance(view.obj, mmap.mmap)
+        self.assertEqual(decode_entry(view), entry)
+
+    def test_msync_runs_outside_the_conversation_lock(self):
+        segment = self.store.segments[-1]
+        syncing = threading.Event()
+        release = threading.Event()
+        sync_to = segment.sync_to
+
+        def slow_sync_to(end):
+            syncing.set()
+            release.wait(5)
+            sync_to(end)
+        segment.sync_to = slow_sync_to
+        poster = threading.Thread(target=self.send, args=("slow",), kwargs={"unread": False})
+        poster.start()
+        self.assertTrue(syncing.wait(5))
+        # The conversation can be read while the post waits on the disk
+        self.assertEqual(self.messages(self.store.history(CONV)), ["slow"])
+        release.set()
+        poster.join()
+        self.assertEqual(segment.synced, segment.tail)
+
+    def test_torn_record_is_ignored(self):
+        self.send("kept", unread=False)
+        torn = self.store.segments[-1].tail
+        self.send("torn", unread=False)
+        # Damage the last record's text, as a crash halfway through writing it would
+        self.store.segments[-1].map[self.store.segments[-1].tail - 1] ^= 0xFF
+        self.store.close()
+        reopened = SegmentStore(self.path, self.wal_path, commit_window=0, segment_bytes=4096)
+        self.addCleanup(reopened.close)
+        self.assertEqual(self.messages(reopened.history(CONV)), ["kept"])
+        self.assertEqual(reopened.segments[-1].tail, torn)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from chat_common.concurrency import IdAllocator
+from chat_common.wal import (WriteAheadLog, segment_path, segment_numbers, apply_record, create_record, post_record, unread_record,
+                             drop_unread_record, delete_conv_record, delete_user_record)
+
+class WriteAheadLogTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, "chat.wal")
+
+    def replayed(self):
+        records = []
+        log = WriteAheadLog(self.path)
+        log.replay(records.append)
+        return records
+
+    def test_records_round_trip_in_order(self):
+        log = WriteAheadLog(self.path, commit_window=0)
+        log.start()
+        seq = 0
+        for i in range(10):
+            seq = log.append({"op": "test", "n": i, "text": "héllo"})
+        log.wait(seq)
+        log.close()
+        self.assertEqual(self.replayed(), [{"op": "test", "n": i, "text": "héllo"} for i in range(10)])
+
+    def test_torn_tail_is_truncated(self):
+        log = WriteAheadLog(self.path, commit_window=0)
+        log.start()
+        log.wait(log.append({"n": 1}))
+        log.wait(log.append({"n": 2}))
+        log.close()
+        segment = segment_path(self.path, 0)
+        os.truncate(segment, os.path.getsize(segment) - 3)
+        self.assertEqual(self.replayed(), [{"n": 1}])
+        # The torn record is gone, so new records follow the last intact one
+        log = WriteAheadLog(self.path, commit_window=0)
+        log.replay(lambda record: None)
+        log.start()
+        log.wait(log.append({"n": 3}))
+        log.close()
+        self.assertEqual(self.replayed(), [{"n": 1}, {"n": 3}])
+
+    def test_rotate_starts_a_new_segment(self):
+        log = WriteAheadLog(self.path, commit_window=0)
+        log.start()
+        log.append({"n": 1})
+        segment, seq = log.rotate()
+        log.wait(log.append({"n": 2}))
+        self.assertEqual((segment, segment_numbers(self.path)), (1, [0, 1]))
+        log.remove_segments_before(segment)
+        log.close()
+        self.assertEqual(self.replayed(), [{"n": 2}])
+
+    def test_concurrent_appends_share_fsyncs(self):
+        log = WriteAheadLog(self.path, commit_window=0.002)
+        log.start()
+        def writer(t):
+            for i in range(50):
+                log.wait(log.append({"t": t, "i": i}))
+        threads = [threading.Thread(target=writer, args=(t,)) for t in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = log.stats()
+        log.close()
+        self.assertEqual(stats["records"], 400)
+        self.assertLess(stats["fsyncs"], 400)
+        self.assertEqual(len(self.replayed()), 400)
+
+    def test_lone_writer_skips_the_commit_window(self):
+        log = WriteAheadLog(self.path, commit_window=1.0)
+        log.start()
+        start = time.perf_counter()
+        for i in range(5):
+            log.wait(log.append({"n": i}))
+        elapsed = time.perf_counter() - start
+        log.close()
+        self.assertLess(elapsed, 1.0)
+
+    def test_apply_rebuilds_state(self):
+        users, conversations, ids = {}, {}, IdAllocator()
+        conv = ("alice", "bob")
+        entries = [{"id": i, "sender": "alice", "message": f"m{i}", "timestamp": ""} for i in (3, 5, 9)]
+        records = [create_record("alice", "h1"), create_record("bob", "h2"), create_record("carol", "h3")]
+        for entry in entries:
+            records += [post_record(conv, entry), unread_record("bob", conv, entry["id"])]
+        records += [drop_unread_record("bob", [3]), delete_conv_record(conv, [5]), delete_user_record("carol")]
+        for record in records:
+            apply_record(record, users, conversations, ids)
+        self.assertEqual(sorted(users), ["alice", "bob"])
+        self.assertEqual([m["id"] for m in conversations[conv]], [3, 9])
+        # A history delete alone leaves the unread copy (the JSON server also logs a drop_unread)
+        self.assertEqual([m["id"] for m in users["bob"]["messages"]], [5, 9])
+        self.assertEqual(ids.allocate(), 10)
+
+if __name__ == "__main__":
+    unittest.main()
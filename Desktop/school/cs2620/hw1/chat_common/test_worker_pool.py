@@ -0,0 +1,69 @@
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+from chat_common.worker_pool import OrderedWorkerPool, ConnectionQueue
+
+class OrderedWorkerPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = OrderedWorkerPool(max_workers=4, queue_depth=8)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_same_key_runs_in_order(self):
+        seen = []
+        def work(i):
+            time.sleep(0.001 * (i % 3))
+            seen.append(i)
+        futures = [self.pool.submit("conn", work, i) for i in range(50)]
+        for f in futures:
+            f.result(timeout=5)
+        self.assertEqual(seen, list(range(50)))
+
+    def test_different_keys_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=2)
+        futures = [self.pool.submit(key, barrier.wait) for key in ("a", "b")]
+        for f in futures:
+            f.result(timeout=5)
+
+    def test_exceptions_propagate_and_queue_continues(self):
+        def boom():
+            raise RuntimeError("bad command")
+        failed = self.pool.submit("conn", boom)
+        ok = self.pool.submit("conn", lambda: 42)
+        with self.assertRaises(RuntimeError):
+            failed.result(timeout=5)
+        self.assertEqual(ok.result(timeout=5), 42)
+        self.assertEqual(self.pool.pending("conn"), 0)
+
+    def test_stats_record_queue_wait(self):
+        for f in [self.pool.submit("conn", time.sleep, 0.005) for _ in range(4)]:
+            f.result(timeout=5)
+        stats = self.pool.stats()
+        self.assertEqual(stats["completed"], 4)
+        self.assertGreater(stats["max_wait_ms"], 0)
+
+    def test_streaming_reply_holds_its_key_but_not_a_worker(self):
+        pool = OrderedWorkerPool(max_workers=1)
+        self.addCleanup(pool.shutdown)
+        streamed = Future()
+        first = pool.submit("conn", lambda: streamed)
+        after = pool.submit("conn", lambda: "next")
+        # The only worker is free for other connections while the reply streams
+        self.assertEqual(pool.submit("other", lambda: 7).result(timeout=5), 7)
+        self.assertFalse(first.done())
+        self.assertFalse(after.done())
+        streamed.set_result(True)
+        self.assertTrue(first.result(timeout=5))
+        self.assertEqual(after.result(timeout=5), "next")
+
+    def test_connection_queue_reports_close(self):
+        queue = ConnectionQueue(self.pool, "conn")
+        self.assertTrue(queue.submit(lambda: True))
+        queue.submit(lambda: False)
+        self.assertFalse(queue.drain())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,263 @@
+import bisect
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from chat_common.history import entry_id
+from chat_common.message import Message, json_default
+
+# Each record is its payload length and CRC-32, then the payload (compact UTF-8 JSON).
+# A crash can leave a torn record at the end; replay stops there and cuts it off
+RECORD_HEADER = struct.Struct("!II")
+# Seconds the flusher waits for more appends before a write when several writers are already
+# queued. 0: no waiting; records that queue up during one fsync still share the next
+DEFAULT_COMMIT_WINDOW = 0.0
+# Queued in place of a record to switch the log to its next segment (see rotate)
+ROTATE = object()
+
+# The log is a series of numbered segment files next to path, so the part a snapshot covers
+# can be deleted whole
+def segment_path(path, number):
+    return f"{path}.{number:06d}"
+
+def segment_numbers(path):
+    directory, prefix = os.path.split(os.path.abspath(path))
+    numbers = []
+    for name in os.listdir(directory):
+        suffix = name[len(prefix) + 1:]
+        if name.startswith(prefix + ".") and len(suffix) == 6 and suffix.isdigit():
+            numbers.append(int(suffix))
+    return sorted(numbers)
+
+def encode_record(record):
+    payload = json.dumps(record, separators=(",", ":"), default=json_default).encode("utf-8")
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+class WriteAheadLog:
+    # Append-only log of every change to users and conversations. append() only queues the
+    # record and returns its sequence number; a single flusher thread writes whatever has
+    # queued up, fsyncs once for the whole batch (group commit) and wakes everyone waiting on
+    # a record in it. A handler calls wait(seq) after releasing its locks and before replying,
+    # so an acknowledged change is on disk while other threads keep appending meanwhile.
+    # sync=False skips the fsync (durable against a server crash, not a machine crash)
+    def __init__(self, path, commit_window=DEFAULT_COMMIT_WINDOW, sync=True):
+        self.path = path
+        self.commit_window = commit_window
+        self.sync = sync
+        self.cond = threading.Condition()
+        self.queued = []         # encoded records not yet written
+        self.appended = 0        # sequence number of the last record appended
+        self.durable = 0         # ... and of the last one on disk
+        self.error = None
+        self.closed = False
+        self.file = None
+        self.flusher = None
+        self.segment = 0         # segment the flusher writes to
+        self.newest_segment = 0  # ... once every queued rotation is done
+        self.records = 0
+        self.batches = 0
+        self.bytes = 0
+        self.sync_seconds = 0.0
+        self.started = None
+
+    # Feed every intact record of the segments from first_segment on to apply(record), in
+    # order, and return how many there were. Must run before start(), which appends to the
+    # last of them; a torn or corrupt tail is truncated so new records follow the last good one
+    def replay(self, apply, first_segment=0):
+        numbers = [n for n in segment_numbers(self.path) if n >= first_segment]
+        self.segment = self.newest_segment = max(numbers, default=first_segment)
+        return sum(self.replay_segment(segment_path(self.path, n), apply) for n in numbers)
+
+    def replay_segment(self, path, apply):
+        count = 0
+        with open(path, "r+b") as f:
+            good = 0
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                apply(json.loads(payload))
+                count += 1
+                good = f.tell()
+            if os.path.getsize(path) > good:
+                print(f"[WAL] Truncating torn tail of {path} at byte {good}")
+                f.truncate(good)
+        return count
+
+    def start(self):
+        self.file = open(segment_path(self.path, self.segment), "ab")
+        self.started = time.perf_counter()
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def append(self, record):
+        data = encode_record(record)
+        with self.cond:
+            if self.closed:
+                raise OSError("Write-ahead log is closed")
+            self.queued.append(data)
+            self.appended += 1
+            self.cond.notify_all()
+            return self.appended
+
+    # Start a new segment: records appended before this call stay in the current one, later
+    # records go to the next. Call it with every writer held off, so the cut matches the state.
+    # Returns the new segment's number and the sequence number that is durable once the switch is
+    def rotate(self):
+        with self.cond:
+            if self.closed:
+                raise OSError("Write-ahead log is closed")
+            self.queued.append(ROTATE)
+            self.appended += 1
+            self.newest_segment += 1
+            self.cond.notify_all()
+            return self.newest_segment, self.appended
+
+    # Delete the segments before number (a snapshot has everything in them)
+    def remove_segments_before(self, number):
+        for n in segment_numbers(self.path):
+            if n < number:
+                os.remove(segment_path(self.path, n))
+
+    # Block until record seq (and everything appended before it) is on disk
+    def wait(self, seq):
+        with self.cond:
+            while self.durable < seq and self.error is None:
+                self.cond.wait()
+            if self.durable < seq:
+                raise OSError(f"Write-ahead log failed: {self.error}")
+
+    def flush_loop(self):
+        while True:
+            with self.cond:
+                while not self.queued and not self.closed:
+                    self.cond.wait()
+                if not self.queued:
+                    return
+                crowded = len(self.queued) > 1
+            # Under concurrent load, let the rest of the group arrive before paying for the fsync;
+            # a lone writer is flushed at once
+            if self.commit_window > 0 and crowded:
+                time.sleep(self.commit_window)
+            with self.cond:
+                batch = self.queued
+                self.queued = []
+                last = self.appended
+            start = time.perf_counter()
+            records = size = 0
+            try:
+                for data in batch:
+                    if data is ROTATE:
+                        self.switch_segment()
+                    else:
+                        self.file.write(data)
+                        records += 1
+                        size += len(data)
+                self.file.flush()
+                if self.sync:
+                    os.fsync(self.file.fileno())
+            except OSError as e:
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.sync_seconds += time.perf_counter() - start
+                self.durable = last
+                self.records += records
+                self.batches += 1
+                self.bytes += size
+                self.cond.notify_all()
+
+    def switch_segment(self):
+        self.file.flush()
+        if self.sync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.segment += 1
+        self.file = open(segment_path(self.path, self.segment), "ab")
+
+    # Flush what is queued and stop the flusher
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        if self.flusher is not None:
+            self.flusher.join()
+        if self.file is not None:
+            self.file.close()
+
+    def stats(self):
+        with self.cond:
+            elapsed = time.perf_counter() - self.started if self.started else 0.0
+            return {"records": self.records, "fsyncs": self.batches if self.sync else 0,
+                    "records_per_batch": round(self.records / self.batches, 1) if self.batches else 0.0,
+                    "bytes": self.bytes, "sync_ms": round(self.sync_seconds * 1000, 1),
+                    "records_per_sec": round(self.records / elapsed, 1) if elapsed else 0.0}
+
+# Record builders. Each is appended under the lock that orders its change (the user lock for
+# account and unread changes, the conversation lock for history changes), so records touching
+# the same key are in the log in the order they were applied
+def create_record(username, password_hash):
+    return {"op": "create", "user": username, "hash": password_hash}
+
+def delete_user_record(username):
+    return {"op": "delete", "user": username}
+
+def post_record(conv_key, message_entry):
+    return {"op": "post", "conv": list(conv_key), "entry": message_entry}
+
+# Unread entries share their message with the history, so only the ID is logged, unless the
+# history is kept somewhere else than the log (entry: log the whole message)
+def unread_record(username, conv_key, msg_id, entry=None):
+    record = {"op": "unread", "user": username, "conv": list(conv_key), "id": msg_id}
+    if entry is not None:
+        record["entry"] = entry
+    return record
+
+def drop_unread_record(username, ids):
+    return {"op": "drop_unread", "user": username, "ids": list(ids)}
+
+def delete_conv_record(conv_key, ids):
+    return {"op": "delete_conv", "conv": list(conv_key), "ids": list(ids)}
+
+# Redo one record against a server's state (users, conversations, ID allocator)
+def apply_record(record, users, conversations, message_ids):
+    op = record["op"]
+    if op == "create":
+        users[record["user"]] = {"password_hash": record["hash"], "messages": []}
+    elif op == "delete":
+        users.pop(record["user"], None)
+    elif op == "post":
+        entry = Message.from_fields(record["entry"])
+        conversations.setdefault(tuple(record["conv"]), []).append(entry)
+        message_ids.advance_past(entry.id)
+    elif op == "unread" and "entry" in record:
+        if record["user"] in users:
+            users[record["user"]]["messages"].append(Message.from_fields(record["entry"]))
+    elif op == "unread":
+        conv = conversations.get(tuple(record["conv"]), [])
+        index = bisect.bisect_left(conv, record["id"], key=entry_id)
+        if record["user"] in users and index < len(conv) and conv[index]["id"] == record["id"]:
+            users[record["user"]]["messages"].append(conv[index])
+    elif op == "drop_unread":
+        if record["user"] in users:
+            ids = set(record["ids"])
+            unread = users[record["user"]]["messages"]
+            users[record["user"]]["messages"] = [msg for msg in unread if msg["id"] not in ids]
+    elif op == "delete_conv":
+        conv_key = tuple(record["conv"])
+        if conv_key in conversations:
+            ids = set(record["ids"])
+            conversations[conv_key] = [msg for msg in conversations[conv_key] if msg["id"] not in ids]
+    else:
+        raise ValueError(f"Unknown log record: {op}")
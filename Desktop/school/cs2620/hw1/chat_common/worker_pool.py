@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+DEFAULT_QUEUE_DEPTH = 64
+# Pool an event-loop server starts on its own when its store waits on the disk (see
+# durable_pool_size): enough workers for that many changes to share each fsync
+DEFAULT_DURABLE_WORKERS = 16
+
+# Workers an event-loop server needs: its own setting, or DEFAULT_DURABLE_WORKERS when the
+# store blocks until changes are on disk, since such a call must never run on the loop thread
+def durable_pool_size(workers, store):
+    if workers <= 0 and getattr(store, "waits_on_disk", False):
+        print(f"[POOL] The store waits for the disk; running commands on {DEFAULT_DURABLE_WORKERS} workers")
+        return DEFAULT_DURABLE_WORKERS
+    return workers
+
+class OrderedWorkerPool:
+    # Fixed-size pool that runs parsed commands off the I/O threads. Work submitted under the
+    # same key (one key per connection) runs one item at a time in submission order, while
+    # different keys share the workers. Queue-wait time (submit -> start) is recorded so the
+    # pool size can be tuned from real numbers.
+    def __init__(self, max_workers=8, queue_depth=DEFAULT_QUEUE_DEPTH):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if queue_depth < 1:
+            raise ValueError("queue_depth must be at least 1")
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat-worker")
+        self.lock = threading.Lock()
+        # key -> deque of (future, fn, args, enqueued_at); a key is present while it has work
+        self.queues = {}
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, key, fn, *args):
+        future = Future()
+        item = (future, fn, args, time.perf_counter())
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                # Something for this key is queued or running; it will pick this up in order
+                queue.append(item)
+                return future
+            self.queues[key] = deque([item])
+        self.executor.submit(self._run_next, key)
+        return future
+
+    def pending(self, key):
+        with self.lock:
+            queue = self.queues.get(key)
+            return len(queue) if queue is not None else 0
+
+    def _run_next(self, key):
+        with self.lock:
+            future, fn, args, enqueued_at = self.queues[key][0]
+        waited = time.perf_counter() - enqueued_at
+        if future.set_running_or_notify_cancel():
+            try:
+                result = fn(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                if isinstance(result, Future):
+                    # The command is done but its reply is still streaming out (see
+                    # chat_common.outbound.send_stream): the key's next item waits for the
+                    # stream, this worker doesn't
+                    result.add_done_callback(lambda streamed: self._finish_streamed(key, future, streamed, waited))
+                    return
+                future.set_result(result)
+        self._finish(key, waited)
+
+    def _finish_streamed(self, key, future, streamed, waited):
+        if streamed.exception() is not None:
+            future.set_exception(streamed.exception())
+        else:
+            future.set_result(streamed.result())
+        self._finish(key, waited)
+
+    def _finish(self, key, waited):
+        with self.lock:
+            self.completed += 1
+            self.wait_total += waited
+            if waited > self.wait_max:
+                self.wait_max = waited
+            queue = self.queues[key]
+            queue.popleft()
+            if not queue:
+                del self.queues[key]
+                return
+        # Requeue instead of looping so one busy connection cannot monopolise a worker
+        try:
+            self.executor.submit(self._run_next, key)
+        except RuntimeError:
+            pass  # shut down
+
+    def stats(self):
+        with self.lock:
+            avg = self.wait_total / self.completed if self.completed else 0.0
+            return {
+                "workers": self.max_workers,
+                "completed": self.completed,
+                "queued": sum(len(q) for q in self.queues.values()),
+                "avg_wait_ms": avg * 1000,
+                "max_wait_ms": self.wait_max * 1000,
+            }
+
+    def start_reporter(self, interval):
+        # Print queue-wait statistics every interval seconds from a daemon thread
+        def report():
+            while True:
+                time.sleep(interval)
+                s = self.stats()
+                print(f"[POOL] workers={s['workers']} completed={s['completed']} queued={s['queued']} "
+                      f"avg_wait={s['avg_wait_ms']:.3f}ms max_wait={s['max_wait_ms']:.3f}ms")
+        threading.Thread(target=report, daemon=True).start()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+class ConnectionQueue:
+    # Per-connection window onto the pool for blocking I/O threads. submit() blocks once
+    # queue_depth commands are outstanding, and reports False as soon as a finished command
+    # returned False (the client asked to close).
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.inflight = deque()
+
+    def submit(self, fn, *args):
+        self.inflight.append(self.pool.submit(self.key, fn, *args))
+        while self.inflight and (self.inflight[0].done() or len(self.inflight) > self.pool.queue_depth):
+            if self.inflight.popleft().result() is False:
+                return False
+        return True
+
+    def drain(self):
+        # Wait for every outstanding command; False if one of them asked to close
+        keep_open = True
+        while self.inflight:
+            if self.inflight.popleft().result() is False:
+                keep_open = False
+        return keep_open
@@ -1,6 +1,26 @@
 import time
 import struct
 import json
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import datetime
+import random
+import tracemalloc
+import signal
+import socket
+import subprocess
+import multiprocessing
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "Custom_impl"))
+from protocol_custom import (MessageSchema, CODEC_V1, CODEC_V2, BYTE, SHORT, LONG, CMD_SEND, CMD_CREATE,
+                             CMD_VIEW_CONV, REQUEST_SCHEMAS, STATUS, CREDENTIALS, FrameReader)
+import protocol_custom
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from chat_common.wal import WriteAheadLog, post_record
+from chat_common.message import Message
 
 # JSON
 
@@ -65,6 +85,114 @@ def binary_decode(payload: bytes):
     message, offset = unpack_long_string(payload, offset)
     return {"cmd": cmd, "from": username, "to": to, "body": message}
 
+# SCHEMA
+
+# Same layout as binary_encode, declared once. compile() builds the encoder and decoder for a
+# codec, specialised to this layout: one precomputed Struct packs cmd and the first length, and
+# the strings are concatenated behind it with no loop over the fields
+MESSAGE = MessageSchema(("cmd", BYTE), ("from", SHORT), ("to", SHORT), ("body", LONG))
+encode_message_schema, decode_message_schema = MESSAGE.compile(CODEC_V1)[:2]
+
+def schema_encode(data: dict):
+    return encode_message_schema((data.get("cmd", 99) & 0xFF, data.get("from", ""), data.get("to", ""), data.get("body", "")))
+
+def schema_decode(payload: bytes):
+    cmd, username, to, message = decode_message_schema(payload)
+    return {"cmd": cmd, "from": username, "to": to, "body": message}
+
+# SERVER FRAMES
+
+# The frames the server sends most, built the way server_custom did before the schemas: the
+# protocol's pack helpers, then the codec's header in front
+SEND = REQUEST_SCHEMAS[CMD_SEND]
+
+def hand_status_frame(codec, text, request_id=None):
+    return codec.encode_message(CMD_SEND, protocol_custom.pack_short_string(text), request_id)
+
+def hand_send_frame(codec, sender, recipient, message, request_id=None):
+    payload = (protocol_custom.pack_short_string(sender) + protocol_custom.pack_short_string(recipient)
+               + codec.pack_long_string(message))
+    return codec.encode_message(CMD_SEND, payload, request_id)
+
+def hand_send_decode(codec, payload):
+    sender, offset = protocol_custom.unpack_short_string(payload, 0)
+    recipient, offset = protocol_custom.unpack_short_string(payload, offset)
+    message, _ = codec.unpack_long_string(payload, offset)
+    return sender, recipient, message
+
+# A frame as bytes or decoded fields as a tuple, so both paths' results can be compared
+def comparable(result):
+    return tuple(result) if isinstance(result, (tuple, list)) else bytes(result)
+
+# Seconds to call func() iterations times, best of repeats runs so a stray pause doesn't decide it
+def measure_calls(func, iterations, repeats=3):
+    best = None
+    for _ in range(repeats):
+        start = time.time()
+        for _ in range(iterations):
+            func()
+        duration = time.time() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+# SHARDED SERVER
+
+SHARD_BENCH_PORT = 56900
+SERVER_CUSTOM = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Custom_impl", "server_custom.py")
+
+def connect_when_up(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(("127.0.0.1", port))
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+# One benchmark client: ask for username's conversation with bench_peer until seconds are up,
+# one request at a time. Returns the number of replies
+def view_conv_loop(port, username, seconds):
+    sock = connect_when_up(port)
+    reader = FrameReader(sock)
+    request = REQUEST_SCHEMAS[CMD_VIEW_CONV].frame(CODEC_V1, CMD_VIEW_CONV, (username, "bench_peer"))
+    count = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        sock.sendall(request)
+        reader.read_frame()
+        count += 1
+    sock.close()
+    return count
+
+# Requests/sec the multi-process Custom server answers when its commands run in shards owner
+# processes: clients processes each fetch their own history-length conversation as fast as the
+# replies come back. The users hash across the shards, so each owner serves some of them
+def measure_sharded_views(shards, clients=8, seconds=3.0, processes=2, history=200):
+    db_dir = tempfile.mkdtemp()
+    port = SHARD_BENCH_PORT + shards
+    proc = subprocess.Popen([sys.executable, SERVER_CUSTOM, "--processes", str(processes), "--shards", str(shards),
+                             "--db", os.path.join(db_dir, "chat.db"), "--port", str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        sock = connect_when_up(port)
+        reader = FrameReader(sock)
+        names = ["bench_peer"] + [f"bench{i}" for i in range(clients)]
+        frames = [CREDENTIALS.frame(CODEC_V1, CMD_CREATE, (name, "pw")) for name in names]
+        frames += [REQUEST_SCHEMAS[CMD_SEND].frame(CODEC_V1, CMD_SEND, (name, "bench_peer", f"message {n} from {name}"))
+                   for name in names[1:] for n in range(history)]
+        sock.sendall(b"".join(bytes(frame) for frame in frames))
+        for _ in frames:
+            reader.read_frame()
+        sock.close()
+        with multiprocessing.get_context("fork").Pool(clients) as client_pool:
+            counts = client_pool.starmap(view_conv_loop, [(port, name, seconds) for name in names[1:]])
+        return sum(counts) / seconds
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait(timeout=10)
+        shutil.rmtree(db_dir, ignore_errors=True)
+
 # Performance comparison
 
 def measure_encoding(data, encode_func, iterations=10000):
@@ -85,6 +213,67 @@ def measure_decoding(encoded, decode_func, iterations=10000):
     duration = time.time() - start
     return duration
 
+# Seconds to encode (or decode) every item of inputs once, and the results
+def measure_batch(inputs, func):
+    start = time.time()
+    results = [func(item) for item in inputs]
+    return time.time() - start, results
+
+# count messages whose names and bodies vary in length, as they do in a real chat, so no
+# encoder gets to reuse work from the previous message
+def varied_messages(count, seed=2620):
+    rng = random.Random(seed)
+    words = "hello bob let's measure how efficient this is with messages of every length".split()
+    return [{"cmd": 3, "from": "user%d" % rng.randrange(10 ** rng.randrange(1, 7)),
+             "to": "friend" + "x" * rng.randrange(20),
+             "body": " ".join(rng.choice(words) for _ in range(rng.randrange(1, 60)))}
+            for _ in range(count)]
+
+# Messages per second that are on disk before they are acknowledged: each of senders threads logs
+# a send and waits for it, like a handler does before replying "Message sent"
+def measure_durable_sends(commit_window, senders, per_sender=200):
+    tmpdir = tempfile.mkdtemp()
+    log = WriteAheadLog(os.path.join(tmpdir, "bench.wal"), commit_window)
+    log.start()
+    def sender(n):
+        for i in range(per_sender):
+            entry = {"id": n * per_sender + i, "sender": "alice", "message": "Hello Bob!", "timestamp": "2025-01-01T00:00:00"}
+            log.wait(log.append(post_record(("alice", "bob"), entry)))
+    threads = [threading.Thread(target=sender, args=(n,)) for n in range(senders)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    stats = log.stats()
+    log.close()
+    shutil.rmtree(tmpdir)
+    return senders * per_sender / elapsed, stats["fsyncs"]
+
+# Heap bytes per message held in a history plus its recipient's unread list, as dict entries
+# with an unread copy (make_entry returns two objects) or as one shared Message
+def measure_message_memory(make_entry, count=100000):
+    start = datetime.datetime(2025, 1, 1)
+    tracemalloc.start()
+    history, unread = [], []
+    for i in range(count):
+        timestamp = (start + datetime.timedelta(seconds=i, microseconds=i)).isoformat()
+        entry, copy = make_entry(i, "alice" if i % 2 else "bob", f"Hello number {i}", timestamp)
+        history.append(entry)
+        unread.append(copy)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / count
+
+def dict_entries(msg_id, sender, message, timestamp):
+    entry = {"id": msg_id, "sender": sender, "message": message, "timestamp": timestamp}
+    return entry, dict(entry)
+
+def message_records(msg_id, sender, message, timestamp):
+    msg = Message(msg_id, sender, message, timestamp)
+    return msg, msg
+
 def main():
     iterations = 100000
     test_data = {
@@ -102,6 +291,11 @@ def main():
     avg_size_bin, enc_time_bin, encoded_bin = measure_encoding(test_data, binary_encode, iterations)
     dec_time_bin = measure_decoding(encoded_bin, binary_decode, iterations)
 
+    # Schema 
+    avg_size_schema, enc_time_schema, encoded_schema = measure_encoding(test_data, schema_encode, iterations)
+    dec_time_schema = measure_decoding(encoded_schema, schema_decode, iterations)
+    assert bytes(encoded_schema) == encoded_bin
+
     print("JSON Implementation:")
     print(f"Average size: {avg_size_json:.2f} bytes")
     print(f"Encoding {iterations} times: {enc_time_json:.6f} seconds")
@@ -112,6 +306,84 @@ def main():
     print(f"Average size: {avg_size_bin:.2f} bytes")
     print(f"Encoding {iterations} times: {enc_time_bin:.6f} seconds")
     print(f"Decoding {iterations} times: {dec_time_bin:.6f} seconds")
+    print()
+
+    print("Binary (Schema) Implementation:")
+    print(f"Average size: {avg_size_schema:.2f} bytes")
+    print(f"Encoding {iterations} times: {enc_time_schema:.6f} seconds ({enc_time_bin / enc_time_schema:.2f}x binary)")
+    print(f"Decoding {iterations} times: {dec_time_schema:.6f} seconds ({dec_time_bin / dec_time_schema:.2f}x binary)")
+    print()
+
+    # A longer body, where writing everything into one buffer saves the most copying
+    large_data = dict(test_data, body="Hello Bob, let's measure how efficient this is! " * 80)
+    _, enc_time_bin, encoded_bin = measure_encoding(large_data, binary_encode, iterations)
+    dec_time_bin = measure_decoding(encoded_bin, binary_decode, iterations)
+    _, enc_time_schema, encoded_schema = measure_encoding(large_data, schema_encode, iterations)
+    dec_time_schema = measure_decoding(encoded_schema, schema_decode, iterations)
+    assert bytes(encoded_schema) == encoded_bin
+    print(f"Binary vs Schema with a {len(encoded_bin)}-byte message:")
+    print(f"Encoding {iterations} times: {enc_time_bin:.6f} vs {enc_time_schema:.6f} seconds ({enc_time_bin / enc_time_schema:.2f}x)")
+    print(f"Decoding {iterations} times: {dec_time_bin:.6f} vs {dec_time_schema:.6f} seconds ({dec_time_bin / dec_time_schema:.2f}x)")
+    print()
+
+    # Every message different, as in real traffic
+    messages = varied_messages(iterations)
+    enc_time_bin, encoded_bin = measure_batch(messages, binary_encode)
+    dec_time_bin, _ = measure_batch(encoded_bin, binary_decode)
+    enc_time_schema, encoded_schema = measure_batch(messages, schema_encode)
+    dec_time_schema, _ = measure_batch(encoded_schema, schema_decode)
+    assert [bytes(m) for m in encoded_schema] == encoded_bin
+    print(f"Binary vs Schema with {iterations} different messages:")
+    print(f"Encoding: {enc_time_bin:.6f} vs {enc_time_schema:.6f} seconds ({enc_time_bin / enc_time_schema:.2f}x)")
+    print(f"Decoding: {dec_time_bin:.6f} vs {dec_time_schema:.6f} seconds ({dec_time_bin / dec_time_schema:.2f}x)")
+    print()
+
+    # The server's own frames, hand-packed versus their schemas
+    print(f"Server frames, hand-packed vs schema ({iterations} times):")
+    text, body = "Message sent", test_data["body"]
+    send_payload = bytes(SEND.pack(CODEC_V1, ("Alice", "Bob", body)))
+    cases = (
+        ("STATUS reply, v1", lambda: hand_status_frame(CODEC_V1, text),
+         lambda: STATUS.frame(CODEC_V1, CMD_SEND, (text,))),
+        ("STATUS reply, v2 with request ID", lambda: hand_status_frame(CODEC_V2, text, 7),
+         lambda: STATUS.frame(CODEC_V2, CMD_SEND, (text,), 7)),
+        ("CMD_SEND frame, v1", lambda: hand_send_frame(CODEC_V1, "Alice", "Bob", body),
+         lambda: SEND.frame(CODEC_V1, CMD_SEND, ("Alice", "Bob", body))),
+        ("CMD_SEND frame, v2 with request ID", lambda: hand_send_frame(CODEC_V2, "Alice", "Bob", body, 7),
+         lambda: SEND.frame(CODEC_V2, CMD_SEND, ("Alice", "Bob", body), 7)),
+        ("CMD_SEND payload decode, v1", lambda: hand_send_decode(CODEC_V1, send_payload),
+         lambda: SEND.unpack(CODEC_V1, send_payload)),
+    )
+    for label, hand, schema in cases:
+        assert comparable(schema()) == comparable(hand())
+        hand_time = measure_calls(hand, iterations)
+        schema_time = measure_calls(schema, iterations)
+        print(f"{label}: {hand_time:.6f} vs {schema_time:.6f} seconds ({hand_time / schema_time:.2f}x)")
+    print()
+
+    # Durable sends: one fsync per message versus group commit across concurrent senders
+    print("Write-ahead log, every send fsynced before it is acknowledged:")
+    for label, window, senders in (("1 sender, fsync per message", 0, 1),
+                                   ("16 senders, fsync per batch", 0, 16),
+                                   ("16 senders, 2 ms commit window", 0.002, 16)):
+        rate, fsyncs = measure_durable_sends(window, senders)
+        print(f"{label}: {rate:.0f} messages/sec, {fsyncs} fsyncs for {senders * 200} messages")
+    print()
+
+    # Command execution spread over owner processes
+    print(f"Multi-process server, 200-message view_conv from 8 clients, 2 workers ({os.cpu_count()} CPUs):")
+    base = None
+    for shards in (1, 2, 4):
+        rate = measure_sharded_views(shards)
+        base = base or rate
+        print(f"{shards} shard(s): {rate:.0f} requests/sec ({rate / base:.2f}x)")
+    print()
+
+    # Memory per stored message: history entry plus the recipient's unread entry
+    print("Stored message, history plus unread (tracemalloc):")
+    for label, make_entry in (("dict entries, unread copy", dict_entries),
+                              ("shared __slots__ Message", message_records)):
+        print(f"{label}: {measure_message_memory(make_entry):.0f} bytes/message")
 
 if __name__ == "__main__":
     main()
@@ -145,4 +417,51 @@ if __name__ == "__main__":
 # while the faster packing and unpacking can handle more messages with the same resources. Thus, as the
 # system scales, the binary solution can serve more users and higher message rates without the additional
 # overhead that comes from parsing and generating JSON for several thousands/millions of concurrent users.
+#
+# The schema version produces exactly the same bytes as binary_encode, from a declared field list
+# instead of hand-written packing code, and its decoder also rejects truncated payloads, which
+# binary_decode does not. Each schema is compiled into an encoder and decoder for its layout: one
+# struct.Struct per string packs it together with the fixed-width fields in front of it (and, for
+# a frame, the header and request ID), so there is no loop over the fields per message. Encoding
+# ran at about 1.05-1.15x binary_encode's speed with the 60-byte message, 1.1x with the 3.8 KB one
+# and 1.0-1.05x with 100,000 different messages. Decoding is not faster: 0.9-1.0x binary_decode,
+# which is as short as a decoder for this layout gets. Against the server's own frames as it used
+# to build them (the protocol's pack helpers, then encode_message), the schema builds a STATUS reply
+# about as fast on v1 and 1.15x faster with a v2 request ID, a CMD_SEND frame 1.2-1.3x faster, and
+# decodes a CMD_SEND payload 1.25-1.3x faster (best of three runs of 100,000).
+#
+# With a write-ahead log (--wal), a change is only acknowledged once its record is fsynced. Done one
+# message at a time that caps a single sender at one fsync per message (about 11,000-12,000
+# messages/sec on an ext4 disk whose fsync takes ~0.1 ms). The log's flusher writes every record that
+# queued up while the previous fsync ran in one batch, so 16 concurrent senders reached about
+# 28,000-30,000 messages/sec with roughly one fsync per 7 messages. That is the default (commit window
+# 0). A window only waits when several writers are already queued, so a lone sender no longer pays
+# for it (10,000-13,000 messages/sec with 2 ms); under load a 2 ms window groups further (about 280
+# fsyncs for 3,200 messages), but on a disk this fast the waiting costs more than the fsyncs it saves:
+# about 6,000 messages/sec with 16 senders and 17,000 with 64. --commit-window pays off where an fsync
+# costs milliseconds.
+#
+# The same holds for the servers: a handler waits for its record before replying, so an event-loop
+# server (asyncio, selectors) must not run handlers on its loop thread, or every fsync stalls every
+# connection and no two records ever share one. With a store that waits on the disk those modes run
+# commands on a worker pool even without --workers: 16 JSON clients in asyncio mode with --wal went
+# from 199 sends/sec (one fsync per record) to about 3,400 (2.7 records per fsync).
+#
+# MemoryStore keeps each message as a __slots__ Message shared by the history and the recipient's
+# unread list, with the sender interned and the timestamp held as integer microseconds. Measured with
+# tracemalloc for 100,000 short messages, a history entry plus its unread entry took about 558 bytes as
+# two dicts and 211 bytes as one Message (the message text itself included). The price is on the
+# edges: building a Message, which parses the ISO timestamp, costs about 0.8 us instead of 0.2 us for a
+# dict, and reading msg["timestamp"] formats it again (about 1.3 us), which only happens when a
+# message is sent to a client.
+#
+# In multi-process mode (--processes) the workers only move bytes; the commands run in the state
+# owner. With one owner, 8 clients fetching a 200-message history kept it busy for 1.96 s of CPU in
+# 2.5 s while each worker used about 0.13 s, so the owner caps the server however many workers are
+# forked. With --shards 4 (and --db, which every owner opens) the same load split into 0.40-0.55 s per
+# owner, since each user's commands run on the shard they hash to. The machine these numbers come
+# from has one CPU, so the owners took turns on it and throughput stayed at about 2,800-2,900
+# requests/sec for 1, 2 and 4 shards; with a core per owner, the split work runs in parallel. Within
+# an owner, commands run on a pool keyed by connection, so one slow command (an fsync, a long
+# history) no longer holds up every other connection on the same worker.
 #*
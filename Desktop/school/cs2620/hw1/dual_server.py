@@ -0,0 +1,115 @@
+import argparse
+import os
+import socket
+import sys
+import threading
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, "Json_impl"))
+sys.path.append(os.path.join(HERE, "Custom_impl"))
+from server import ChatServer
+import server_custom
+from chat_common.worker_pool import DEFAULT_QUEUE_DEPTH
+from chat_common.wal import DEFAULT_COMMIT_WINDOW
+from chat_common.snapshot import DEFAULT_SNAPSHOT_EVERY
+from chat_common.sqlite_store import SqliteStore
+from chat_common.segment_store import SegmentStore
+
+# One listener for both wire formats. Every JSON request is an object, so a JSON client's
+# first byte is always "{". A binary client's first byte is a command byte: CMD_HELLO or a
+# plain command, never compressed, so it can't be 0x7B (0x40 | 59 is no command)
+JSON_FIRST_BYTE = ord("{")
+# How long a new connection may stay silent before it is dropped unclassified
+SNIFF_TIMEOUT = 30.0
+
+class DualServer:
+    # Runs the JSON server's command handlers and the binary server's on a single copy of the
+    # state: the binary module's globals are pointed at the ChatServer's store, active users,
+    # locks and backpressure. Users, unread messages and histories are shared, and a push to a
+    # user is framed by the protocol that user logged in with (chat_push_parts)
+    def __init__(self, port=12345, workers=0, queue_depth=DEFAULT_QUEUE_DEPTH, wal_path=None,
+                 commit_window=DEFAULT_COMMIT_WINDOW, snapshot_every=DEFAULT_SNAPSHOT_EVERY, store=None):
+        self.port = port
+        self.chat = ChatServer(port=port, workers=workers, queue_depth=queue_depth, bind=False,
+                               wal_path=wal_path, commit_window=commit_window, snapshot_every=snapshot_every,
+                               store=store)
+        share_state(self.chat)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(("0.0.0.0", port))
+        self.running = True
+
+    def start(self):
+        self.server.listen(socket.SOMAXCONN)
+        print(f"[LISTENING] Dual-protocol server is listening on port {self.port}")
+        while self.running:
+            try:
+                conn, addr = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.route, args=(conn, addr), daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.server.close()
+        self.chat.stop()
+
+    # Peek at the first byte, without consuming it, and hand the connection to that protocol
+    def route(self, conn, addr):
+        conn.settimeout(SNIFF_TIMEOUT)
+        try:
+            first = conn.recv(1, socket.MSG_PEEK)
+        except OSError:
+            first = b""
+        if not first:
+            conn.close()
+            return
+        conn.settimeout(None)
+        if first[0] == JSON_FIRST_BYTE:
+            self.chat.handle_client(conn, addr)
+        else:
+            server_custom.handle_client(conn, addr)
+
+# Point the binary server's module state at a ChatServer's
+def share_state(chat):
+    server_custom.store = chat.store
+    server_custom.active_users = chat.active_users
+    server_custom.locks = chat.locks
+    server_custom.backpressure = chat.backpressure
+    server_custom.compression_stats = chat.compression_stats
+    server_custom.pool = chat.pool
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSON and binary chat server on one port")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run commands on a fixed pool of this many threads (0 = on the I/O thread)")
+    parser.add_argument("--queue-depth", type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help="commands a connection may have waiting for the pool")
+    parser.add_argument("--wal", default=None,
+                        help="write-ahead log file: replayed at startup, every change is fsynced before it is acknowledged")
+    parser.add_argument("--commit-window", type=float, default=DEFAULT_COMMIT_WINDOW * 1000,
+                        help="milliseconds a log write waits for more records when several writers are queued (group commit)")
+    parser.add_argument("--snapshot-every", type=int, default=DEFAULT_SNAPSHOT_EVERY,
+                        help="log records between background snapshots that let the log be truncated (0 = never)")
+    parser.add_argument("--db", default=None,
+                        help="keep accounts and messages in this SQLite database instead of memory")
+    parser.add_argument("--segments", default=None,
+                        help="keep histories in memory-mapped segment files in this directory (accounts use --wal)")
+    args = parser.parse_args()
+    store = None
+    if args.db:
+        store = SqliteStore(args.db)
+    elif args.segments:
+        store = SegmentStore(args.segments, args.wal, args.commit_window / 1000, args.snapshot_every)
+    server = DualServer(port=args.port, workers=args.workers, queue_depth=args.queue_depth,
+                        wal_path=args.wal, commit_window=args.commit_window / 1000,
+                        snapshot_every=args.snapshot_every, store=store)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        print("[SHUTDOWN] Server is shutting down.")
+        print(f"[BACKPRESSURE] {server.chat.backpressure.stats()}")
+        print(f"[COMPRESSION] {server.chat.compression_stats.snapshot()}")
+        print(f"[STORE] {server.chat.store.stats()}")
+        server.stop()
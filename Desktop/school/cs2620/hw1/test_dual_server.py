@@ -0,0 +1,79 @@
+import json
+import socket
+import threading
+import time
+import unittest
+
+from dual_server import DualServer
+from protocol_custom import (
+    FrameReader, CODEC_V2, PROTOCOL_V2, CMD_HELLO, CMD_CREATE, CMD_LOGIN, CMD_SEND, CMD_LIST, CMD_CHAT,
+    REQUEST_SCHEMAS, CHAT, STATUS, TEXT, encode_message, pack_hello
+)
+
+HOST = "127.0.0.1"
+PORT = 56795
+
+class DualServerTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = DualServer(port=PORT)
+        threading.Thread(target=cls.server.start, daemon=True).start()
+        time.sleep(0.3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def json_client(self):
+        s = socket.create_connection((HOST, PORT))
+        self.addCleanup(s.close)
+        return s, s.makefile("rb")
+
+    def json_request(self, s, lines, msg):
+        s.sendall((json.dumps(msg) + "\n").encode())
+        return json.loads(lines.readline())
+
+    def binary_client(self):
+        s = socket.create_connection((HOST, PORT))
+        self.addCleanup(s.close)
+        reader = FrameReader(s)
+        s.sendall(encode_message(CMD_HELLO, pack_hello(PROTOCOL_V2)))
+        self.assertEqual(reader.read_frame()[0], CMD_HELLO)
+        return s, reader
+
+    def binary_request(self, s, reader, cmd, values):
+        s.sendall(REQUEST_SCHEMAS[cmd].frame(CODEC_V2, cmd, values))
+        return reader.read_frame()
+
+    def test_json_and_binary_users_share_state(self):
+        js, lines = self.json_client()
+        bs, reader = self.binary_client()
+        self.assertFalse(self.json_request(js, lines, {"cmd": "create", "from": "dual_json", "password": "pw"})["error"])
+        _, resp = self.binary_request(bs, reader, CMD_CREATE, ("dual_bin", "pw"))
+        self.assertEqual(STATUS.unpack(CODEC_V2, resp), ("Account created",))
+        _, resp = self.binary_request(bs, reader, CMD_LIST, ("dual_*",))
+        self.assertEqual(sorted(TEXT.unpack(CODEC_V2, resp)[0].split(",")), ["dual_bin", "dual_json"])
+
+        self.json_request(js, lines, {"cmd": "login", "from": "dual_json", "password": "pw"})
+        self.binary_request(bs, reader, CMD_LOGIN, ("dual_bin", "pw"))
+
+        # JSON to binary: the push arrives as a binary CMD_CHAT frame
+        resp = self.json_request(js, lines, {"cmd": "send", "from": "dual_json", "to": "dual_bin", "body": "hi binary"})
+        self.assertEqual(resp["body"], "Message sent")
+        cmd, push = reader.read_frame()
+        self.assertEqual((cmd, CHAT.unpack(CODEC_V2, push)), (CMD_CHAT, ("dual_json", "hi binary")))
+
+        # Binary to JSON: the push arrives as a JSON line, the reply as a binary frame
+        _, resp = self.binary_request(bs, reader, CMD_SEND, ("dual_bin", "dual_json", "hi json"))
+        self.assertEqual(STATUS.unpack(CODEC_V2, resp), ("Message sent",))
+        push = json.loads(lines.readline())
+        self.assertEqual(push["cmd"], "chat")
+        self.assertEqual(json.loads(push["body"])[0]["message"], "hi json")
+
+        history = self.json_request(js, lines, {"cmd": "view_conv", "from": "dual_json", "to": "dual_bin"})
+        ids = [entry["id"] for entry in json.loads(history["body"])]
+        self.assertEqual(len(ids), 2)
+        self.assertLess(ids[0], ids[1])
+
+if __name__ == "__main__":
+    unittest.main()